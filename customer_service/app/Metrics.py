@@ -0,0 +1,46 @@
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, disable_created_metrics, CONTENT_TYPE_LATEST
+from starlette.responses import Response
+import time
+
+# Seconds; covers a lookup by the id index up to a large CSV or NDJSON import
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# The service's own registry: in the gateway's monolith mode several services share one process
+registry = CollectorRegistry()
+disable_created_metrics()
+
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests served", ("method", "route", "status"), registry=registry)
+HTTP_DURATION = Histogram("http_request_duration_seconds", "HTTP request latency", ("method", "route"), buckets=DEFAULT_BUCKETS, registry=registry)
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests currently being served", registry=registry)
+
+
+class MetricsMiddleware:
+    """Plain ASGI middleware, labelled by the matched route template to keep cardinality bounded."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+        async def sendWithStatus(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, sendWithStatus)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            HTTP_DURATION.labels(scope["method"], path).observe(time.perf_counter() - started)
+            HTTP_REQUESTS.labels(scope["method"], path, str(status)).inc()
+
+
+async def metrics(request):
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
@@ -1,19 +1,55 @@
 import motor.motor_asyncio
+from pymongo import monitoring
 import os
 
+from .indexes import INDEXES
+from .Metrics import Histogram, Counter, DEFAULT_BUCKETS, registry
+
+
+MONGO_DURATION = Histogram("mongodb_command_duration_seconds", "MongoDB command latency", ("collection", "command"), buckets=DEFAULT_BUCKETS, registry=registry)
+MONGO_FAILURES = Counter("mongodb_command_failures_total", "MongoDB commands that failed", ("collection", "command"), registry=registry)
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Times every command pymongo sends, by collection and command name."""
+    def __init__(self):
+        self.collections = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = event.command.get("collection", "") # getMore carries the cursor id instead
+        self.collections[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event):
+        collection = self.collections.pop((event.connection_id, event.request_id), "")
+        MONGO_DURATION.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        collection = self.collections.pop((event.connection_id, event.request_id), "")
+        MONGO_DURATION.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+        MONGO_FAILURES.labels(collection, event.command_name).inc()
+
 
 conn_str = os.getenv('conn_str')
 
 class MongoDB:
-    def __init__(self, conn_str, list):
+    def __init__(self, conn_str, list, indexes={}):
         self.__client = motor.motor_asyncio.AsyncIOMotorClient(
-            conn_str, serverSelectionTimeoutMS=5000
+            conn_str, serverSelectionTimeoutMS=5000, event_listeners=[CommandMetrics()]
         )
         self.collections = {}
+        self.indexes = indexes
         self.addCollection(list)
 
     def addCollection(self, list):
         for collection in list:
             self.collections[collection[1]] = self.__client[collection[0]][collection[1]]
 
-mongodb = MongoDB(conn_str, [["Tesodev", "customers"]])
+    async def ensureIndexes(self):
+        # create_indexes is a no-op for indexes that already exist with the same spec
+        for collection, indexes in self.indexes.items():
+            await self.collections[collection].create_indexes(indexes)
+
+# cascadeJobs belongs to order_service; customer deletes queue their order cascade in it
+mongodb = MongoDB(conn_str, [["Tesodev", "customers"], ["Tesodev", "cascadeJobs"]], INDEXES)
@@ -0,0 +1,39 @@
+from pymongo.errors import DuplicateKeyError
+from datetime import datetime
+from bson import Binary
+import httpx
+import os
+
+from app.MongoDB import mongodb
+
+# Comma-separated, so every order_service instance drops its cached copy
+ORDER_SERVICE_URLS = [url for url in os.getenv('ORDER_SERVICE_URL', '').split(',') if url]
+
+client = httpx.AsyncClient(timeout=2)
+
+async def invalidateCustomerCache(customerId):
+    for url in ORDER_SERVICE_URLS:
+        try:
+            await client.delete(f"{url}/order/customerCache/{customerId}")
+        except httpx.HTTPError:
+            pass # The entry still expires after customer_cache_ttl
+
+
+async def queueOrderCascade(customerId):
+    """Queue the removal of a customer's orders in the job collection order_service's cascade workers poll.
+
+    The job is written to MongoDB before the delete is answered, so it survives
+    restarts of either service. It takes the workers' default mode, and a job
+    that is already running is left to finish; it removes whatever belongs to
+    the customer when it gets there.
+    """
+    try:
+        await mongodb.collections["cascadeJobs"].update_one(
+            {"_id": Binary.from_uuid(customerId), "status": {"$ne": "running"}},
+            {"$set": {"status": "queued", "queuedAt": datetime.utcnow(), "error": None},
+             "$unset": {"mode": ""},
+             "$setOnInsert": {"total": 0, "deleted": 0, "batches": 0}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        pass # Running
@@ -0,0 +1,37 @@
+from bson import Binary
+from datetime import datetime
+from uuid import UUID
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Encode list responses straight from the Motor documents instead of validating them into models first
+FAST_RESPONSES = os.getenv('fast_responses', 'false').lower() in ('1', 'true', 'yes')
+
+
+def encodeSpecial(value):
+    """Called by the encoder only for the types JSON has no form for."""
+    if isinstance(value, Binary):
+        return str(UUID(bytes=value))
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, UUID):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    def dumps(value) -> bytes:
+        return orjson.dumps(value, default=encodeSpecial)
+else:
+    def dumps(value) -> bytes:
+        return json.dumps(value, default=encodeSpecial, separators=(",", ":")).encode()
+
+
+def projection(model):
+    """Only the model's fields, so the output matches what response_model would have produced."""
+    return {"_id": 0} | {field: 1 for field in model.model_fields}
@@ -0,0 +1,163 @@
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+import csv
+import json
+import os
+
+from .models import UpdateCustomer, ImportSummary
+
+IMPORT_CHUNK_SIZE = int(os.getenv('import_chunk_size', 1000))
+MAX_IMPORT_ERRORS = int(os.getenv('max_import_errors', 1000))
+# Longer lines, and CSV records, are reported as a row error instead of being buffered
+MAX_LINE_LENGTH = int(os.getenv('import_max_line_length', 65536))
+
+ADDRESS_COLUMNS = ("addressLine", "city", "country", "cityCode")
+
+
+def decodeLine(line, maxLength):
+    if len(line) > maxLength:
+        return ValueError(f"Line is longer than {maxLength} bytes")
+    try:
+        return line.decode("utf-8").rstrip("\r")
+    except UnicodeDecodeError as exc:
+        return ValueError(f"Invalid UTF-8 at byte {exc.start}")
+
+
+async def readLines(stream, maxLength=MAX_LINE_LENGTH):
+    """Split a streamed body into lines without holding more than a chunk and a line in memory.
+
+    Every line is decoded on its own, so bad UTF-8 or a line over maxLength
+    bytes is yielded as a ValueError for that line and the import goes on.
+    """
+    buffer = b""
+    skipping = False # The rest of an overlong line is dropped up to its newline
+    async for chunk in stream:
+        *lines, buffer = (buffer + chunk).split(b"\n")
+        for line in lines:
+            if skipping:
+                skipping = False
+                continue
+            yield decodeLine(line, maxLength)
+        if len(buffer) > maxLength:
+            if not skipping:
+                yield ValueError(f"Line is longer than {maxLength} bytes")
+                skipping = True
+            buffer = b""
+    if buffer and not skipping:
+        yield decodeLine(buffer, maxLength)
+
+
+async def readRecords(stream, format, maxLength=MAX_LINE_LENGTH):
+    """Yield (line number, record or ValueError) for every line of the body.
+
+    A CSV record stays open while it has an unbalanced quote, so quoted fields
+    can hold newlines; such a record is numbered by its first line and capped
+    at maxLength characters like a line.
+    """
+    lineNumber, start, record, quoted = 0, 0, None, False
+    async for line in readLines(stream, maxLength):
+        lineNumber += 1
+        if isinstance(line, Exception):
+            yield (start if quoted else lineNumber), line
+            record, quoted = None, False
+            continue
+
+        if not quoted:
+            start, record = lineNumber, line
+        elif record is not None:
+            record += "\n" + line
+            if len(record) > maxLength:
+                yield start, ValueError(f"Record is longer than {maxLength} characters")
+                record = None # Skipped until its quote closes
+
+        if format == "csv" and line.count('"') % 2:
+            quoted = not quoted
+        if not quoted and record is not None:
+            yield start, record
+
+    if quoted and record is not None:
+        yield start, ValueError("Unterminated quoted field")
+
+
+def parseNDJSON(line, header):
+    row = json.loads(line)
+    if not isinstance(row, dict):
+        raise ValueError("Expected a JSON object")
+    return row
+
+
+def parseCSV(line, header):
+    values = next(csv.reader([line]))
+    if len(values) != len(header):
+        raise ValueError(f"Expected {len(header)} columns, got {len(values)}")
+
+    row = dict(zip(header, values))
+    row["address"] = {column: row.pop(column) or None for column in ADDRESS_COLUMNS if column in row}
+    return row
+
+
+async def readRows(stream, format):
+    """Yield (line number, parsed row or the exception raised while parsing it)."""
+    header = None
+    async for lineNumber, line in readRecords(stream, format):
+        if isinstance(line, Exception):
+            yield lineNumber, line
+            continue
+        if not line.strip():
+            continue
+        if format == "csv" and header is None:
+            header = next(csv.reader([line]))
+            continue
+        try:
+            yield lineNumber, (parseCSV if format == "csv" else parseNDJSON)(line, header)
+        except ValueError as exc:
+            yield lineNumber, exc
+
+
+class ImportProgress:
+    def __init__(self):
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+
+    def fail(self, line, error):
+        self.failed += 1
+        # Only the first MAX_IMPORT_ERRORS are reported so memory stays flat on bad uploads
+        if len(self.errors) < MAX_IMPORT_ERRORS:
+            self.errors.append({"line": line, "error": error})
+
+    def summary(self):
+        return ImportSummary(inserted=self.inserted, failed=self.failed, errors=self.errors)
+
+
+async def insertChunk(collection, chunk, progress):
+    lines = [line for line, _ in chunk]
+    try:
+        progress.inserted += len((await collection.insert_many([document for _, document in chunk], ordered=False)).inserted_ids)
+    except BulkWriteError as exc:
+        progress.inserted += exc.details["nInserted"]
+        for error in exc.details["writeErrors"]:
+            progress.fail(lines[error["index"]], error["errmsg"])
+    chunk.clear()
+
+
+async def importRows(collection, stream, format, build):
+    """Validate streamed rows against UpdateCustomer and write them in unordered insert_many chunks."""
+    progress = ImportProgress()
+    chunk = []
+    async for line, row in readRows(stream, format):
+        if isinstance(row, Exception):
+            progress.fail(line, str(row))
+            continue
+        try:
+            chunk.append((line, build(UpdateCustomer(**row))))
+        except ValidationError as exc:
+            progress.fail(line, "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in exc.errors()))
+            continue
+
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            await insertChunk(collection, chunk, progress)
+
+    if chunk:
+        await insertChunk(collection, chunk, progress)
+    return progress.summary()
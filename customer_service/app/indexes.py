@@ -0,0 +1,46 @@
+from pymongo import IndexModel, ASCENDING
+from bson import Binary
+from uuid import uuid4
+from datetime import datetime
+
+INDEXES = {
+    "customers": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id"),
+        IndexModel([("createdAt", ASCENDING), ("id", ASCENDING)], name="createdAt_id")
+    ]
+}
+
+KEYSET_SORT = [("createdAt", ASCENDING), ("id", ASCENDING)]
+
+# (route, collection, filter, sort) for every indexed query the routes issue.
+# Unpaged getAll is a full scan by design and is not listed.
+QUERY_SHAPES = [
+    ("update/delete/get/validate", "customers", {"id": Binary.from_uuid(uuid4())}, None),
+    ("validate many", "customers", {"id": {"$in": [Binary.from_uuid(uuid4()), Binary.from_uuid(uuid4())]}}, None),
+    ("customer filter sync", "customers", {"createdAt": {"$gte": datetime(2024, 1, 1)}}, None),
+    ("getAll paged", "customers", {}, KEYSET_SORT)
+]
+
+
+def planStages(plan):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from planStages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from planStages(value)
+
+
+async def findCollectionScans(mongodb, shapes=QUERY_SHAPES):
+    """Run explain() for every route query and return the routes whose winning plan is a COLLSCAN."""
+    scans = []
+    for route, collection, query, sort in shapes:
+        cursor = mongodb.collections[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        if "COLLSCAN" in planStages(explain["queryPlanner"]["winningPlan"]):
+            scans.append(route)
+    return scans
@@ -0,0 +1,146 @@
+from datetime import datetime, timedelta
+from uuid import UUID
+import hashlib
+import asyncio
+import math
+import os
+
+from app.MongoDB import mongodb
+from .Metrics import Counter, registry
+
+# An in-memory Bloom filter of customer ids answers "does not exist" without a query
+CUSTOMER_FILTER = os.getenv('customer_filter', 'false').lower() in ('1', 'true', 'yes')
+FILTER_CAPACITY = int(os.getenv('customer_filter_capacity', 1000000))
+FILTER_ERROR_RATE = float(os.getenv('customer_filter_error_rate', 0.01))
+# Picks up customers created by other instances; until then a miss for them is checked against the recent creates
+FILTER_SYNC_INTERVAL = float(os.getenv('customer_filter_sync_interval', 5))
+# Deleted customers only leave the filter when it is rebuilt
+FILTER_REBUILD_INTERVAL = float(os.getenv('customer_filter_rebuild_interval', 3600))
+FILTER_SYNC_OVERLAP = timedelta(seconds=float(os.getenv('customer_filter_sync_overlap', 2)))
+WARM_BATCH_SIZE = 10000
+
+FILTER_CHECKS = Counter("customer_filter_checks_total", "Customer existence checks by the Bloom filter's answer", ("result",), registry=registry)
+
+
+class BloomFilter:
+    """A fixed-size Bloom filter over UUIDs, sized for `capacity` ids at `errorRate` false positives."""
+    def __init__(self, capacity=FILTER_CAPACITY, errorRate=FILTER_ERROR_RATE):
+        self.size = max(8, math.ceil(-capacity * math.log(errorRate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, id: UUID):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(id.bytes, digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, id: UUID):
+        for position in self.positions(id):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, id: UUID):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(id))
+
+
+class CustomerFilter:
+    """Keeps a BloomFilter of every customer id, warmed from Mongo at startup.
+
+    A hit still goes to Mongo, so false positives and deleted customers only
+    cost a query. A miss rules out every customer but those created since the
+    last sync, which other instances may have made; `unsynced()` narrows the
+    check of a miss to them. Creates and imports add their ids directly, a
+    sync pulls the ones other instances created, and a periodic rebuild drops
+    the deleted ones. Until the first warm-up finishes every check goes to Mongo.
+    """
+    def __init__(self, collection, capacity=FILTER_CAPACITY, errorRate=FILTER_ERROR_RATE,
+                 syncInterval=FILTER_SYNC_INTERVAL, rebuildInterval=FILTER_REBUILD_INTERVAL):
+        self.collection = collection
+        self.capacity = capacity
+        self.errorRate = errorRate
+        self.syncInterval = syncInterval
+        self.rebuildInterval = rebuildInterval
+        self.bloom = None
+        self.syncedAt = None
+        self.__pending = []
+        self.__task = None
+
+    def start(self):
+        if self.__task is None:
+            self.__task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+
+    def add(self, id: UUID):
+        if self.__task is None:
+            return # Disabled
+        if self.bloom is not None:
+            self.bloom.add(id)
+        # Also kept for the filter being built, so a create during a rebuild is not lost
+        self.__pending.append(id)
+
+    def mightExist(self, id: UUID):
+        if self.bloom is None:
+            return True
+        exists = id in self.bloom
+        FILTER_CHECKS.labels("maybe" if exists else "absent").inc()
+        return exists
+
+    def unsynced(self):
+        """The condition a missed id still has to be checked with: created since the last sync, with the same overlap."""
+        return {"createdAt": {"$gte": self.syncedAt - FILTER_SYNC_OVERLAP}}
+
+    async def addFrom(self, bloom, query):
+        ids = self.collection.find(query, {"_id": 0, "id": 1}).batch_size(WARM_BATCH_SIZE)
+        async for document in ids:
+            bloom.add(UUID(bytes=document["id"]))
+
+    async def warm(self):
+        """Build a fresh filter from every customer id and swap it in."""
+        started = datetime.utcnow()
+        self.__pending = []
+        bloom = BloomFilter(self.capacity, self.errorRate)
+        await self.addFrom(bloom, {})
+        for id in self.__pending:
+            bloom.add(id)
+        self.bloom, self.syncedAt, self.__pending = bloom, started, []
+
+    async def sync(self):
+        """Add the customers created since the last sync, with some overlap for clock skew between instances."""
+        started = datetime.utcnow()
+        await self.addFrom(self.bloom, {"createdAt": {"$gte": self.syncedAt - FILTER_SYNC_OVERLAP}})
+        self.syncedAt = started
+        self.__pending = []
+
+    async def run(self):
+        rebuiltAt = None
+        while True:
+            try:
+                if rebuiltAt is None or (datetime.utcnow() - rebuiltAt).total_seconds() >= self.rebuildInterval:
+                    await self.warm()
+                    rebuiltAt = datetime.utcnow()
+                else:
+                    await self.sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                print(f"Customer filter error: {exc}")
+            await asyncio.sleep(self.syncInterval)
+
+    def stats(self):
+        if self.bloom is None:
+            return {"ready": False}
+        return {"ready": True, "ids": self.bloom.count, "bits": self.bloom.size, "hashes": self.bloom.hashes,
+                "syncedAt": self.syncedAt.isoformat()}
+
+
+customerFilter = CustomerFilter(mongodb.collections["customers"])
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, EmailStr
-from typing import Optional
+from typing import Optional, List
 from uuid import UUID
 from datetime import datetime
 
@@ -17,7 +17,20 @@ class Customer(BaseModel):
     createdAt: datetime
     updatedAt: datetime
 
+class CustomerPage(BaseModel):
+    items: List[Customer]
+    nextCursor: Optional[str] = None
+
 class UpdateCustomer(BaseModel):
     name: str
     email: EmailStr
-    address: Address
\ No newline at end of file
+    address: Address
+
+class ImportRowError(BaseModel):
+    line: int
+    error: str
+
+class ImportSummary(BaseModel):
+    inserted: int
+    failed: int
+    errors: List[ImportRowError]
\ No newline at end of file
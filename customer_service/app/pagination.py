@@ -0,0 +1,79 @@
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse, Response
+from bson import Binary
+from uuid import UUID
+from datetime import datetime
+import base64
+import json
+import os
+
+from .indexes import KEYSET_SORT
+from .encoding import FAST_RESPONSES, dumps, projection
+
+MAX_PAGE_SIZE = int(os.getenv('max_page_size', 1000))
+STREAM_BATCH_SIZE = int(os.getenv('stream_batch_size', 500))
+
+
+def encodeCursor(document):
+    id = document["id"]
+    position = {
+        "createdAt": document["createdAt"].isoformat(),
+        "id": str(id if isinstance(id, UUID) else UUID(bytes=id))
+    }
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decodeCursor(cursor):
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(position["createdAt"]), Binary.from_uuid(UUID(position["id"]))
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def afterCursor(query, cursor):
+    """Keyset condition on (createdAt, id): everything strictly after the cursor position."""
+    if cursor is None:
+        return query
+
+    createdAt, id = decodeCursor(cursor)
+    after = {"$or": [
+        {"createdAt": {"$gt": createdAt}},
+        {"createdAt": createdAt, "id": {"$gt": id}}
+    ]}
+    return {"$and": [query, after]} if query else after
+
+
+async def streamDocuments(cursor, model, fast=False):
+    async for document in cursor:
+        yield dumps(document) + b"\n" if fast else model(**document).model_dump_json() + "\n"
+
+
+async def paginate(collection, query, model, limit=None, cursor=None, stream=False, fast=None):
+    """Serve a find() as a full list, a keyset page or an NDJSON stream.
+
+    In fast mode the documents are encoded to JSON as they come from Motor,
+    skipping the response_model validation; the projection keeps the output
+    identical.
+    """
+    fast = FAST_RESPONSES if fast is None else fast
+    fields = projection(model) if fast else {"_id": 0}
+
+    if stream:
+        documents = collection.find(afterCursor(query, cursor), fields).batch_size(STREAM_BATCH_SIZE)
+        if cursor is not None:
+            documents = documents.sort(KEYSET_SORT)
+        return StreamingResponse(streamDocuments(documents, model, fast), media_type="application/x-ndjson")
+
+    if limit is None and cursor is None:
+        documents = await collection.find(query, fields).to_list(length=None)
+        return Response(dumps(documents), media_type="application/json") if fast else documents
+
+    limit = limit or MAX_PAGE_SIZE
+    documents = await collection.find(afterCursor(query, cursor), fields).sort(KEYSET_SORT).limit(limit + 1).to_list(length=limit + 1)
+
+    page = {
+        "items": documents[:limit],
+        "nextCursor": encodeCursor(documents[limit - 1]) if len(documents) > limit else None
+    }
+    return Response(dumps(page), media_type="application/json") if fast else page
@@ -1,17 +1,32 @@
-from fastapi import APIRouter, HTTPException
-from typing import List
+from fastapi import APIRouter, HTTPException, Query, BackgroundTasks, Request, Body
+from typing import Annotated, Dict, List, Optional, Union
 from bson import Binary
 from uuid import UUID, uuid4
 from datetime import datetime
+import os
 
 from app.MongoDB import mongodb
-from .models import Customer, UpdateCustomer
+from .models import Customer, CustomerPage, UpdateCustomer, ImportSummary
+from .importer import importRows
+from .pagination import paginate, MAX_PAGE_SIZE
+from .OrderService import invalidateCustomerCache, queueOrderCascade
+from .membership import customerFilter
+
+# cascade also removes a deleted customer's orders, in a background job on order_service
+DELETE_MODE = os.getenv('customer_delete_mode', 'keep').lower()
+MAX_VALIDATE_SIZE = int(os.getenv('max_validate_size', 1000))
 
 router = APIRouter(prefix="/customer", tags=["Customer"])
 
 
-@router.post("/", response_model=UUID)
-async def create(customer: UpdateCustomer):
+IMPORT_FORMATS = {
+    "application/x-ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+    "text/csv": "csv"
+}
+
+
+def newCustomer(customer: UpdateCustomer):
     customer = customer.dict()
     customer = Customer(**customer |
             {
@@ -21,14 +36,52 @@ async def create(customer: UpdateCustomer):
             }
         )
 
+    customerFilter.add(customer.id)
     customer.id = Binary.from_uuid(customer.id) 
+    return customer
+
+
+@router.post("/", response_model=UUID)
+async def create(customer: UpdateCustomer):
+    customer = newCustomer(customer)
     
     await mongodb.collections["customers"].insert_one(customer.dict())
     return customer.id
 
 
+@router.post("/validate", response_model=Dict[UUID, bool])
+async def validateMany(customerIds: Annotated[List[UUID], Body(max_length=MAX_VALIDATE_SIZE)]):
+    """Which of the ids exist, in one query: an $in on the id index for the filter's hits, and the misses only among recent creates."""
+    result = {customerId: False for customerId in customerIds}
+    hits, misses = [], []
+    for customerId in result:
+        (hits if customerFilter.mightExist(customerId) else misses).append(Binary.from_uuid(customerId))
+
+    clauses = ([{"id": {"$in": hits}}] if hits else []) + ([{"id": {"$in": misses}} | customerFilter.unsynced()] if misses else [])
+    if clauses:
+        found = mongodb.collections["customers"].find(clauses[0] if len(clauses) == 1 else {"$or": clauses}, {"_id": 0, "id": 1})
+        async for customer in found:
+            result[UUID(bytes=customer["id"])] = True
+    return result
+
+
+@router.get("/filter/stats", response_model=dict)
+async def filterStats():
+    return customerFilter.stats()
+
+
+@router.post("/import", response_model=ImportSummary)
+async def importCustomers(request: Request):
+    format = IMPORT_FORMATS.get(request.headers.get("content-type", "").split(";")[0].strip())
+    if format is None:
+        raise HTTPException(status_code=415, detail="Expected an application/x-ndjson or text/csv body")
+
+    return await importRows(mongodb.collections["customers"], request.stream(), format, lambda customer: newCustomer(customer).dict())
+
+
 @router.put("/{customerId}", response_model=bool)
-async def update(customerId: UUID, customer: UpdateCustomer):
+async def update(customerId: UUID, customer: UpdateCustomer, background_tasks: BackgroundTasks):
+    background_tasks.add_task(invalidateCustomerCache, customerId)
     customerId = Binary.from_uuid(customerId)
 
     customer = customer.dict()
@@ -38,14 +91,19 @@ async def update(customerId: UUID, customer: UpdateCustomer):
 
 
 @router.delete("/{customerId}", response_model=bool)
-async def delete(customerId: UUID): #OTHER RELATİON LOGİC
-    customerId = Binary.from_uuid(customerId)
-    return (await mongodb.collections["customers"].delete_one({"id": customerId})).deleted_count > 0
+async def delete(customerId: UUID, background_tasks: BackgroundTasks):
+    background_tasks.add_task(invalidateCustomerCache, customerId)
 
+    deleted = (await mongodb.collections["customers"].delete_one({"id": Binary.from_uuid(customerId)})).deleted_count > 0
+    if deleted and DELETE_MODE == 'cascade':
+        # Only the job is written before responding; progress is at GET /order/cascade/{customerId}
+        await queueOrderCascade(customerId)
+    return deleted
 
-@router.get("/", response_model=List[Customer])
-async def getAll():
-    return await mongodb.collections["customers"].find({}, {"_id": 0}).to_list(length=None)
+
+@router.get("/", response_model=Union[List[Customer], CustomerPage])
+async def getAll(limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, stream: bool = False):
+    return await paginate(mongodb.collections["customers"], {}, Customer, limit, cursor, stream)
 
 
 @router.get("/{customerId}", response_model=Customer)
@@ -60,6 +118,9 @@ async def get(customerId: UUID):
 
 @router.get("/validate/{customerId}", response_model=bool)
 async def validate(customerId: UUID):
-    customerId = Binary.from_uuid(customerId)
+    query = {"id": Binary.from_uuid(customerId)}
+    if not customerFilter.mightExist(customerId):
+        # Another instance may have created it since the last sync; the (createdAt, id) index keeps that range short
+        query |= customerFilter.unsynced()
 
-    return (await mongodb.collections["customers"].find_one({"id": customerId}, {"_id": 0})) != None
\ No newline at end of file
+    return (await mongodb.collections["customers"].find_one(query, {"_id": 0, "id": 1})) != None
\ No newline at end of file
@@ -1,10 +1,27 @@
 import uvicorn
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from app.routes import router
+from app.MongoDB import mongodb
+from app import OrderService
+from app.membership import CUSTOMER_FILTER, customerFilter
+from app.Metrics import MetricsMiddleware, metrics
 
-app = FastAPI()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await mongodb.ensureIndexes()
+    if CUSTOMER_FILTER:
+        customerFilter.start() # Warms in the background; checks go to Mongo until it is ready
+    yield
+    await customerFilter.stop()
+    await OrderService.client.aclose() # Looked up at shutdown; the gateway's monolith mode swaps it
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(MetricsMiddleware)
+app.add_route("/metrics", metrics, include_in_schema=False)
 app.include_router(router) 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8001) 
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8001) 
@@ -5,8 +5,17 @@ from unittest.mock import MagicMock
 from unittest.mock import patch, AsyncMock
 from bson import Binary
 from uuid import uuid4, UUID
+import asyncio
+import json
+import os
 
 from main import app
+from app.MongoDB import MongoDB
+from app.indexes import INDEXES, findCollectionScans
+from app.membership import BloomFilter, CustomerFilter, FILTER_SYNC_OVERLAP
+from app.importer import readLines
+from app.OrderService import queueOrderCascade
+from pymongo.errors import DuplicateKeyError
 
 #Test client
 client = TestClient(app)
@@ -77,6 +86,27 @@ def test_update_customer(mock_mongodb):
     assert updated_data["name"] == "Jane Doe"
     assert updated_data["email"] == "janedoe@example.com"
     assert updated_data["address"]["addressLine"] == "456 Elm St"
+
+# Test updating a customer drops the cached address in order_service
+@patch("app.routes.invalidateCustomerCache")
+def test_update_customer_invalidates_order_cache(mock_invalidate, mock_mongodb):
+    customer_id = uuid4()
+
+    mock_mongodb["customers"].update_one = AsyncMock(return_value=AsyncMock(matched_count=1))
+
+    response = client.put(f"/customer/{customer_id}", json={
+        "name": "Jane Doe",
+        "email": "janedoe@example.com",
+        "address": {
+            "addressLine": "456 Elm St",
+            "city": "Gotham",
+            "country": "Wonderland",
+            "cityCode": 67890
+        }
+    })
+
+    assert response.status_code == 200
+    mock_invalidate.assert_called_once_with(customer_id)
 ##########################################
 
 ##################DELETE##################
@@ -92,6 +122,43 @@ def test_delete_customer(mock_mongodb):
     assert response.json() is True
 
     mock_mongodb["customers"].delete_one.assert_called_once_with({"id": Binary.from_uuid(customer_id)})
+
+# Test cascade mode queues the removal of the customer's orders before responding
+@patch("app.routes.queueOrderCascade", new_callable=AsyncMock)
+def test_delete_customer_cascade(mock_cascade, mock_mongodb):
+    customer_id = uuid4()
+    mock_mongodb["customers"].delete_one = AsyncMock(return_value=MagicMock(deleted_count=1))
+
+    with patch("app.routes.DELETE_MODE", "cascade"):
+        response = client.delete(f"/customer/{customer_id}")
+
+        assert response.json() is True
+        mock_cascade.assert_called_once_with(customer_id)
+
+        # Nothing to cascade for a customer that did not exist
+        mock_cascade.reset_mock()
+        mock_mongodb["customers"].delete_one = AsyncMock(return_value=MagicMock(deleted_count=0))
+        response = client.delete(f"/customer/{customer_id}")
+
+    assert response.json() is False
+    assert not mock_cascade.called
+
+# Test the cascade job is upserted straight into the shared job collection, and a running job is left alone
+def test_queue_order_cascade(mock_mongodb):
+    customer_id = uuid4()
+    mock_mongodb["cascadeJobs"].update_one = AsyncMock()
+
+    asyncio.run(queueOrderCascade(customer_id))
+
+    query, update = mock_mongodb["cascadeJobs"].update_one.call_args.args
+    assert query == {"_id": Binary.from_uuid(customer_id), "status": {"$ne": "running"}}
+    assert update["$set"]["status"] == "queued"
+    assert update["$unset"] == {"mode": ""}
+    assert update["$setOnInsert"] == {"total": 0, "deleted": 0, "batches": 0}
+    assert mock_mongodb["cascadeJobs"].update_one.call_args.kwargs == {"upsert": True}
+
+    mock_mongodb["cascadeJobs"].update_one = AsyncMock(side_effect=DuplicateKeyError("running"))
+    asyncio.run(queueOrderCascade(customer_id))
 ##########################################
 
 ##################GETALL##################
@@ -233,7 +300,7 @@ def test_validate_customer_exists(mock_mongodb):
     assert response.json() is True
 
     mock_mongodb["customers"].find_one.assert_called_once_with(
-        {"id": Binary.from_uuid(customer_id)}, {"_id": 0}
+        {"id": Binary.from_uuid(customer_id)}, {"_id": 0, "id": 1}
     )
 
 # Test the customer validation route for a case where the customer does not exist
@@ -248,6 +315,297 @@ def test_validate_customer_not_exists(mock_mongodb):
     assert response.json() is False
 
     mock_mongodb["customers"].find_one.assert_called_once_with(
-        {"id": Binary.from_uuid(customer_id)}, {"_id": 0}
+        {"id": Binary.from_uuid(customer_id)}, {"_id": 0, "id": 1}
     )
-##########################################
\ No newline at end of file
+
+# Test batch validation answers every id from one $in query on ids only
+def test_validate_customers_batch(mock_mongodb):
+    existing, missing = uuid4(), uuid4()
+    mock_mongodb["customers"].find.return_value.__aiter__.return_value = [{"id": Binary.from_uuid(existing)}]
+
+    response = client.post("/customer/validate", json=[str(existing), str(missing)])
+
+    assert response.status_code == 200
+    assert response.json() == {str(existing): True, str(missing): False}
+    mock_mongodb["customers"].find.assert_called_once_with(
+        {"id": {"$in": [Binary.from_uuid(existing), Binary.from_uuid(missing)]}}, {"_id": 0, "id": 1}
+    )
+
+# Test ids the Bloom filter rules out are only looked up among the customers created since its last sync
+def test_validate_customers_filtered(mock_mongodb):
+    known, unknown = uuid4(), uuid4()
+    bloom = BloomFilter(capacity=1000, errorRate=0.001)
+    bloom.add(known)
+    syncedAt = datetime(2024, 5, 1, 10)
+    recent = {"createdAt": {"$gte": syncedAt - FILTER_SYNC_OVERLAP}}
+    mock_mongodb["customers"].find.return_value.__aiter__.return_value = [{"id": Binary.from_uuid(known)}]
+    mock_mongodb["customers"].find_one = AsyncMock(return_value=None)
+
+    with patch("app.routes.customerFilter.bloom", bloom), patch("app.routes.customerFilter.syncedAt", syncedAt):
+        response = client.post("/customer/validate", json=[str(known), str(unknown)])
+        single = client.get(f"/customer/validate/{unknown}")
+
+    assert response.json() == {str(known): True, str(unknown): False}
+    mock_mongodb["customers"].find.assert_called_once_with(
+        {"$or": [{"id": {"$in": [Binary.from_uuid(known)]}}, {"id": {"$in": [Binary.from_uuid(unknown)]}} | recent]}, {"_id": 0, "id": 1}
+    )
+    assert single.json() is False
+    mock_mongodb["customers"].find_one.assert_called_once_with({"id": Binary.from_uuid(unknown)} | recent, {"_id": 0, "id": 1})
+
+# Test a customer another instance created is found before this instance's filter has synced it
+def test_validate_customer_created_elsewhere(mock_mongodb):
+    creator, other = CustomerFilter(MagicMock()), CustomerFilter(MagicMock())
+    for customerFilter in (creator, other):
+        customerFilter._CustomerFilter__task = object() # Enabled, without starting the loop
+        customerFilter.bloom, customerFilter.syncedAt = BloomFilter(capacity=1000, errorRate=0.001), datetime.utcnow()
+    created = uuid4()
+    creator.add(created)
+    mock_mongodb["customers"].find_one = AsyncMock(return_value={"id": Binary.from_uuid(created)})
+    mock_mongodb["customers"].find.return_value.__aiter__.return_value = [{"id": Binary.from_uuid(created)}]
+
+    assert creator.mightExist(created) and not other.mightExist(created)
+    with patch("app.routes.customerFilter", other):
+        assert client.get(f"/customer/validate/{created}").json() is True
+        assert client.post("/customer/validate", json=[str(created)]).json() == {str(created): True}
+
+    assert mock_mongodb["customers"].find_one.call_args.args[0] == {"id": Binary.from_uuid(created)} | other.unsynced()
+
+# Test the filter warms from every id, keeps creates made meanwhile and has no false negatives
+def test_customer_filter_warm():
+    ids = [uuid4() for _ in range(500)]
+    collection = MagicMock()
+    customerFilter = CustomerFilter(collection, capacity=1000, errorRate=0.01)
+    customerFilter._CustomerFilter__task = object() # Enabled, without starting the loop
+    created = uuid4()
+
+    async def documents():
+        customerFilter.add(created)
+        for id in ids:
+            yield {"id": Binary.from_uuid(id)}
+    collection.find.return_value.batch_size.return_value = documents()
+
+    asyncio.run(customerFilter.warm())
+
+    collection.find.assert_called_once_with({}, {"_id": 0, "id": 1})
+    assert all(customerFilter.mightExist(id) for id in ids + [created])
+    assert sum(customerFilter.mightExist(uuid4()) for _ in range(1000)) < 50
+##########################################
+
+################PAGINATION################
+# Test keyset pagination of customers returns a page and a cursor
+def test_get_all_customers_paged(mock_mongodb):
+    customers = [{
+        "id": Binary.from_uuid(uuid4()),
+        "name": "John Doe",
+        "email": "johndoe@example.com",
+        "address": {
+            "addressLine": "123 Main St",
+            "city": "Metropolis",
+            "country": "Wonderland",
+            "cityCode": 12345
+        },
+        "createdAt": datetime.utcnow(),
+        "updatedAt": datetime.utcnow()
+    } for _ in range(2)]
+
+    mock_find = MagicMock()
+    mock_find.sort.return_value.limit.return_value.to_list = AsyncMock(return_value=customers)
+    mock_mongodb["customers"].find.return_value = mock_find
+
+    response = client.get("/customer/?limit=1")
+
+    assert response.status_code == 200
+
+    response_data = response.json()
+    assert len(response_data["items"]) == 1
+    assert response_data["items"][0]["id"] == str(UUID(bytes=customers[0]["id"]))
+    assert response_data["nextCursor"]
+
+    mock_find.sort.assert_called_once_with([("createdAt", 1), ("id", 1)])
+    mock_find.sort.return_value.limit.assert_called_once_with(2)
+
+# Test the limit is bounded by the maximum page size
+def test_get_all_customers_page_size_limit(mock_mongodb):
+    response = client.get("/customer/?limit=100000")
+
+    assert response.status_code == 422
+##########################################
+
+
+##############FASTRESPONSES###############
+# Test the fast encoder produces the same list as the response_model path
+def test_get_all_customers_fast_matches_default(mock_mongodb):
+    customers = [{
+        "id": Binary.from_uuid(uuid4()),
+        "name": "John Doe",
+        "email": "johndoe@example.com",
+        "address": {
+            "addressLine": "123 Main St",
+            "city": "Metropolis",
+            "country": "Wonderland",
+            "cityCode": 12345
+        },
+        "createdAt": datetime.utcnow(),
+        "updatedAt": datetime.utcnow()
+    } for _ in range(2)]
+    mock_mongodb["customers"].find.return_value.to_list = AsyncMock(side_effect=lambda length: [dict(customer) for customer in customers])
+
+    expected = client.get("/customer/").json()
+    with patch("app.pagination.FAST_RESPONSES", True):
+        response = client.get("/customer/")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    assert response.json() == expected
+##########################################
+
+
+##################INDEXES#################
+# Test the explain check flags queries whose winning plan is a collection scan
+def test_find_collection_scans_flags_collscan():
+    mock_db = MagicMock()
+    ixscan = {"queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}}}
+    collscan = {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}}
+    mock_db.collections = MagicMock()
+    mock_db.collections.__getitem__.return_value.find.return_value.explain = AsyncMock(side_effect=[ixscan, collscan])
+
+    shapes = [("indexed", "c", {"id": 1}, None), ("scanned", "c", {"other": 1}, None)]
+
+    assert asyncio.run(findCollectionScans(mock_db, shapes)) == ["scanned"]
+
+# Test every route query is index-backed against a real database
+@pytest.mark.skipif(not os.getenv("conn_str"), reason="needs a MongoDB connection string in conn_str")
+def test_route_queries_use_indexes():
+    async def check():
+        db = MongoDB(os.getenv("conn_str"), [["Tesodev", "customers"]], INDEXES)
+        await db.ensureIndexes()
+        return await findCollectionScans(db)
+
+    assert asyncio.run(check()) == []
+##########################################
+
+
+
+##################IMPORT##################
+# Test NDJSON import validates rows, writes them in chunks and reports per-line errors
+def test_import_customers_ndjson(mock_mongodb):
+    mock_mongodb["customers"].insert_many = AsyncMock(side_effect=lambda documents, ordered: MagicMock(inserted_ids=[None] * len(documents)))
+
+    valid = {
+        "name": "John Doe",
+        "email": "johndoe@example.com",
+        "address": {"addressLine": "123 Main St", "city": "Metropolis", "country": "Wonderland", "cityCode": 12345}
+    }
+    body = "\n".join([
+        json.dumps(valid),
+        json.dumps(valid | {"email": "not-an-email"}),
+        "{broken",
+        "",
+        json.dumps(valid | {"name": "Jane Doe"})
+    ])
+
+    response = client.post("/customer/import", content=body, headers={"Content-Type": "application/x-ndjson"})
+
+    assert response.status_code == 200
+
+    summary = response.json()
+    assert summary["inserted"] == 2
+    assert summary["failed"] == 2
+    assert [error["line"] for error in summary["errors"]] == [2, 3]
+    assert "email" in summary["errors"][0]["error"]
+
+    documents = mock_mongodb["customers"].insert_many.call_args[0][0]
+    assert [document["name"] for document in documents] == ["John Doe", "Jane Doe"]
+    assert all(isinstance(document["id"], Binary) for document in documents)
+    assert mock_mongodb["customers"].insert_many.call_args[1] == {"ordered": False}
+
+# Test CSV import maps the flat address columns and flushes a chunk per IMPORT_CHUNK_SIZE rows
+def test_import_customers_csv(mock_mongodb):
+    mock_mongodb["customers"].insert_many = AsyncMock(side_effect=lambda documents, ordered: MagicMock(inserted_ids=[None] * len(documents)))
+
+    rows = ["name,email,addressLine,city,country,cityCode"]
+    rows += [f"Customer {i},customer{i}@example.com,,Metropolis,Wonderland,12345" for i in range(5)]
+
+    with patch("app.importer.IMPORT_CHUNK_SIZE", 2):
+        response = client.post("/customer/import", content="\r\n".join(rows), headers={"Content-Type": "text/csv"})
+
+    assert response.status_code == 200
+    assert response.json() == {"inserted": 5, "failed": 0, "errors": []}
+
+    assert mock_mongodb["customers"].insert_many.call_count == 3
+    document = mock_mongodb["customers"].insert_many.call_args_list[0][0][0][0]
+    assert document["address"] == {"addressLine": None, "city": "Metropolis", "country": "Wonderland", "cityCode": 12345}
+
+# Test a row with invalid UTF-8 is reported as a row error and the rows around it are still imported
+def test_import_customers_invalid_utf8(mock_mongodb):
+    mock_mongodb["customers"].insert_many = AsyncMock(side_effect=lambda documents, ordered: MagicMock(inserted_ids=[None] * len(documents)))
+
+    rows = [
+        b"name,email,addressLine,city,country,cityCode",
+        b"Customer 1,customer1@example.com,,Metropolis,Wonderland,12345",
+        b"Customer \xff\xfe,customer2@example.com,,Metropolis,Wonderland,12345",
+        "M\u00fcller,customer3@example.com,,Metropolis,Wonderland,12345".encode()
+    ]
+
+    response = client.post("/customer/import", content=b"\n".join(rows), headers={"Content-Type": "text/csv"})
+
+    assert response.status_code == 200
+    summary = response.json()
+    assert summary["inserted"] == 2
+    assert summary["failed"] == 1
+    assert summary["errors"][0]["line"] == 3
+    assert "UTF-8" in summary["errors"][0]["error"]
+
+# Test a line over the length cap is rejected without buffering it, even when it never ends in a newline
+def test_import_read_lines_caps_line_length():
+    async def chunks(*parts):
+        for part in parts:
+            yield part
+
+    async def read(*parts):
+        return [line if isinstance(line, str) else str(line) async for line in readLines(chunks(*parts), maxLength=8)]
+
+    assert asyncio.run(read(b"short\n", b"x" * 20, b"x" * 20, b"tail\nnext\n")) == ["short", "Line is longer than 8 bytes", "next"]
+    assert asyncio.run(read(b"y" * 100)) == ["Line is longer than 8 bytes"]
+
+# Test a quoted CSV field holding a newline stays one row, numbered by its first line
+def test_import_customers_csv_multiline_field(mock_mongodb):
+    mock_mongodb["customers"].insert_many = AsyncMock(side_effect=lambda documents, ordered: MagicMock(inserted_ids=[None] * len(documents)))
+
+    body = "\n".join([
+        "name,email,addressLine,city,country,cityCode",
+        'Customer 1,customer1@example.com,"Flat 2',
+        '12 ""Main"" St",Metropolis,Wonderland,12345',
+        "Customer 2,customer2@example.com,,Metropolis,Wonderland,not-a-code"
+    ])
+
+    response = client.post("/customer/import", content=body, headers={"Content-Type": "text/csv"})
+
+    assert response.status_code == 200
+    summary = response.json()
+    assert summary["inserted"] == 1
+    assert [error["line"] for error in summary["errors"]] == [4]
+    document = mock_mongodb["customers"].insert_many.call_args[0][0][0]
+    assert document["address"]["addressLine"] == 'Flat 2\n12 "Main" St'
+
+# Test unsupported upload types are rejected
+def test_import_customers_unsupported_type(mock_mongodb):
+    response = client.post("/customer/import", json=[])
+
+    assert response.status_code == 415
+##########################################
+
+##################METRICS#################
+# Test /metrics exposes per-route latency in the Prometheus text format, labelled by route template
+def test_metrics_endpoint(mock_mongodb):
+    mock_mongodb["customers"].find_one = AsyncMock(return_value=None)
+    client.get(f"/customer/{uuid4()}")
+
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'http_requests_total{method="GET",route="/customer/{customerId}",status="404"}' in response.text
+    assert 'http_request_duration_seconds_bucket{le="+Inf",method="GET",route="/customer/{customerId}"}' in response.text
+    assert "http_requests_in_flight" in response.text
+##########################################
@@ -0,0 +1,111 @@
+from contextlib import AsyncExitStack
+import importlib.util
+import httpx
+import sys
+import os
+
+from Upstream import Upstream, Instance
+import Metrics
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Prefixes served by importing the service into the gateway process; the others are proxied over HTTP
+IN_PROCESS = [prefix.strip() for prefix in os.getenv('GATEWAY_IN_PROCESS', '').split(',') if prefix.strip()]
+SERVICE_DIRS = {
+    "order": os.getenv('ORDER_SERVICE_DIR', os.path.join(ROOT, "order_service")),
+    "customer": os.getenv('CUSTOMER_SERVICE_DIR', os.path.join(ROOT, "customer_service"))
+}
+
+
+def isServicePackage(name):
+    return name == "app" or name.startswith("app.")
+
+
+def loadService(name, directory):
+    """Import a service's main module and return its FastAPI app.
+
+    Every service keeps its code in a package called `app`, so each is imported
+    with the others' `app` modules out of sys.modules, and its own are moved
+    under `<name>_service.` afterwards. The loaded modules keep their references
+    to each other, so the services never see each other's code.
+    """
+    others = {module: sys.modules.pop(module) for module in list(sys.modules) if isServicePackage(module)}
+    sys.path.insert(0, directory)
+    try:
+        spec = importlib.util.spec_from_file_location(f"{name}_service_main", os.path.join(directory, "main.py"))
+        main = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(main)
+    finally:
+        sys.path.remove(directory)
+        for module in [module for module in sys.modules if isServicePackage(module)]:
+            sys.modules[f"{name}_service.{module}"] = sys.modules.pop(module)
+        sys.modules.update(others)
+    return main.app
+
+
+class InProcessUpstream(Upstream):
+    """An Upstream whose requests go straight to the service's ASGI app in this process.
+
+    There is no socket, connection pool or second HTTP parse; the gateway's
+    cache, coalescing and metrics work as they do for a remote upstream. The
+    service's own lifespan (indexes, publisher, background workers) runs
+    inside the gateway's.
+    """
+    def __init__(self, name, app):
+        super().__init__(name, [])
+        self.app = app
+        self.instances = [Instance(name, "http://in-process", self.limits, False, transport=httpx.ASGITransport(app=app))]
+        self.__stack = None
+
+    async def start(self):
+        self.__stack = AsyncExitStack()
+        await self.__stack.enter_async_context(self.app.router.lifespan_context(self.app))
+        await super().start()
+
+    async def stop(self):
+        await super().stop()
+        if self.__stack is not None:
+            await self.__stack.aclose()
+            self.__stack = None
+
+    def stats(self):
+        return super().stats() | {"inProcess": True}
+
+
+def connectServices(upstreams):
+    """Send the in-process customer service's calls to order_service to the in-process order app.
+
+    Left alone they would go to ORDER_SERVICE_URL, which in monolith mode does
+    not name the order service that actually serves the orders, so its cached
+    customer addresses would never be dropped.
+    """
+    if not all(isinstance(upstreams.get(name), InProcessUpstream) for name in ("order", "customer")):
+        return
+    orderService = sys.modules["customer_service.app.OrderService"]
+    orderService.client = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=upstreams["order"].app), base_url="http://in-process", timeout=orderService.client.timeout
+    )
+    orderService.ORDER_SERVICE_URLS = ["http://in-process"]
+
+
+def inProcessUpstreams(urls):
+    """An InProcessUpstream for every prefix in GATEWAY_IN_PROCESS.
+
+    A service that cannot be imported here, for example because its
+    dependencies are not installed, is proxied over HTTP instead when it has a
+    URL configured. When both services run here, they call each other here too,
+    and the gateway's /metrics serves their metrics as well.
+    """
+    upstreams = {}
+    for name in IN_PROCESS:
+        try:
+            upstreams[name] = InProcessUpstream(name, loadService(name, SERVICE_DIRS[name]))
+        except Exception as exc:
+            if not urls.get(name):
+                raise
+            print(f"Could not load the {name} service in process, proxying to {urls[name]}: {exc!r}")
+            continue
+        Metrics.serviceRegistries[name] = sys.modules[f"{name}_service.app.Metrics"].registry
+    connectServices(upstreams)
+    return upstreams
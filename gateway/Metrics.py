@@ -0,0 +1,68 @@
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, disable_created_metrics, CONTENT_TYPE_LATEST, REGISTRY
+from prometheus_client.metrics_core import Metric
+from starlette.responses import Response
+import time
+
+# Seconds; covers a response cache hit or in-process call up to a proxied request waiting out its route timeout
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+disable_created_metrics()
+
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests served", ("method", "route", "status"))
+HTTP_DURATION = Histogram("http_request_duration_seconds", "HTTP request latency", ("method", "route"), buckets=DEFAULT_BUCKETS)
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests currently being served")
+
+# Registries of the services running inside the gateway in monolith mode, by name
+serviceRegistries = {}
+
+
+class MetricsMiddleware:
+    """Plain ASGI middleware, labelled by the matched route template to keep cardinality bounded."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+        async def sendWithStatus(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, sendWithStatus)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            HTTP_DURATION.labels(scope["method"], path).observe(time.perf_counter() - started)
+            HTTP_REQUESTS.labels(scope["method"], path, str(status)).inc()
+
+
+class MonolithRegistry:
+    """The gateway's metrics and those of its in-process services as one registry.
+
+    The services use the same metric names as the gateway, so families are
+    merged by name and every sample gets a `service` label, "gateway" for
+    the gateway's own.
+    """
+    def __init__(self, registries):
+        self.registries = registries
+
+    def collect(self):
+        families = {}
+        for service, registry in self.registries.items():
+            for family in registry.collect():
+                merged = families.setdefault(family.name, Metric(family.name, family.documentation, family.type, family.unit))
+                merged.samples.extend(sample._replace(labels={"service": service} | sample.labels) for sample in family.samples)
+        return list(families.values())
+
+
+async def metrics(request):
+    registry = MonolithRegistry({"gateway": REGISTRY} | serviceRegistries) if serviceRegistries else REGISTRY
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
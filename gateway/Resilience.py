@@ -0,0 +1,110 @@
+from collections import deque
+import time
+import os
+
+
+# Outcomes of the last BREAKER_WINDOW calls decide whether an instance is taken out of rotation
+BREAKER_WINDOW = int(os.getenv('UPSTREAM_BREAKER_WINDOW', 20))
+BREAKER_MIN_CALLS = int(os.getenv('UPSTREAM_BREAKER_MIN_CALLS', 10))
+BREAKER_ERROR_RATE = float(os.getenv('UPSTREAM_BREAKER_ERROR_RATE', 0.5))
+# A call slower than this counts as slow; too many slow calls open the breaker like errors do
+BREAKER_SLOW_CALL = float(os.getenv('UPSTREAM_BREAKER_SLOW_CALL', 5))
+BREAKER_SLOW_RATE = float(os.getenv('UPSTREAM_BREAKER_SLOW_RATE', 0.8))
+BREAKER_OPEN_SECONDS = float(os.getenv('UPSTREAM_BREAKER_OPEN_SECONDS', 10))
+
+# Retries and hedges may add RETRY_BUDGET of the request volume, plus a floor per second for quiet periods
+RETRY_BUDGET = float(os.getenv('UPSTREAM_RETRY_BUDGET', 0.2))
+RETRY_MIN_PER_SECOND = int(os.getenv('UPSTREAM_RETRY_MIN_PER_SECOND', 5))
+RETRY_BUDGET_CAP = 100
+
+
+class CircuitBreaker:
+    """Closed, open or half-open, from the error and slow-call rates over a window of recent calls.
+
+    An open breaker rejects calls for `openSeconds`, then lets a single probe
+    through; the probe closes it again or reopens it.
+    """
+    def __init__(self, window=BREAKER_WINDOW, minCalls=BREAKER_MIN_CALLS, errorRate=BREAKER_ERROR_RATE,
+                 slowCall=BREAKER_SLOW_CALL, slowRate=BREAKER_SLOW_RATE, openSeconds=BREAKER_OPEN_SECONDS, clock=time.monotonic):
+        self.minCalls = minCalls
+        self.errorRate = errorRate
+        self.slowCall = slowCall
+        self.slowRate = slowRate
+        self.openSeconds = openSeconds
+        self.clock = clock
+        self.outcomes = deque(maxlen=window)
+        self.state = "closed"
+        self.openedAt = None
+        self.probing = False
+        self.opened = 0
+
+    def available(self):
+        if self.state == "open" and self.clock() - self.openedAt >= self.openSeconds:
+            self.state, self.probing = "half-open", False
+        return self.state == "closed" or (self.state == "half-open" and not self.probing)
+
+    def acquire(self):
+        """Called for the instance a request was sent to; in half-open it takes the one probe."""
+        if self.state == "half-open":
+            self.probing = True
+
+    def record(self, failed, duration):
+        slow = duration >= self.slowCall
+        if self.state == "half-open":
+            self.open() if failed or slow else self.close()
+            return
+
+        self.outcomes.append((failed, slow))
+        if self.state == "closed" and len(self.outcomes) >= self.minCalls:
+            failures = sum(failed for failed, _ in self.outcomes)
+            slowCalls = sum(slow for _, slow in self.outcomes)
+            if failures >= self.errorRate * len(self.outcomes) or slowCalls >= self.slowRate * len(self.outcomes):
+                self.open()
+
+    def release(self):
+        # A probe that was cancelled, for example a losing hedge, gives its turn back
+        if self.state == "half-open":
+            self.probing = False
+
+    def open(self):
+        self.state, self.openedAt, self.probing = "open", self.clock(), False
+        self.outcomes.clear()
+        self.opened += 1
+
+    def close(self):
+        self.state, self.probing = "closed", False
+        self.outcomes.clear()
+
+
+class RetryBudget:
+    """Bounds retries and hedges so a struggling upstream is not sent a multiple of its traffic.
+
+    Every request deposits `ratio` of a token and every retry or hedge spends
+    a whole one; `minPerSecond` extra are allowed each second regardless.
+    """
+    def __init__(self, ratio=RETRY_BUDGET, minPerSecond=RETRY_MIN_PER_SECOND, cap=RETRY_BUDGET_CAP, clock=time.monotonic):
+        self.ratio = ratio
+        self.minPerSecond = minPerSecond
+        self.cap = cap
+        self.clock = clock
+        self.tokens = 0.0
+        self.second = None
+        self.free = 0
+        self.exhausted = 0
+
+    def deposit(self):
+        self.tokens = min(self.cap, self.tokens + self.ratio)
+
+    def withdraw(self):
+        second = int(self.clock())
+        if second != self.second:
+            self.second, self.free = second, self.minPerSecond
+
+        if self.free > 0:
+            self.free -= 1
+            return True
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.exhausted += 1
+        return False
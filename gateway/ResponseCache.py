@@ -0,0 +1,168 @@
+from collections import OrderedDict
+import hashlib
+import time
+import re
+import os
+
+from Metrics import Counter, Gauge
+
+
+# 0 disables the cache; ETags and 304s are still served
+CACHE_SIZE = int(os.getenv('GATEWAY_CACHE_SIZE', 0))
+CACHE_TTL = float(os.getenv('GATEWAY_CACHE_TTL', 30))
+CACHE_PATHS = [prefix.strip() for prefix in os.getenv('GATEWAY_CACHE_PATHS', '/customer/,/order/getByOrder/').split(',') if prefix.strip()]
+# "METHOD /prefix=/flushed/": writes that change resources their path does not name, like a customer delete cascading to its orders
+CACHE_FLUSHES = [
+    (rule.split(None, 1)[0].lower(), *(part.strip() for part in rule.split(None, 1)[1].rsplit('=', 1)))
+    for rule in os.getenv('GATEWAY_CACHE_FLUSHES', 'DELETE /customer/=/order/,POST /order/cascade/=/order/').split(',') if rule.strip()
+]
+
+RESOURCE_ID = re.compile(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+# Not replayed from the cache; the body is stored decoded-as-sent and the length is recomputed
+UNCACHED_HEADERS = {"content-length", "date", "server", "connection", "keep-alive", "transfer-encoding"}
+
+CACHE_LOOKUPS = Counter("gateway_cache_lookups_total", "Gateway response cache lookups", ("result",))
+CACHE_INVALIDATIONS = Counter("gateway_cache_invalidations_total", "Cached responses dropped by a write to the same resource")
+
+
+def etag(content):
+    return '"' + hashlib.blake2b(content, digest_size=16).hexdigest() + '"'
+
+
+def notModified(ifNoneMatch, tag):
+    if not ifNoneMatch:
+        return False
+    candidates = [candidate.strip().removeprefix("W/") for candidate in ifNoneMatch.split(",")]
+    return "*" in candidates or tag in candidates
+
+
+def resourceIds(path):
+    return {match.lower() for match in RESOURCE_ID.findall(path)}
+
+
+def servicePrefix(path):
+    return "/" + path.lstrip("/").split("/", 1)[0] + "/"
+
+
+class CachedResponse:
+    def __init__(self, content, statusCode, headers):
+        self.content = content
+        self.statusCode = statusCode
+        self.headers = {name: value for name, value in headers.items() if name.lower() not in UNCACHED_HEADERS}
+        self.etag = self.headers.setdefault("etag", etag(content))
+
+
+class ResponseCache:
+    """Size-bounded LRU of upstream GET responses whose entries also expire after `ttl` seconds.
+
+    Entries are keyed on method and path (with the query string) and indexed by
+    the resource ids in the path, so a PUT or DELETE of /order/{id} also drops
+    GET /order/getByOrder/{id}. Only paths under `prefixes` that name a
+    resource are cached; lists change on every create and are left alone.
+
+    A PUT or DELETE that names no resource, like PUT /order/changeStatus, may
+    change any of them and drops everything cached under its service. The
+    `flushes` rules do the same for writes that change another service's
+    resources.
+    """
+    def __init__(self, maxSize=CACHE_SIZE, ttl=CACHE_TTL, prefixes=CACHE_PATHS, flushes=CACHE_FLUSHES):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.prefixes = tuple(prefixes)
+        self.flushes = list(flushes)
+        self.__entries = OrderedDict()
+        self.__byResource = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # Bumped by every write, so a GET that raced one does not store what it read before it
+        self.version = 0
+
+    def key(self, method, path, query=""):
+        return f"{method.upper()} {path}?{query}" if query else f"{method.upper()} {path}"
+
+    def cacheable(self, path):
+        return self.maxSize > 0 and path.startswith(self.prefixes) and bool(RESOURCE_ID.search(path))
+
+    def get(self, key):
+        entry = self.__entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                self.__remove(key)
+            self.misses += 1
+            CACHE_LOOKUPS.labels("miss").inc()
+            return None
+
+        self.__entries.move_to_end(key)
+        self.hits += 1
+        CACHE_LOOKUPS.labels("hit").inc()
+        return entry[0]
+
+    def set(self, key, path, response, version=None):
+        if self.maxSize <= 0 or (version is not None and version != self.version):
+            return
+        self.__remove(key)
+        self.__entries[key] = (response, time.monotonic() + self.ttl, resourceIds(path), path)
+        for resource in self.__entries[key][2]:
+            self.__byResource.setdefault(resource, set()).add(key)
+        while len(self.__entries) > self.maxSize:
+            self.__remove(next(iter(self.__entries)))
+            self.evictions += 1
+
+    def invalidatedBy(self, method, path):
+        """Whether a write may change cached responses: PUT and DELETE always, other methods under a flush rule."""
+        method = method.lower()
+        return method in ("put", "delete") or any(method == rule and path.startswith(prefix) for rule, prefix, _ in self.flushes)
+
+    def invalidate(self, path, method="put"):
+        """Drop every cached response that names one of the resources in `path`, or that a flush covers."""
+        self.version += 1
+        resources = resourceIds(path)
+        keys = set()
+        for resource in resources:
+            keys |= self.__byResource.get(resource, set())
+
+        flushed = [flushed for rule, prefix, flushed in self.flushes if method.lower() == rule and path.startswith(prefix)]
+        if not resources:
+            flushed.append(servicePrefix(path))
+        if flushed:
+            keys |= {key for key, entry in self.__entries.items() if entry[3].startswith(tuple(flushed))}
+
+        for key in keys:
+            self.__remove(key)
+        self.invalidations += len(keys)
+        CACHE_INVALIDATIONS.inc(len(keys))
+        return len(keys)
+
+    def __remove(self, key):
+        entry = self.__entries.pop(key, None)
+        if entry is None:
+            return
+        for resource in entry[2]:
+            keys = self.__byResource.get(resource)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.__byResource[resource]
+
+    def clear(self):
+        self.__entries.clear()
+        self.__byResource.clear()
+
+    def stats(self):
+        return {
+            "size": len(self.__entries),
+            "maxSize": self.maxSize,
+            "ttl": self.ttl,
+            "prefixes": list(self.prefixes),
+            "flushes": [f"{method.upper()} {prefix}={flushed}" for method, prefix, flushed in self.flushes],
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
+
+
+responseCache = ResponseCache()
+Gauge("gateway_cache_entries", "Responses currently held by the gateway cache").set_function(lambda: responseCache.stats()["size"])
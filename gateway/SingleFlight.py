@@ -0,0 +1,46 @@
+import asyncio
+import os
+
+from Metrics import Counter
+
+
+# Path prefixes whose concurrent identical GETs share one upstream call; empty disables coalescing
+COALESCE_PATHS = [prefix.strip() for prefix in os.getenv('GATEWAY_COALESCE_PATHS', '/customer/,/order/').split(',') if prefix.strip()]
+
+COALESCED = Counter("gateway_coalesced_requests_total", "Requests answered by another request's in-flight upstream call", ("prefix",))
+
+
+class SingleFlight:
+    """Runs one call per key at a time; callers that arrive while it is running share its result."""
+    def __init__(self, prefixes=COALESCE_PATHS):
+        self.prefixes = tuple(prefixes)
+        self.__calls = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def prefix(self, path):
+        """The configured prefix `path` falls under, or None when it is not coalesced."""
+        return next((prefix for prefix in self.prefixes if path.startswith(prefix)), None)
+
+    async def do(self, key, function, prefix=""):
+        task = self.__calls.get(key)
+        if task is None:
+            # A task of its own, so a caller that disconnects does not cancel the call for the others
+            task = self.__calls[key] = asyncio.ensure_future(function())
+            task.add_done_callback(lambda _: self.__calls.pop(key, None))
+            self.calls += 1
+        else:
+            self.coalesced += 1
+            COALESCED.labels(prefix).inc()
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            "prefixes": list(self.prefixes),
+            "inFlight": len(self.__calls),
+            "calls": self.calls,
+            "coalesced": self.coalesced
+        }
+
+
+singleFlight = SingleFlight()
@@ -0,0 +1,285 @@
+import asyncio
+import random
+import httpx
+import time
+import os
+
+from Metrics import Histogram, Gauge, Counter, DEFAULT_BUCKETS
+from Resilience import CircuitBreaker, RetryBudget
+
+
+MAX_CONNECTIONS = int(os.getenv('UPSTREAM_MAX_CONNECTIONS', 100))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('UPSTREAM_MAX_KEEPALIVE_CONNECTIONS', 20))
+KEEPALIVE_EXPIRY = float(os.getenv('UPSTREAM_KEEPALIVE_EXPIRY', 5))
+POOL_TIMEOUT = float(os.getenv('UPSTREAM_POOL_TIMEOUT', 5))
+HTTP2 = os.getenv('UPSTREAM_HTTP2', 'false').lower() in ('1', 'true', 'yes')
+CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', 2))
+
+# Deadline for a whole proxied request, retries and hedges included; UPSTREAM_ROUTE_TIMEOUTS overrides it per path prefix
+TIMEOUT = float(os.getenv('UPSTREAM_TIMEOUT', 30))
+ROUTE_TIMEOUTS = sorted(
+    ((prefix.strip(), float(seconds)) for prefix, seconds in
+     (entry.rsplit('=', 1) for entry in os.getenv('UPSTREAM_ROUTE_TIMEOUTS', '').split(',') if entry.strip())),
+    key=lambda route: len(route[0]), reverse=True
+)
+MAX_RETRIES = int(os.getenv('UPSTREAM_MAX_RETRIES', 2))
+# A GET still unanswered after this many seconds is also sent to a second instance; 0 disables hedging
+HEDGE_DELAY = float(os.getenv('UPSTREAM_HEDGE_DELAY', 0))
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+RETRY_STATUSES = {502, 503, 504}
+# Failures where the request never reached the upstream, so any method can be retried
+NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+UPSTREAM_DURATION = Histogram("upstream_request_duration_seconds", "Latency of proxied upstream requests", ("upstream",), buckets=DEFAULT_BUCKETS)
+UPSTREAM_IN_FLIGHT = Gauge("upstream_requests_in_flight", "Proxied requests waiting on an upstream", ("upstream",))
+UPSTREAM_RETRIES = Counter("upstream_retries_total", "Upstream requests sent again after a failure", ("upstream",))
+UPSTREAM_HEDGES = Counter("upstream_hedged_requests_total", "Slow GETs also sent to a second instance", ("upstream",))
+UPSTREAM_BREAKER_OPENED = Counter("upstream_breaker_opened_total", "Times an instance's circuit breaker opened", ("upstream", "instance"))
+
+
+class UpstreamUnavailable(Exception):
+    """No instance of the upstream can take the request: none is configured or every breaker is open."""
+
+
+class UpstreamTimeout(Exception):
+    """The route's deadline passed before an instance answered."""
+
+
+def routeTimeout(path):
+    return next((seconds for prefix, seconds in ROUTE_TIMEOUTS if path.startswith(prefix)), TIMEOUT)
+
+
+class Instance:
+    """One server of an upstream: its own pooled client, outstanding requests and circuit breaker."""
+    def __init__(self, upstream, baseUrl, limits, http2, transport=None):
+        self.upstream = upstream
+        self.baseUrl = baseUrl
+        self.limits = limits
+        self.http2 = http2
+        self.transport = transport
+        self.client = None
+        self.breaker = CircuitBreaker()
+
+        self.inFlight = 0
+        self.peakInFlight = 0
+        self.requests = 0
+        self.failures = 0
+        self.queued = 0
+        self.poolTimeouts = 0
+
+    async def start(self):
+        if self.http2 and self.transport is None:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                raise RuntimeError("UPSTREAM_HTTP2 requires the h2 package: pip install httpx[http2]")
+
+        self.client = httpx.AsyncClient(
+            base_url=self.baseUrl,
+            limits=self.limits,
+            http2=self.http2,
+            transport=self.transport,
+            # The route deadline bounds the whole call; connecting gets a short timeout of its own so it can be retried
+            timeout=httpx.Timeout(None, connect=CONNECT_TIMEOUT, pool=POOL_TIMEOUT)
+        )
+
+    async def stop(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def request(self, method, path, timeout, **kwargs):
+        self.requests += 1
+        if self.inFlight >= self.limits.max_connections:
+            # Every connection is busy, this request waits in the pool queue
+            self.queued += 1
+
+        self.breaker.acquire()
+        self.inFlight += 1
+        self.peakInFlight = max(self.peakInFlight, self.inFlight)
+        started = time.perf_counter()
+        failed = True
+        try:
+            response = await asyncio.wait_for(self.client.request(method, path, **kwargs), timeout)
+            failed = response.status_code >= 500
+            return response
+        except asyncio.TimeoutError:
+            raise UpstreamTimeout()
+        except httpx.PoolTimeout:
+            self.poolTimeouts += 1
+            raise
+        except asyncio.CancelledError:
+            failed = None # Lost a hedge race or the caller went away; says nothing about the instance
+            raise
+        finally:
+            self.inFlight -= 1
+            if failed is None:
+                self.breaker.release()
+            else:
+                self.failures += failed
+                wasOpen = self.breaker.state == "open"
+                self.breaker.record(failed, time.perf_counter() - started)
+                if self.breaker.state == "open" and not wasOpen:
+                    UPSTREAM_BREAKER_OPENED.labels(self.upstream, self.baseUrl).inc()
+
+    def stats(self):
+        pool = getattr(getattr(self.client, "_transport", None), "_pool", None)
+        connections = getattr(pool, "connections", [])
+        return {
+            "url": self.baseUrl,
+            "breaker": self.breaker.state,
+            "breakerOpened": self.breaker.opened,
+            "openConnections": len(connections),
+            "idleConnections": sum(1 for connection in connections if connection.is_idle()),
+            "inFlight": self.inFlight,
+            "peakInFlight": self.peakInFlight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "queued": self.queued,
+            "poolTimeouts": self.poolTimeouts
+        }
+
+
+class Upstream:
+    """A service behind the gateway, served by one or more instances.
+
+    `baseUrls` is a list or a comma-separated string. Each request goes to the
+    available instance with the fewest outstanding requests, under the route's
+    deadline. Idempotent requests are retried on another instance after a
+    connection failure or a 502/503/504, within a retry budget; any method is
+    retried when the request never left the gateway. With UPSTREAM_HEDGE_DELAY,
+    a slow GET is also sent to a second instance and the first answer wins.
+    """
+    def __init__(self, name, baseUrls, maxConnections=MAX_CONNECTIONS,
+                 maxKeepaliveConnections=MAX_KEEPALIVE_CONNECTIONS,
+                 keepaliveExpiry=KEEPALIVE_EXPIRY, http2=HTTP2,
+                 maxRetries=MAX_RETRIES, hedgeDelay=HEDGE_DELAY):
+        self.name = name
+        if isinstance(baseUrls, str) or baseUrls is None:
+            baseUrls = [url.strip() for url in (baseUrls or "").split(",") if url.strip()]
+        self.limits = httpx.Limits(
+            max_connections=maxConnections,
+            max_keepalive_connections=maxKeepaliveConnections,
+            keepalive_expiry=keepaliveExpiry
+        )
+        self.http2 = http2
+        self.instances = [Instance(name, url, self.limits, http2) for url in baseUrls]
+        self.maxRetries = maxRetries
+        self.hedgeDelay = hedgeDelay
+        self.budget = RetryBudget()
+
+        self.inFlight = 0
+        self.peakInFlight = 0
+        self.requests = 0
+        self.retries = 0
+        self.hedges = 0
+
+    async def start(self):
+        for instance in self.instances:
+            await instance.start()
+
+    async def stop(self):
+        for instance in self.instances:
+            await instance.stop()
+
+    def pick(self, tried=()):
+        """The least loaded available instance, preferring ones this request has not tried yet."""
+        available = [instance for instance in self.instances if instance.breaker.available()]
+        candidates = [instance for instance in available if instance not in tried] or available
+        if not candidates:
+            return None
+        return min(candidates, key=lambda instance: (instance.inFlight, random.random()))
+
+    async def request(self, method, path, **kwargs):
+        self.requests += 1
+        self.budget.deposit()
+        self.inFlight += 1
+        self.peakInFlight = max(self.peakInFlight, self.inFlight)
+        UPSTREAM_IN_FLIGHT.labels(self.name).inc()
+        started = time.perf_counter()
+        timeout = routeTimeout(path)
+        try:
+            return await self.send(method.upper(), path, started + timeout, kwargs)
+        except UpstreamTimeout:
+            raise UpstreamTimeout(f"{self.name} did not answer {method.upper()} {path} within {timeout:g}s") from None
+        finally:
+            self.inFlight -= 1
+            UPSTREAM_IN_FLIGHT.labels(self.name).dec()
+            UPSTREAM_DURATION.labels(self.name).observe(time.perf_counter() - started)
+
+    async def send(self, method, path, deadline, kwargs):
+        tried = []
+        for attempt in range(self.maxRetries + 1):
+            instance = self.pick(tried)
+            if instance is None:
+                raise UpstreamUnavailable(f"No {self.name} instance is available")
+            tried.append(instance)
+            error, response = None, None
+            try:
+                if method == "GET" and self.hedgeDelay:
+                    response = await self.hedged(instance, tried, path, deadline, kwargs)
+                else:
+                    response = await instance.request(method, path, deadline - time.perf_counter(), **kwargs)
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+            except httpx.TransportError as exc:
+                error = exc
+
+            retryable = isinstance(error, NOT_SENT) or method in IDEMPOTENT_METHODS
+            retryable = retryable and attempt < self.maxRetries and deadline > time.perf_counter()
+            # With every other instance's breaker open, the failure in hand is the answer
+            if not retryable or self.pick(tried) is None or not self.budget.withdraw():
+                if error is not None:
+                    raise error
+                return response
+            self.retries += 1
+            UPSTREAM_RETRIES.labels(self.name).inc()
+
+    async def hedged(self, instance, tried, path, deadline, kwargs):
+        """Send the GET to `instance` and, if it has not answered after hedgeDelay, to another one too."""
+        first = asyncio.ensure_future(instance.request("GET", path, deadline - time.perf_counter(), **kwargs))
+        calls = [first]
+        try:
+            done, _ = await asyncio.wait(calls, timeout=self.hedgeDelay)
+            if not done and deadline > time.perf_counter():
+                second = self.pick(tried)
+                if second is not None and second not in tried and self.budget.withdraw():
+                    tried.append(second)
+                    self.hedges += 1
+                    UPSTREAM_HEDGES.labels(self.name).inc()
+                    calls.append(asyncio.ensure_future(second.request("GET", path, deadline - time.perf_counter(), **kwargs)))
+
+            pending = set(calls)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for call in done:
+                    if not call.exception() and call.result().status_code not in RETRY_STATUSES:
+                        return call.result()
+            # Neither answered well; report the first instance's outcome
+            return first.result()
+        finally:
+            for call in calls:
+                call.cancel()
+
+    def stats(self):
+        instances = [instance.stats() for instance in self.instances]
+        maxConnections = self.limits.max_connections * len(self.instances)
+        return {
+            "urls": [instance.baseUrl for instance in self.instances],
+            "http2": self.http2,
+            "maxConnections": maxConnections,
+            "maxKeepaliveConnections": self.limits.max_keepalive_connections,
+            "openConnections": sum(instance["openConnections"] for instance in instances),
+            "idleConnections": sum(instance["idleConnections"] for instance in instances),
+            "inFlight": self.inFlight,
+            "peakInFlight": self.peakInFlight,
+            "saturation": self.inFlight / maxConnections if maxConnections else 0,
+            "requests": self.requests,
+            "queued": sum(instance["queued"] for instance in instances),
+            "poolTimeouts": sum(instance["poolTimeouts"] for instance in instances),
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "retryBudgetExhausted": self.budget.exhausted,
+            "instances": instances
+        }
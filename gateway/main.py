@@ -1,53 +1,121 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException, Response
 import uvicorn
 import httpx
 import os
 
-app = FastAPI()
+from Upstream import Upstream, UpstreamUnavailable, UpstreamTimeout
+from InProcess import inProcessUpstreams
+from ResponseCache import responseCache, CachedResponse, notModified
+from SingleFlight import singleFlight
+from Metrics import MetricsMiddleware, metrics
 
  
 ORDER_SERVICE_URL = os.getenv('ORDER_SERVICE_URL')
 CUSTOMER_SERVICE_URL = os.getenv('CUSTOMER_SERVICE_URL')
 
-async def proxy_request(request: Request, full_path: str, method: str, body: dict = None):
+# Each may list several instances, comma separated
+urls = {"order": ORDER_SERVICE_URL, "customer": CUSTOMER_SERVICE_URL}
+# Monolith mode: the prefixes in GATEWAY_IN_PROCESS run inside this process, the rest are proxied
+upstreams = {name: Upstream(name, url) for name, url in urls.items()} | inProcessUpstreams(urls)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    for upstream in upstreams.values():
+        await upstream.start()
+    yield
+    for upstream in upstreams.values():
+        await upstream.stop()
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(MetricsMiddleware)
+app.add_route("/metrics", metrics, include_in_schema=False)
+
+
+def cachedResponse(request: Request, cached: CachedResponse, cacheStatus: str = None):
+    headers = dict(cached.headers)
+    if cacheStatus:
+        headers["x-cache"] = cacheStatus
+    if notModified(request.headers.get("if-none-match"), cached.etag):
+        return Response(status_code=304, headers={"etag": cached.etag, **({"x-cache": cacheStatus} if cacheStatus else {})})
+    return Response(content=cached.content, status_code=cached.statusCode, headers=headers)
+
+
+async def proxy_request(request: Request, full_path: str, method: str):
     if full_path.startswith("order"):
-        url = f"{ORDER_SERVICE_URL}/{full_path}"
+        upstream = upstreams["order"]
     elif full_path.startswith("customer"):
-        url = f"{CUSTOMER_SERVICE_URL}/{full_path}"
+        upstream = upstreams["customer"]
     else:
         raise HTTPException(status_code=404, detail="Service not found")
-    
+
+    path = f"/{full_path}"
+    cacheable = method == "get" and responseCache.cacheable(path) and "no-cache" not in request.headers.get("cache-control", "")
+    if cacheable:
+        key = responseCache.key(method, path, str(request.query_params))
+        cached = responseCache.get(key)
+        if cached is not None:
+            return cachedResponse(request, cached, "HIT")
+        version = responseCache.version
+
+    async def send():
+        # The body goes through as sent, with its content-type: JSON objects or lists, NDJSON, CSV or nothing
+        return await upstream.request(
+            method=method,
+            path=path,
+            params=request.query_params,
+            headers=request.headers.raw,
+            content=await request.body()
+        )
+
+    coalescePrefix = singleFlight.prefix(path) if method == "get" else None
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.request(
-                method=method,
-                url=url,
-                headers=request.headers.raw,
-                content=await request.body(),
-                json=body,
-                timeout=None
-            )
-
-            return Response(
-                content=response.content,
-                status_code=response.status_code,
-                headers=dict(response.headers)
-            )
+        if coalescePrefix is not None:
+            # Identical GETs in flight at the same time share one upstream call
+            response = await singleFlight.do(f"{path}?{request.query_params}", send, coalescePrefix)
+        else:
+            response = await send()
+    except UpstreamUnavailable as exc:
+        raise HTTPException(status_code=503, detail=str(exc))
+    except UpstreamTimeout as exc:
+        raise HTTPException(status_code=504, detail=str(exc))
     except httpx.RequestError as exc:
         raise HTTPException(status_code=500, detail=f"Request failed: {str(exc)}")
 
+    if responseCache.invalidatedBy(method, path):
+        responseCache.invalidate(path, method)
+
+    if method == "get" and response.status_code == 200:
+        # Tagged whether or not it is cached, so clients can revalidate with If-None-Match
+        cached = CachedResponse(response.content, response.status_code, response.headers)
+        if cacheable:
+            responseCache.set(key, path, cached, version)
+        return cachedResponse(request, cached, "MISS" if cacheable else None)
+
+    return Response(
+        content=response.content,
+        status_code=response.status_code,
+        headers=dict(response.headers)
+    )
+
+
+@app.get("/gateway/stats")
+async def stats():
+    return {name: upstream.stats() for name, upstream in upstreams.items()} | {"cache": responseCache.stats(), "coalescing": singleFlight.stats()}
 
 @app.api_route("/{full_path:path}", methods=["GET"])
 async def get(full_path: str, request: Request):
     return await proxy_request(request, full_path, "get")
 
 @app.api_route("/{full_path:path}", methods=["POST"])
-async def post(full_path: str, request: Request, body: dict):
-    return await proxy_request(request, full_path, "post", body)
+async def post(full_path: str, request: Request):
+    return await proxy_request(request, full_path, "post")
 
 @app.api_route("/{full_path:path}", methods=["PUT"])
-async def put(full_path: str, request: Request, body: dict):
-    return await proxy_request(request, full_path, "put", body)
+async def put(full_path: str, request: Request):
+    return await proxy_request(request, full_path, "put")
 
 @app.api_route("/{full_path:path}", methods=["DELETE"])
 async def delete(full_path: str, request: Request):
@@ -56,4 +124,4 @@ async def delete(full_path: str, request: Request):
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8080) 
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8080) 
@@ -0,0 +1,486 @@
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from uuid import uuid4
+import asyncio
+import httpx
+import time
+import sys
+
+import main
+import InProcess
+import Metrics
+from Upstream import Upstream, Instance
+from Resilience import CircuitBreaker, RetryBudget
+from ResponseCache import ResponseCache, CachedResponse
+from SingleFlight import SingleFlight
+
+#Fake order and customer services behind the gateway
+backend = FastAPI()
+orders = {}
+reads = []
+
+@backend.get("/order/getByOrder/{orderId}")
+async def getByOrder(orderId: str):
+    reads.append(orderId)
+    return {"id": orderId, "status": orders.get(orderId, "pending")}
+
+@backend.put("/order/changeStatus")
+async def changeStatus(body: dict):
+    for orderId in body["ids"]:
+        orders[orderId] = body["status"]
+    return len(body["ids"])
+
+@backend.put("/order/{orderId}")
+async def updateOrder(orderId: str, body: dict):
+    orders[orderId] = body["status"]
+    return True
+
+@backend.get("/customer/{customerId}")
+async def getCustomer(customerId: str):
+    return {"id": customerId}
+
+@backend.delete("/customer/{customerId}")
+async def deleteCustomer(customerId: str):
+    return True
+
+@backend.post("/{path:path}")
+async def echo(path: str, request: Request):
+    return {"path": path, "contentType": request.headers.get("content-type"), "body": (await request.body()).decode()}
+
+def upstream(name, app):
+    service = Upstream(name, [])
+    service.instances = [Instance(name, "http://backend", service.limits, False, transport=httpx.ASGITransport(app=app))]
+    return service
+
+@pytest.fixture
+def gateway(monkeypatch):
+    orders.clear()
+    reads.clear()
+    monkeypatch.setitem(main.upstreams, "order", upstream("order", backend))
+    monkeypatch.setitem(main.upstreams, "customer", upstream("customer", backend))
+    with TestClient(main.app) as client:
+        yield client
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = ResponseCache(maxSize=100, ttl=60)
+    monkeypatch.setattr(main, "responseCache", cache)
+    return cache
+
+
+##################PROXY####################
+# Test bodies that are not a JSON object reach the services as sent: lists, NDJSON, CSV and no body at all
+def test_proxy_forwards_raw_bodies(gateway):
+    customerId = str(uuid4())
+    cases = [
+        ("order/bulk", b'[{"quantity": 1}, {"quantity": 2}]', "application/json"),
+        ("customer/validate", f'["{customerId}"]'.encode(), "application/json"),
+        ("customer/import", b'{"name": "a"}\n{"name": "b"}\n', "application/x-ndjson"),
+        ("customer/import", b"name,email\na,a@example.com\n", "text/csv"),
+        (f"order/cascade/{customerId}", b"", None)
+    ]
+    for path, body, contentType in cases:
+        response = gateway.post(f"/{path}", content=body, headers={"content-type": contentType} if contentType else {})
+
+        assert response.status_code == 200, path
+        assert response.json() == {"path": path, "contentType": contentType, "body": body.decode()}
+
+    assert gateway.put("/order/changeStatus", json={"ids": [], "status": "cancelled"}).json() == 0
+
+##################CACHE####################
+# Test GET responses carry an ETag and a matching If-None-Match is answered with 304, with or without the cache
+def test_etag_not_modified(gateway):
+    orderId = str(uuid4())
+    response = gateway.get(f"/order/getByOrder/{orderId}")
+
+    assert response.status_code == 200
+    tag = response.headers["etag"]
+    assert "x-cache" not in response.headers
+
+    response = gateway.get(f"/order/getByOrder/{orderId}", headers={"If-None-Match": f'W/{tag}, "other"'})
+    assert response.status_code == 304
+    assert response.headers["etag"] == tag
+    assert response.content == b""
+
+    assert gateway.get(f"/order/getByOrder/{orderId}", headers={"If-None-Match": '"other"'}).status_code == 200
+
+# Test a cached response is served without the upstream, and a 304 is answered from the cache too
+def test_cache_hit(gateway, cache):
+    orderId = str(uuid4())
+    first = gateway.get(f"/order/getByOrder/{orderId}")
+    second = gateway.get(f"/order/getByOrder/{orderId}")
+
+    assert (first.headers["x-cache"], second.headers["x-cache"]) == ("MISS", "HIT")
+    assert second.json() == first.json()
+    assert second.headers["etag"] == first.headers["etag"]
+    assert reads == [orderId]
+
+    response = gateway.get(f"/order/getByOrder/{orderId}", headers={"If-None-Match": first.headers["etag"]})
+    assert (response.status_code, response.headers["x-cache"]) == (304, "HIT")
+    assert gateway.get(f"/order/getByOrder/{orderId}", headers={"Cache-Control": "no-cache"}).status_code == 200
+    assert reads == [orderId, orderId]
+
+# Test a write to a resource drops the cached responses that name its id, and only those
+def test_cache_invalidated_by_resource_id(gateway, cache):
+    orderId, otherId = str(uuid4()), str(uuid4())
+    gateway.get(f"/order/getByOrder/{orderId}")
+    gateway.get(f"/order/getByOrder/{otherId}")
+
+    assert gateway.put(f"/order/{orderId}", json={"status": "shipped"}).status_code == 200
+
+    response = gateway.get(f"/order/getByOrder/{orderId}")
+    assert response.headers["x-cache"] == "MISS"
+    assert response.json()["status"] == "shipped"
+    assert gateway.get(f"/order/getByOrder/{otherId}").headers["x-cache"] == "HIT"
+    assert cache.stats()["invalidations"] == 1
+
+# Test a write whose path names no resource drops everything cached under its service
+def test_cache_flushed_by_write_without_resource_id(gateway, cache):
+    orderIds = [str(uuid4()), str(uuid4())]
+    customerId = str(uuid4())
+    for orderId in orderIds:
+        gateway.get(f"/order/getByOrder/{orderId}")
+    gateway.get(f"/customer/{customerId}")
+
+    assert gateway.put("/order/changeStatus", json={"ids": orderIds, "status": "cancelled"}).status_code == 200
+
+    for orderId in orderIds:
+        response = gateway.get(f"/order/getByOrder/{orderId}")
+        assert response.headers["x-cache"] == "MISS"
+        assert response.json()["status"] == "cancelled"
+    assert gateway.get(f"/customer/{customerId}").headers["x-cache"] == "HIT"
+
+# Test a customer delete, which cascades to the customer's orders, also drops the cached orders
+def test_cache_flushed_by_customer_delete(gateway, cache):
+    orderId, customerId, otherCustomerId = str(uuid4()), str(uuid4()), str(uuid4())
+    gateway.get(f"/order/getByOrder/{orderId}")
+    gateway.get(f"/customer/{customerId}")
+    gateway.get(f"/customer/{otherCustomerId}")
+
+    assert gateway.delete(f"/customer/{customerId}").status_code == 200
+
+    assert gateway.get(f"/order/getByOrder/{orderId}").headers["x-cache"] == "MISS"
+    assert gateway.get(f"/customer/{customerId}").headers["x-cache"] == "MISS"
+    assert gateway.get(f"/customer/{otherCustomerId}").headers["x-cache"] == "HIT"
+
+# Test a GET that read before a write and finishes after it is not cached
+def test_cache_version_guard():
+    cache = ResponseCache(maxSize=10, ttl=60)
+    path = f"/order/getByOrder/{uuid4()}"
+    key = cache.key("get", path)
+
+    version = cache.version
+    cache.invalidate(path)
+    cache.set(key, path, CachedResponse(b"stale", 200, {}), version)
+    assert cache.get(key) is None
+
+    cache.set(key, path, CachedResponse(b"fresh", 200, {}), cache.version)
+    assert cache.get(key).content == b"fresh"
+
+# Test entries expire after the TTL and the least recently used one is evicted past maxSize
+def test_cache_expiry_and_eviction():
+    paths = [f"/order/getByOrder/{uuid4()}" for _ in range(3)]
+    cache = ResponseCache(maxSize=2, ttl=60)
+    for path in paths:
+        cache.set(cache.key("get", path), path, CachedResponse(b"{}", 200, {}))
+
+    assert cache.get(cache.key("get", paths[0])) is None
+    assert cache.stats()["evictions"] == 1
+
+    expired = ResponseCache(maxSize=2, ttl=-1)
+    expired.set(expired.key("get", paths[0]), paths[0], CachedResponse(b"{}", 200, {}))
+    assert expired.get(expired.key("get", paths[0])) is None
+    assert expired.stats()["size"] == 0
+
+# Test only single resources under the configured prefixes are cacheable
+def test_cache_cacheable_paths():
+    cache = ResponseCache(maxSize=10, prefixes=["/customer/", "/order/getByOrder/"])
+
+    assert cache.cacheable(f"/order/getByOrder/{uuid4()}")
+    assert not cache.cacheable("/order/")
+    assert not cache.cacheable(f"/order/getByCustomer/{uuid4()}")
+    assert not ResponseCache(maxSize=0).cacheable(f"/customer/{uuid4()}")
+##########################################
+
+
+###############SINGLEFLIGHT################
+# Test identical concurrent calls share one call and its result; a later call runs again
+def test_singleflight_coalesces_concurrent_calls():
+    flight = SingleFlight(prefixes=["/order/"])
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return object()
+
+    async def run():
+        results = await asyncio.gather(*[flight.do("/order/x?", fetch, "/order/") for _ in range(5)])
+        later = await flight.do("/order/x?", fetch, "/order/")
+        return results, later
+
+    results, later = asyncio.run(run())
+
+    assert len(calls) == 2
+    assert all(result is results[0] for result in results)
+    assert later is not results[0]
+    assert flight.stats() == {"prefixes": ["/order/"], "inFlight": 0, "calls": 2, "coalesced": 4}
+
+# Test calls with different keys are not coalesced
+def test_singleflight_separate_keys():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        return object()
+
+    async def run():
+        return await asyncio.gather(flight.do("/order/x?a=1", fetch), flight.do("/order/x?a=2", fetch))
+
+    first, second = asyncio.run(run())
+    assert first is not second
+    assert flight.coalesced == 0
+
+# Test a caller that goes away does not cancel the call for the others sharing it
+def test_singleflight_cancelled_caller():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def run():
+        leaving = asyncio.ensure_future(flight.do("key", fetch))
+        staying = asyncio.ensure_future(flight.do("key", fetch))
+        await asyncio.sleep(0.01)
+        leaving.cancel()
+        return await staying, leaving.cancelled()
+
+    assert asyncio.run(run()) == ("done", True)
+
+# Test an error reaches every caller sharing the call, and the key is released
+def test_singleflight_error_shared():
+    flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise httpx.ConnectError("refused")
+
+    async def run():
+        return await asyncio.gather(*[flight.do("key", fail) for _ in range(3)], return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, httpx.ConnectError) for result in results)
+    assert flight.stats()["inFlight"] == 0
+
+# Test the gateway coalesces identical GETs under GATEWAY_COALESCE_PATHS only
+def test_singleflight_prefixes():
+    flight = SingleFlight(prefixes=["/customer/", "/order/"])
+
+    assert flight.prefix("/order/getByOrder/1") == "/order/"
+    assert flight.prefix("/gateway/stats") is None
+    assert SingleFlight(prefixes=[]).prefix("/order/") is None
+##########################################
+
+
+###############RESILIENCE##################
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def breaker(clock, **options):
+    return CircuitBreaker(**{"window": 10, "minCalls": 4, "errorRate": 0.5, "slowCall": 1, "slowRate": 0.8, "openSeconds": 10, "clock": clock} | options)
+
+def mocked(handlers, **options):
+    service = Upstream("order", [], **options)
+    service.instances = [
+        Instance("order", f"http://instance{index}", service.limits, False, transport=httpx.MockTransport(handler))
+        for index, handler in enumerate(handlers)
+    ]
+    return service
+
+def responder(status, calls):
+    def handler(request):
+        calls.append(request.url.host)
+        return httpx.Response(status)
+    return handler
+
+def call(service, method):
+    async def run():
+        await service.start()
+        try:
+            return await service.request(method, "/order/x")
+        finally:
+            await service.stop()
+    return asyncio.run(run())
+
+# Test the breaker opens once the error rate over the window reaches the threshold, and not before minCalls
+def test_breaker_opens_on_error_rate():
+    clock = FakeClock()
+    circuit = breaker(clock)
+    for failed in (True, True, False):
+        circuit.record(failed, 0.01)
+    assert circuit.state == "closed"
+
+    circuit.record(False, 0.01)
+    assert circuit.state == "open" and not circuit.available()
+    assert circuit.opened == 1
+
+    clock.now += 9.9
+    assert not circuit.available()
+    clock.now += 0.1
+    assert circuit.available() and circuit.state == "half-open"
+
+# Test slow calls open the breaker at the slow-call rate even when every call succeeded
+def test_breaker_opens_on_slow_rate():
+    circuit = breaker(FakeClock())
+    circuit.record(False, 0.01)
+    for _ in range(3):
+        circuit.record(False, 1.5)
+    assert circuit.state == "closed" # 3 of 4 slow is under 0.8
+
+    circuit.record(False, 1.5)
+    assert circuit.state == "open"
+
+# Test half-open lets a single probe through; its outcome closes or reopens the breaker, and a cancelled probe gives its turn back
+def test_breaker_half_open_single_probe():
+    clock = FakeClock()
+    circuit = breaker(clock)
+    circuit.open()
+    clock.now += 10
+
+    assert circuit.available()
+    circuit.acquire()
+    assert not circuit.available()
+    circuit.release()
+    assert circuit.available()
+
+    circuit.acquire()
+    circuit.record(True, 0.01)
+    assert circuit.state == "open" and circuit.opened == 2
+    assert not circuit.available()
+
+    clock.now += 10
+    assert circuit.available()
+    circuit.acquire()
+    circuit.record(False, 0.01)
+    assert circuit.state == "closed" and circuit.available()
+
+# Test a POST that reached an instance is not sent again on a 503, while a GET is retried on another instance
+def test_upstream_no_retry_after_post_sent():
+    calls = []
+    service = mocked([responder(503, calls), responder(503, calls)], maxRetries=2)
+
+    assert call(service, "post").status_code == 503
+    assert len(calls) == 1
+
+    calls.clear()
+    assert call(service, "get").status_code == 503
+    assert set(calls) == {"instance0", "instance1"} and len(calls) == 3
+
+# Test a POST that never left the gateway is retried on another instance
+def test_upstream_retries_post_not_sent():
+    calls = []
+    def refuse(request):
+        calls.append(request.url.host)
+        raise httpx.ConnectError("refused", request=request)
+
+    service = mocked([refuse, responder(200, calls)], maxRetries=1)
+    # The refusing instance looks idle, so it is picked first
+    service.instances[1].inFlight = 1
+
+    assert call(service, "post").status_code == 200
+    assert calls == ["instance0", "instance1"]
+    assert service.stats()["retries"] == 1
+
+# Test retries stop once the budget is spent, and the failure in hand is returned
+def test_upstream_retry_budget_exhausted():
+    calls = []
+    clock = FakeClock()
+    service = mocked([responder(503, calls) for _ in range(3)], maxRetries=5)
+    service.budget = RetryBudget(ratio=0.1, minPerSecond=1, clock=clock)
+
+    assert call(service, "get").status_code == 503
+    assert len(calls) == 2 # The first try and the one retry the budget allowed
+    assert service.stats()["retryBudgetExhausted"] == 1
+
+    # Ten requests' deposits buy one retry, and a new second brings the floor back
+    for _ in range(10):
+        service.budget.deposit()
+    assert service.budget.withdraw()
+    assert not service.budget.withdraw()
+    clock.now += 1
+    assert service.budget.withdraw()
+
+# Test a slow GET is hedged to a second instance; the losing call is cancelled without counting against its instance
+def test_upstream_hedge_loser_not_counted():
+    clock = FakeClock()
+    calls = []
+
+    async def handler(request):
+        calls.append(request.url.host)
+        if len(calls) == 1:
+            await asyncio.sleep(5) # The first instance asked hangs
+        return httpx.Response(200, json={"from": request.url.host})
+
+    service = mocked([handler, handler], hedgeDelay=0.05)
+    for instance in service.instances:
+        # Both half-open, so each may only send a single probe
+        instance.breaker = breaker(clock)
+        instance.breaker.open()
+    clock.now += 10
+
+    started = time.perf_counter()
+    response = call(service, "get")
+
+    assert time.perf_counter() - started < 2
+    assert response.json()["from"] == calls[1]
+    assert service.stats()["hedges"] == 1
+
+    loser, winner = sorted(service.instances, key=lambda instance: instance.baseUrl != f"http://{calls[0]}")
+    assert loser.failures == 0 and len(loser.breaker.outcomes) == 0
+    assert loser.breaker.state == "half-open" and loser.breaker.available()
+    assert winner.breaker.state == "closed"
+##########################################
+
+###############INPROCESS###################
+# Test monolith mode points customer_service's calls to order_service at the in-process order app
+def test_in_process_services_call_each_other(monkeypatch):
+    monkeypatch.setattr(InProcess, "IN_PROCESS", ["order", "customer"])
+    upstreams = InProcess.inProcessUpstreams({})
+    orderService = sys.modules["customer_service.app.OrderService"]
+
+    assert orderService.ORDER_SERVICE_URLS == ["http://in-process"]
+    assert upstreams["order"].stats()["inProcess"]
+
+    async def invalidate():
+        await orderService.invalidateCustomerCache(uuid4())
+        response = await orderService.client.delete(f"{orderService.ORDER_SERVICE_URLS[0]}/order/customerCache/{uuid4()}")
+        await orderService.client.aclose()
+        return response
+
+    response = asyncio.run(invalidate())
+    assert response.status_code == 200
+    assert response.json() is False
+
+# Test monolith mode's /metrics carries the in-process services' metrics next to the gateway's, told apart by a service label
+def test_in_process_metrics(monkeypatch):
+    monkeypatch.setattr(InProcess, "IN_PROCESS", ["order", "customer"])
+    monkeypatch.setattr(Metrics, "serviceRegistries", {})
+    InProcess.inProcessUpstreams({})
+    assert set(Metrics.serviceRegistries) == {"order", "customer"}
+
+    Metrics.HTTP_REQUESTS.labels("GET", "/gateway/stats", "200").inc()
+    sys.modules["order_service.app.Metrics"].HTTP_REQUESTS.labels("GET", "/order/", "200").inc()
+    sys.modules["customer_service.app.Metrics"].HTTP_REQUESTS.labels("GET", "/customer/", "200").inc()
+    exposition = asyncio.run(Metrics.metrics(None)).body.decode()
+
+    assert exposition.count("# TYPE http_requests_total counter") == 1
+    for service, route in (("gateway", "/gateway/stats"), ("order", "/order/"), ("customer", "/customer/")):
+        assert f'http_requests_total{{method="GET",route="{route}",service="{service}",status="200"}}' in exposition
+    assert 'rabbitmq_publish_backlog{service="order"}' in exposition
+##########################################
@@ -0,0 +1,223 @@
+"""Load test order_service, customer_service and the gateway against local stand-ins.
+
+    python loadtest/run.py --concurrency 50 --requests 2000 --output results.json
+    python loadtest/run.py --baseline results.json --threshold 0.1
+
+Every service is started by serve.py in its own process with in-memory MongoDB
+and RabbitMQ stand-ins. Each scenario is driven at the given concurrency and
+reported as RPS and p50/p95/p99 latency. With --baseline, scenarios whose RPS
+dropped or whose p99 grew by more than the threshold are flagged and the run
+exits with status 1.
+
+gateway_in_process runs the gateway scenarios against a gateway that serves
+both services in its own process (monolith mode); with both gateways in the
+run, their latencies are compared side by side.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import seed
+
+HERE = Path(__file__).resolve().parent
+PORTS = {"customer_service": 9101, "order_service": 9102, "gateway": 9180, "gateway_in_process": 9181}
+
+
+def orderBody(index, customers):
+    return {
+        "customerId": str(seed.customerId(index % customers)),
+        "quantity": 1,
+        "price": 100.0,
+        "status": "pending",
+        "product": {"id": str(seed.orderId(index)), "name": "Product", "imageUrl": "http://example.com/product.png"}
+    }
+
+
+def customerBody(index, customers):
+    return {"name": f"Load {index}", "email": f"load{index}@example.com", "address": seed.address(index)}
+
+
+# service -> [(scenario, method, path(index, args), body(index, args) or None)]
+SCENARIOS = {
+    "customer_service": [
+        ("create", "POST", lambda i, a: "/customer/", customerBody),
+        ("get", "GET", lambda i, a: f"/customer/{seed.customerId(i % a.customers)}", None),
+        ("validate", "GET", lambda i, a: f"/customer/validate/{seed.customerId(i % a.customers)}", None),
+        ("update", "PUT", lambda i, a: f"/customer/{seed.customerId(i % a.customers)}", customerBody),
+        ("getAll page", "GET", lambda i, a: "/customer/?limit=100", None)
+    ],
+    "order_service": [
+        ("create", "POST", lambda i, a: "/order/", orderBody),
+        ("getByOrder", "GET", lambda i, a: f"/order/getByOrder/{seed.orderId(i % a.orders)}", None),
+        ("getByCustomer", "GET", lambda i, a: f"/order/getByCustomer/{seed.customerId(i % a.customers)}", None),
+        ("changeStatus", "PUT", lambda i, a: f"/order/changeStatus/{seed.orderId(i % a.orders)}?status=shipped", None),
+        ("getAll page", "GET", lambda i, a: "/order/?limit=100", None)
+    ],
+    "gateway": [
+        ("customer get", "GET", lambda i, a: f"/customer/{seed.customerId(i % a.customers)}", None),
+        ("order getByOrder", "GET", lambda i, a: f"/order/getByOrder/{seed.orderId(i % a.orders)}", None),
+        ("order create", "POST", lambda i, a: "/order/", orderBody)
+    ]
+}
+SCENARIOS["gateway_in_process"] = SCENARIOS["gateway"]
+
+
+def percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+async def drive(client, method, path, body, args):
+    latencies, errors = [], 0
+    counter = iter(range(args.requests))
+
+    async def worker():
+        nonlocal errors
+        for index in counter:
+            started = time.perf_counter()
+            response = await client.request(method, path(index, args), json=body(index, args.customers) if body else None)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99": round(percentile(latencies, 0.99) * 1000, 2)
+    }
+
+
+def start(service, args):
+    env = os.environ.copy()
+    env["ORDER_SERVICE_URL"] = f"http://127.0.0.1:{PORTS['order_service']}"
+    env["CUSTOMER_SERVICE_URL"] = f"http://127.0.0.1:{PORTS['customer_service']}"
+    command = [sys.executable, str(HERE / "serve.py"), service, str(PORTS[service]), "--customers", str(args.customers), "--orders", str(args.orders)]
+    if service == "gateway_in_process":
+        command[2:3] = ["gateway"]
+        command.append("--in-process")
+    return subprocess.Popen(command, env=env)
+
+
+async def waitUntilReady(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(f"http://127.0.0.1:{port}/openapi.json")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"Service on port {port} did not start within {timeout}s")
+
+
+async def runAll(args):
+    results = {}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    for service in args.services:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{PORTS[service]}", limits=limits, timeout=30) as client:
+            results[service] = {}
+            for scenario, method, path, body in SCENARIOS[service]:
+                # Warm up connections and caches before measuring
+                await drive(client, method, path, body, argparse.Namespace(**vars(args) | {"requests": args.concurrency}))
+                results[service][scenario] = await drive(client, method, path, body, args)
+                print(f"{service:<20}{scenario:<20}{json.dumps(results[service][scenario])}")
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for service, scenarios in results.items():
+        for scenario, current in scenarios.items():
+            previous = baseline.get(service, {}).get(scenario)
+            if previous is None:
+                continue
+            if current["rps"] < previous["rps"] * (1 - threshold):
+                regressions.append(f"{service} {scenario}: rps {previous['rps']} -> {current['rps']}")
+            if current["p99"] > previous["p99"] * (1 + threshold):
+                regressions.append(f"{service} {scenario}: p99 {previous['p99']}ms -> {current['p99']}ms")
+    return regressions
+
+
+def compareModes(results):
+    """p50/p99 of every gateway scenario, proxied over HTTP against served in process."""
+    lines = [f"{'scenario':<20}{'http p50':>10}{'in-proc p50':>13}{'http p99':>10}{'in-proc p99':>13}{'p50 saved':>11}"]
+    for scenario, proxied in results["gateway"].items():
+        local = results["gateway_in_process"][scenario]
+        lines.append(f"{scenario:<20}{proxied['p50']:>10}{local['p50']:>13}{proxied['p99']:>10}{local['p99']:>13}"
+                     f"{1 - local['p50'] / proxied['p50']:>11.0%}")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--services", default="customer_service,order_service,gateway,gateway_in_process")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per scenario")
+    parser.add_argument("--customers", type=int, default=1000)
+    parser.add_argument("--orders", type=int, default=10000)
+    parser.add_argument("--output", default="loadtest_results.json")
+    parser.add_argument("--baseline")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+    args.services = args.services.split(",")
+
+    # The gateway proxies to both services, so they have to be up for it
+    needed = set(args.services) | ({"customer_service", "order_service"} if "gateway" in args.services else set())
+    processes = [start(service, args) for service in sorted(needed)]
+    try:
+        async def run():
+            for service in needed:
+                await waitUntilReady(PORTS[service])
+            return await runAll(args)
+        results = asyncio.run(run())
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    report = {
+        "meta": {
+            "time": datetime.utcnow().isoformat(),
+            "commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=HERE).stdout.strip(),
+            "python": platform.python_version(),
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "customers": args.customers,
+            "orders": args.orders
+        },
+        "results": results
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+    if "gateway" in results and "gateway_in_process" in results:
+        print("\n".join(compareModes(results)))
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file)["results"], args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
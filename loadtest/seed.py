@@ -0,0 +1,46 @@
+"""Deterministic seed data, so the load driver can address documents the servers were seeded with."""
+from bson import Binary
+from datetime import datetime, timedelta
+from uuid import UUID, uuid5
+
+NAMESPACE = UUID("6f1c4ae6-3b7e-4a5f-9d0f-2b8f4c1d7e90")
+EPOCH = datetime(2024, 1, 1)
+
+
+def customerId(index):
+    return uuid5(NAMESPACE, f"customer-{index}")
+
+
+def orderId(index):
+    return uuid5(NAMESPACE, f"order-{index}")
+
+
+def address(index):
+    return {"addressLine": f"{index} Main St", "city": "Metropolis", "country": "Wonderland", "cityCode": 10000 + index % 1000}
+
+
+def customers(count):
+    for index in range(count):
+        yield {
+            "id": Binary.from_uuid(customerId(index)),
+            "name": f"Customer {index}",
+            "email": f"customer{index}@example.com",
+            "address": address(index),
+            "createdAt": EPOCH + timedelta(seconds=index),
+            "updatedAt": EPOCH + timedelta(seconds=index)
+        }
+
+
+def orders(count, customerCount):
+    for index in range(count):
+        yield {
+            "id": Binary.from_uuid(orderId(index)),
+            "customerId": Binary.from_uuid(customerId(index % customerCount)),
+            "quantity": 1 + index % 5,
+            "price": float(10 + index % 500),
+            "status": ("pending", "processing", "shipped", "delivered")[index % 4],
+            "address": address(index % customerCount),
+            "product": {"id": Binary.from_uuid(uuid5(NAMESPACE, f"product-{index % 100}")), "name": f"Product {index % 100}", "imageUrl": "http://example.com/product.png"},
+            "createdAt": EPOCH + timedelta(seconds=index),
+            "updatedAt": EPOCH + timedelta(seconds=index)
+        }
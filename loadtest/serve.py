@@ -0,0 +1,70 @@
+"""Run one service on a port with in-memory MongoDB and RabbitMQ stand-ins.
+
+    python loadtest/serve.py order_service 9002 --customers 1000 --orders 10000
+    python loadtest/serve.py gateway 9080 --in-process
+
+With --in-process the gateway runs both services inside its own process
+(GATEWAY_IN_PROCESS=order,customer) instead of proxying to them.
+"""
+import argparse
+import asyncio
+import importlib.util
+import os
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import motor.motor_asyncio
+import uvicorn
+from standins import FakeClient
+import seed
+
+
+def seeded(collection, documents):
+    async def insert():
+        for document in documents:
+            await collection.insert_one(document)
+    asyncio.run(insert())
+    return collection
+
+
+def patchBroker():
+    # The order service's broker stand-in, loaded by path so its `benchmarks` package stays out of sys.path
+    spec = importlib.util.spec_from_file_location("broker", ROOT / "order_service" / "benchmarks" / "broker.py")
+    broker = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(broker)
+    for name, value in (("ip", "127.0.0.1"), ("rabbit_username", "guest"), ("rabbit_password", "guest")):
+        os.environ.setdefault(name, value)
+    broker.FakeBroker().patch().__enter__()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("service", choices=["order_service", "customer_service", "gateway"])
+    parser.add_argument("port", type=int)
+    parser.add_argument("--customers", type=int, default=1000)
+    parser.add_argument("--orders", type=int, default=10000)
+    parser.add_argument("--in-process", action="store_true", help="gateway only: serve both services in the gateway process")
+    args = parser.parse_args()
+
+    os.chdir(ROOT / args.service)
+    sys.path.insert(0, str(ROOT / args.service))
+
+    # Every MongoDB client the services create, at import or later, gets the stand-in collections
+    motor.motor_asyncio.AsyncIOMotorClient = FakeClient
+    seeded(FakeClient.collection("Tesodev", "customers"), seed.customers(args.customers))
+    seeded(FakeClient.collection("Tesodev", "orders", indexed=("id", "customerId")), seed.orders(args.orders, args.customers))
+
+    if args.service == "order_service" or args.in_process:
+        patchBroker()
+    if args.in_process:
+        os.environ["GATEWAY_IN_PROCESS"] = "order,customer"
+
+    import main
+    uvicorn.run(main.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
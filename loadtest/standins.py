@@ -0,0 +1,230 @@
+"""In-memory stand-ins for the Motor collections the services use.
+
+Only the subset of the query language the routes issue is supported: field
+equality, $in, $gt/$gte/$lt/$lte, $and/$or, $set/$inc updates and simple
+projections. Equality lookups on indexed fields avoid a full scan.
+"""
+from types import SimpleNamespace
+from bson import ObjectId
+import copy
+
+
+def getField(document, path):
+    for key in path.split("."):
+        if not isinstance(document, dict) or key not in document:
+            return None
+        document = document[key]
+    return document
+
+
+OPERATORS = {
+    "$in": lambda value, operand: value in operand,
+    "$nin": lambda value, operand: value not in operand,
+    "$ne": lambda value, operand: value != operand,
+    "$gt": lambda value, operand: value is not None and value > operand,
+    "$gte": lambda value, operand: value is not None and value >= operand,
+    "$lt": lambda value, operand: value is not None and value < operand,
+    "$lte": lambda value, operand: value is not None and value <= operand,
+    "$exists": lambda value, operand: (value is not None) == operand
+}
+
+
+def matches(document, query):
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(matches(document, part) for part in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(document, part) for part in condition):
+                return False
+        elif isinstance(condition, dict) and condition and all(op.startswith("$") for op in condition):
+            value = getField(document, key)
+            if not all(OPERATORS[op](value, operand) for op, operand in condition.items()):
+                return False
+        elif getField(document, key) != condition:
+            return False
+    return True
+
+
+def project(document, projection):
+    if not projection:
+        return copy.deepcopy(document)
+
+    include = {key for key, value in projection.items() if value and key != "_id"}
+    if include:
+        result = {key: copy.deepcopy(document[key]) for key in include if key in document}
+        if projection.get("_id", 1) and "_id" in document:
+            result["_id"] = document["_id"]
+        return result
+
+    return {key: copy.deepcopy(value) for key, value in document.items() if projection.get(key, 1)}
+
+
+class FakeCursor:
+    def __init__(self, documents, projection):
+        self.documents = documents
+        self.projection = projection
+        self.skipCount = 0
+        self.limitCount = 0
+
+    def sort(self, keys, direction=None):
+        if isinstance(keys, str):
+            keys = [(keys, direction or 1)]
+        for key, order in reversed(keys):
+            self.documents.sort(key=lambda document: (getField(document, key) is not None, getField(document, key)), reverse=order < 0)
+        return self
+
+    def skip(self, count):
+        self.skipCount = count
+        return self
+
+    def limit(self, count):
+        self.limitCount = count
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def __selected(self):
+        documents = self.documents[self.skipCount:]
+        if self.limitCount:
+            documents = documents[:self.limitCount]
+        return [project(document, self.projection) for document in documents]
+
+    async def to_list(self, length=None):
+        documents = self.__selected()
+        return documents if length is None else documents[:length]
+
+    def __aiter__(self):
+        self.__iterator = iter(self.__selected())
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.__iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeCollection:
+    """Motor-like collection kept in a list, with hash indexes on `indexed` fields."""
+    def __init__(self, indexed=("id",)):
+        self.documents = []
+        self.indexed = indexed
+        self.indexes = {field: {} for field in indexed}
+
+    def __index(self, document):
+        for field in self.indexed:
+            self.indexes[field].setdefault(self.__key(getField(document, field)), []).append(document)
+
+    def __unindex(self, document):
+        for field in self.indexed:
+            key = self.__key(getField(document, field))
+            bucket = self.indexes[field].get(key, [])
+            self.indexes[field][key] = [other for other in bucket if other is not document]
+
+    def __key(self, value):
+        return (type(value).__name__, value) if value is not None else None
+
+    def __candidates(self, query):
+        for field in self.indexed:
+            if field in query and not isinstance(query[field], dict):
+                return list(self.indexes[field].get(self.__key(query[field]), []))
+        return self.documents
+
+    def __find(self, query):
+        return [document for document in self.__candidates(query or {}) if matches(document, query or {})]
+
+    async def create_indexes(self, indexes, **kwargs):
+        return []
+
+    async def insert_one(self, document, **kwargs):
+        document.setdefault("_id", ObjectId())
+        stored = copy.deepcopy(document)
+        self.documents.append(stored)
+        self.__index(stored)
+        return SimpleNamespace(inserted_id=document["_id"])
+
+    async def insert_many(self, documents, ordered=True, **kwargs):
+        ids = [(await self.insert_one(document)).inserted_id for document in documents]
+        return SimpleNamespace(inserted_ids=ids)
+
+    def find(self, query=None, projection=None, **kwargs):
+        return FakeCursor(self.__find(query), projection)
+
+    async def find_one(self, query=None, projection=None, **kwargs):
+        documents = self.__find(query)
+        return project(documents[0], projection) if documents else None
+
+    async def count_documents(self, query, **kwargs):
+        return len(self.__find(query))
+
+    def __apply(self, document, update):
+        self.__unindex(document)
+        for key, value in update.get("$set", {}).items():
+            document[key] = copy.deepcopy(value)
+        for key, value in update.get("$inc", {}).items():
+            document[key] = document.get(key, 0) + value
+        self.__index(document)
+
+    async def find_one_and_update(self, query, update, projection=None, upsert=False, **kwargs):
+        documents = self.__find(query)[:1]
+        for document in documents:
+            self.__apply(document, update)
+        return project(documents[0], projection) if documents else None
+
+    async def update_one(self, query, update, upsert=False, **kwargs):
+        documents = self.__find(query)[:1]
+        for document in documents:
+            self.__apply(document, update)
+        return SimpleNamespace(matched_count=len(documents), modified_count=len(documents))
+
+    async def update_many(self, query, update, upsert=False, **kwargs):
+        documents = self.__find(query)
+        for document in documents:
+            self.__apply(document, update)
+        return SimpleNamespace(matched_count=len(documents), modified_count=len(documents))
+
+    async def delete_one(self, query, **kwargs):
+        documents = self.__find(query)[:1]
+        for document in documents:
+            self.__unindex(document)
+            self.documents = [other for other in self.documents if other is not document]
+        return SimpleNamespace(deleted_count=len(documents))
+
+    async def delete_many(self, query, **kwargs):
+        documents = self.__find(query)
+        for document in documents:
+            self.__unindex(document)
+        ids = {id(document) for document in documents}
+        self.documents = [document for document in self.documents if id(document) not in ids]
+        return SimpleNamespace(deleted_count=len(documents))
+
+
+class FakeDatabase:
+    def __init__(self, name):
+        self.name = name
+
+    def __getitem__(self, collection):
+        return FakeClient.collection(self.name, collection)
+
+
+class FakeClient:
+    """Drop-in for AsyncIOMotorClient; every database.collection is a FakeCollection shared by name.
+
+    Services imported into one process, as the gateway does in monolith
+    mode, therefore see the same customers and orders, like on one MongoDB.
+    """
+    collections = {}
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getitem__(self, database):
+        return FakeDatabase(database)
+
+    @classmethod
+    def collection(cls, database, name, indexed=("id",)):
+        if (database, name) not in cls.collections:
+            cls.collections[database, name] = FakeCollection(indexed)
+        return cls.collections[database, name]
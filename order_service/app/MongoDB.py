@@ -1,19 +1,65 @@
+from contextlib import asynccontextmanager
 import motor.motor_asyncio
+from pymongo import monitoring
 import os
 
+from .indexes import INDEXES, AUDIT_INDEXES
+from .Metrics import Histogram, Counter, DEFAULT_BUCKETS, registry
+
+
+MONGO_DURATION = Histogram("mongodb_command_duration_seconds", "MongoDB command latency", ("collection", "command"), buckets=DEFAULT_BUCKETS, registry=registry)
+MONGO_FAILURES = Counter("mongodb_command_failures_total", "MongoDB commands that failed", ("collection", "command"), registry=registry)
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Times every command pymongo sends, by collection and command name."""
+    def __init__(self):
+        self.collections = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = event.command.get("collection", "") # getMore carries the cursor id instead
+        self.collections[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event):
+        collection = self.collections.pop((event.connection_id, event.request_id), "")
+        MONGO_DURATION.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        collection = self.collections.pop((event.connection_id, event.request_id), "")
+        MONGO_DURATION.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+        MONGO_FAILURES.labels(collection, event.command_name).inc()
+
 
 conn_str = os.getenv('conn_str')
+conn_str_audit = os.getenv('conn_str_audit')
 
 class MongoDB:
-    def __init__(self, conn_str, list):
+    def __init__(self, conn_str, list, indexes={}):
         self.__client = motor.motor_asyncio.AsyncIOMotorClient(
-            conn_str, serverSelectionTimeoutMS=5000
+            conn_str, serverSelectionTimeoutMS=5000, event_listeners=[CommandMetrics()]
         )
         self.collections = {}
+        self.indexes = indexes
         self.addCollection(list)
 
     def addCollection(self, list):
         for collection in list:
             self.collections[collection[1]] = self.__client[collection[0]][collection[1]]
 
-mongodb = MongoDB(conn_str, [["Tesodev", "customers"], ["Tesodev", "orders"]])
+    @asynccontextmanager
+    async def transaction(self):
+        """A session with a transaction that commits on exit; needs a replica set or sharded cluster."""
+        async with await self.__client.start_session() as session:
+            async with session.start_transaction():
+                yield session
+
+    async def ensureIndexes(self):
+        # create_indexes is a no-op for indexes that already exist with the same spec
+        for collection, indexes in self.indexes.items():
+            await self.collections[collection].create_indexes(indexes)
+
+mongodb = MongoDB(conn_str, [["Tesodev", "customers"], ["Tesodev", "orders"], ["Tesodev", "outbox"], ["Tesodev", "outboxLease"], ["Tesodev", "orderRollups"], ["Tesodev", "cascadeJobs"], ["Tesodev", "ordersArchive"]], INDEXES)
+# Read side of the audit trail; unset leaves the audit API disabled
+auditdb = MongoDB(conn_str_audit, [["Tesodev", "AuditLog"], ["Tesodev", "AuditLogHourly"]], AUDIT_INDEXES) if conn_str_audit else None
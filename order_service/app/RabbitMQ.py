@@ -1,47 +1,245 @@
 import pika
 import json
+import bson
 from bson import Binary
 from datetime import datetime
+from concurrent.futures import Future
+import threading
+import queue
 import uuid
+import time
 import os
 
+from .Metrics import Histogram, Counter, Gauge, DEFAULT_BUCKETS, registry
+
 username = os.getenv('rabbit_username')
 password = os.getenv('rabbit_password')
 ip = os.getenv('ip')
 
-def encodeSpecialFields(orderData):
-    for key, value in orderData.items():
-        if isinstance(value, Binary):
-            orderData[key] = str(uuid.UUID(bytes=value))
-        elif isinstance(value, datetime):
-            orderData[key] = value.isoformat()
-        elif isinstance(value, dict):
-            encodeSpecialFields(value)
-    return orderData
-
-def publishMessage(orderData: dict): 
-    orderData = encodeSpecialFields(orderData)
-    
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(
-            host=ip,
-            port=5672,
-            virtual_host='/',
-            credentials=pika.PlainCredentials(username, password)
-        )
+QUEUE_NAME = 'order_audit_log'
+CHANNEL_POOL_SIZE = int(os.getenv('rabbit_channel_pool_size', 4))
+RECONNECT_DELAY = float(os.getenv('rabbit_reconnect_delay', 1))
+MAX_RECONNECT_DELAY = float(os.getenv('rabbit_max_reconnect_delay', 30))
+SHUTDOWN_TIMEOUT = float(os.getenv('rabbit_shutdown_timeout', 10))
+# Messages waiting for a publisher channel; beyond it, e.g. during a broker outage, publish() fails at once
+MAX_PENDING = int(os.getenv('rabbit_max_pending', 10000))
+# bson keeps UUIDs and datetimes native from end to end; json is what older consumers understand
+AUDIT_ENCODING = os.getenv('audit_encoding', 'json').lower()
+AUDIT_SCHEMA_VERSION = 1
+CONTENT_TYPES = {"json": "application/json", "bson": "application/bson"}
+
+PUBLISH_DURATION = Histogram("rabbitmq_publish_duration_seconds", "Time from basic_publish to broker confirm", buckets=DEFAULT_BUCKETS, registry=registry)
+PUBLISH_WAIT = Histogram("rabbitmq_publish_queue_seconds", "Time a message waited for a free publisher channel", buckets=DEFAULT_BUCKETS, registry=registry)
+PUBLISHED = Counter("rabbitmq_published_total", "Audit messages confirmed by the broker", registry=registry)
+PUBLISH_FAILURES = Counter("rabbitmq_publish_failures_total", "Audit messages the broker rejected or that could not be sent", registry=registry)
+
+def encodeSpecialFields(value):
+    """A JSON-ready copy with Binary UUIDs and datetimes as strings; the input is left untouched."""
+    if isinstance(value, dict):
+        return {key: encodeSpecialFields(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [encodeSpecialFields(item) for item in value]
+    if isinstance(value, Binary):
+        return str(uuid.UUID(bytes=value))
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+class PublishQueueFull(Exception):
+    pass
+
+
+class RabbitMQPublisher:
+    """Long-lived publisher that keeps connections open for the lifetime of the app.
+
+    pika connections are not thread safe, so every worker thread owns one
+    connection and one confirm-mode channel; together they form the channel
+    pool. Routes only enqueue messages, the event loop never touches the socket.
+    """
+    def __init__(self, connectionParameters, poolSize=CHANNEL_POOL_SIZE, maxPending=MAX_PENDING):
+        self.connectionParameters = connectionParameters
+        self.poolSize = poolSize
+        self.__pending = queue.Queue(maxPending)
+        self.__workers = []
+        self.__stopping = threading.Event()
+        self.published = 0
+        self.failed = 0
+        self.reconnects = 0
+
+    @property
+    def running(self):
+        return any(worker.is_alive() for worker in self.__workers)
+
+    @property
+    def backlog(self):
+        return self.__pending.qsize()
+
+    def start(self):
+        if self.running:
+            return
+        self.__stopping.clear()
+        self.__workers = [
+            threading.Thread(target=self.__work, name=f"rabbitmq-publisher-{i}", daemon=True)
+            for i in range(self.poolSize)
+        ]
+        for worker in self.__workers:
+            worker.start()
+
+    def stop(self, timeout=SHUTDOWN_TIMEOUT):
+        """Flush every pending message, then close the pool."""
+        self.__stopping.set()
+        for _ in self.__workers:
+            self.__pending.put(None)
+
+        deadline = time.monotonic() + timeout
+        for worker in self.__workers:
+            worker.join(max(0, deadline - time.monotonic()))
+        self.__workers = []
+
+    def publish(self, body, properties=None) -> Future:
+        """Enqueue a message; the returned future resolves once the broker confirms it.
+
+        Cancelling the future before a worker picks the message up withdraws it.
+        When MAX_PENDING messages are already waiting the future fails with
+        PublishQueueFull right away, so an outage cannot grow the queue without bound.
+        """
+        future = Future()
+        try:
+            self.__pending.put_nowait((body, properties, future, time.perf_counter()))
+        except queue.Full:
+            self.failed += 1
+            PUBLISH_FAILURES.inc()
+            future.set_exception(PublishQueueFull(f"{self.backlog} audit messages are already waiting for the broker"))
+        return future
+
+    def __connect(self):
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                connection = pika.BlockingConnection(self.connectionParameters())
+                channel = connection.channel()
+                channel.queue_declare(queue=QUEUE_NAME, durable=True)
+                channel.confirm_delivery()
+                return connection, channel
+            except pika.exceptions.AMQPConnectionError:
+                if self.__stopping.is_set():
+                    return None, None
+                self.reconnects += 1
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def __work(self):
+        connection, channel = None, None
+        while True:
+            item = self.__pending.get()
+            if item is None:
+                break
+
+            body, properties, future, queuedAt = item
+            PUBLISH_WAIT.observe(time.perf_counter() - queuedAt)
+            if not future.set_running_or_notify_cancel():
+                continue # Withdrawn by the caller while it waited, e.g. an outbox batch that timed out
+            try:
+                connection, channel = self.__publish(connection, channel, body, properties, future)
+            except Exception as exc:
+                # Anything unexpected fails this message only; the worker starts over on a fresh connection
+                print(f"RabbitMQ publisher error: {exc!r}")
+                self.failed += 1
+                PUBLISH_FAILURES.inc()
+                if not future.done():
+                    future.set_exception(exc)
+                self.__close(connection)
+                connection, channel = None, None
+
+        self.__close(connection)
+
+    def __publish(self, connection, channel, body, properties, future):
+        """Publish one message and settle its future; returns the connection and channel to keep using."""
+        while True:
+            if channel is None or channel.is_closed:
+                connection, channel = self.__connect()
+                if channel is None:
+                    self.failed += 1
+                    PUBLISH_FAILURES.inc()
+                    future.set_exception(pika.exceptions.AMQPConnectionError("Publisher stopped"))
+                    return connection, channel
+            try:
+                started = time.perf_counter()
+                channel.basic_publish(
+                    exchange='',
+                    routing_key=QUEUE_NAME,
+                    body=body,
+                    properties=properties or pika.BasicProperties(delivery_mode=2),
+                    mandatory=True
+                )
+                PUBLISH_DURATION.observe(time.perf_counter() - started)
+                PUBLISHED.inc()
+                self.published += 1
+                future.set_result(True)
+                return connection, channel
+            except (pika.exceptions.UnroutableError, pika.exceptions.NackError) as exc:
+                self.failed += 1
+                PUBLISH_FAILURES.inc()
+                future.set_exception(exc)
+                return connection, channel
+            except pika.exceptions.AMQPError:
+                # Connection dropped mid-publish, reconnect and retry the same message
+                self.__close(connection)
+                connection, channel = None, None
+
+    def __close(self, connection):
+        try:
+            if connection is not None and connection.is_open:
+                connection.close()
+        except Exception:
+            pass
+
+
+def connectionParameters():
+    return pika.ConnectionParameters(
+        host=ip,
+        port=5672,
+        virtual_host='/',
+        credentials=pika.PlainCredentials(username, password)
     )
-    channel = connection.channel()
-    
-    channel.queue_declare(queue='order_audit_log', durable=True)
-    
-    message = json.dumps(orderData)
-    channel.basic_publish(
-        exchange='',
-        routing_key='order_audit_log',
-        body=message,
-        properties=pika.BasicProperties(
-            delivery_mode=2,
-        )
+
+publisher = RabbitMQPublisher(connectionParameters)
+Gauge("rabbitmq_publish_backlog", "Audit messages waiting to be published", registry=registry).set_function(lambda: publisher.backlog)
+
+def auditEvent(orderData: dict):
+    """The order stamped with eventAt, the time of the write it records: its deletion, last update or creation."""
+    if orderData.get("eventAt") is not None:
+        return orderData
+    return orderData | {"eventAt": orderData.get("deletedAt") or orderData.get("updatedAt") or orderData.get("createdAt") or datetime.utcnow()}
+
+
+def auditMessage(orderData: dict, encoding=AUDIT_ENCODING):
+    if encoding == "bson":
+        return bson.encode(auditEvent(orderData))
+    return json.dumps(encodeSpecialFields(auditEvent(orderData)))
+
+
+def auditMessages(orders: list, encoding=AUDIT_ENCODING):
+    """Many audit events as one message: a JSON array, or a BSON document holding them under `events`."""
+    if encoding == "bson":
+        return bson.encode({"events": [auditEvent(orderData) for orderData in orders]})
+    return json.dumps([encodeSpecialFields(auditEvent(orderData)) for orderData in orders])
+
+
+def auditProperties(messageId=None, contentType=CONTENT_TYPES.get(AUDIT_ENCODING)):
+    # The consumer picks the decoder from content_type and rejects schema versions it does not know
+    return pika.BasicProperties(
+        delivery_mode=2,
+        message_id=messageId or str(uuid.uuid4()),
+        content_type=contentType,
+        headers={"schema_version": AUDIT_SCHEMA_VERSION}
     )
-    
-    connection.close()
\ No newline at end of file
+
+
+def publishMessage(orderData: dict) -> Future:
+    return publisher.publish(auditMessage(orderData), auditProperties())
+
+
+def publishMessages(orders: list) -> Future:
+    return publisher.publish(auditMessages(orders), auditProperties())
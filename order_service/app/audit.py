@@ -0,0 +1,165 @@
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse, Response
+from bson import Binary, ObjectId
+from bson.errors import InvalidId
+from typing import Optional
+from uuid import UUID
+from datetime import datetime, timezone
+import base64
+import json
+import os
+
+from app.MongoDB import auditdb
+from .models import AuditPage
+from .indexes import AUDIT_SORT
+from .encoding import dumps
+from .pagination import MAX_PAGE_SIZE, STREAM_BATCH_SIZE
+
+# Must match the consumer's audit_storage: one document per event, or hourly buckets
+AUDIT_STORAGE = os.getenv('audit_storage', 'documents').lower()
+DEFAULT_AUDIT_PAGE_SIZE = int(os.getenv('audit_page_size', 100))
+
+router = APIRouter(prefix="/order/audit", tags=["Audit"])
+
+
+def encodeAuditCursor(event):
+    eventAt, id = event["eventAt"], event["_id"]
+    position = {
+        "eventAt": eventAt.isoformat() if isinstance(eventAt, datetime) else eventAt,
+        "native": isinstance(eventAt, datetime),
+        "_id": str(id),
+        "objectId": isinstance(id, ObjectId)
+    }
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decodeAuditCursor(cursor):
+    """The (eventAt, _id) of the cursor, in the types they were stored with.
+
+    eventAt is a datetime for BSON events and a string for JSON ones; _id is
+    an ObjectId for legacy events inserted without a message id, else a string.
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        eventAt = datetime.fromisoformat(position["eventAt"])
+        id = ObjectId(position["_id"]) if position.get("objectId") else str(position["_id"])
+        return eventAt if position.get("native") else position["eventAt"], id
+    except (ValueError, KeyError, TypeError, InvalidId):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def naiveUtc(moment):
+    # Events carry naive UTC timestamps, so offsets are folded in before comparing
+    if moment is None or moment.tzinfo is None:
+        return moment
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def auditQuery(orderId=None, customerId=None, since=None, until=None, cursor=None):
+    """Event filter matching both message encodings.
+
+    Events are placed in time by eventAt, when the write they record happened,
+    not by the order's createdAt. JSON events store ids and timestamps as
+    strings, BSON events as Binary UUIDs and dates. Mongo never compares across
+    types, and sorts every string before every date, so the older JSON events
+    come first. Likewise legacy ObjectId _ids sort after the string ones within
+    the same eventAt.
+    """
+    conditions = []
+    if orderId is not None:
+        conditions.append({"id": {"$in": [str(orderId), Binary.from_uuid(orderId)]}})
+    if customerId is not None:
+        conditions.append({"customerId": {"$in": [str(customerId), Binary.from_uuid(customerId)]}})
+    if since is not None or until is not None:
+        native, text = {}, {}
+        if since is not None:
+            native["$gte"], text["$gte"] = since, since.isoformat()
+        if until is not None:
+            native["$lte"], text["$lte"] = until, until.isoformat()
+        conditions.append({"$or": [{"eventAt": text}, {"eventAt": native}]})
+
+    if cursor is not None:
+        eventAt, id = decodeAuditCursor(cursor)
+        after = [
+            {"eventAt": {"$gt": eventAt}},
+            {"eventAt": eventAt, "_id": {"$gt": id}}
+        ]
+        if not isinstance(eventAt, datetime):
+            after.append({"eventAt": {"$type": "date"}})
+        if not isinstance(id, ObjectId):
+            after.append({"eventAt": eventAt, "_id": {"$type": "objectId"}})
+        conditions.append({"$or": after})
+
+    if len(conditions) > 1:
+        return {"$and": conditions}
+    return conditions[0] if conditions else {}
+
+
+def bucketQuery(orderId=None, customerId=None, since=None, until=None, cursor=None):
+    """Narrows the hourly buckets to those that can hold a matching event."""
+    query = {}
+    if orderId is not None:
+        query["events.id"] = {"$in": [str(orderId), Binary.from_uuid(orderId)]}
+    if customerId is not None:
+        query["events.customerId"] = {"$in": [str(customerId), Binary.from_uuid(customerId)]}
+
+    if cursor is not None:
+        eventAt = decodeAuditCursor(cursor)[0]
+        since = max(since or datetime.min, eventAt if isinstance(eventAt, datetime) else datetime.fromisoformat(eventAt))
+    if since is not None or until is not None:
+        query["hour"] = {}
+        if since is not None:
+            query["hour"]["$gte"] = since.replace(minute=0, second=0, microsecond=0)
+        if until is not None:
+            query["hour"]["$lte"] = until
+    return query
+
+
+def auditEvents(limit=None, **filters):
+    """A cursor over the matching events in (eventAt, _id) order, in either storage layout."""
+    if AUDIT_STORAGE == 'buckets':
+        pipeline = [
+            {"$match": bucketQuery(**filters)},
+            {"$unwind": "$events"},
+            {"$replaceRoot": {"newRoot": "$events"}},
+            {"$match": auditQuery(**filters)},
+            {"$sort": dict(AUDIT_SORT)}
+        ]
+        if limit:
+            pipeline.append({"$limit": limit})
+        return auditdb.collections["AuditLogHourly"].aggregate(pipeline, allowDiskUse=True, batchSize=STREAM_BATCH_SIZE)
+
+    events = auditdb.collections["AuditLog"].find(auditQuery(**filters)).sort(AUDIT_SORT).batch_size(STREAM_BATCH_SIZE)
+    return events.limit(limit) if limit else events
+
+
+async def streamEvents(events):
+    async for event in events:
+        yield dumps(event) + b"\n"
+
+
+@router.get("/", response_model=AuditPage)
+async def getAudit(
+    orderId: Optional[UUID] = None,
+    customerId: Optional[UUID] = None,
+    since: Optional[datetime] = Query(None, alias="from"),
+    until: Optional[datetime] = Query(None, alias="to"),
+    limit: int = Query(DEFAULT_AUDIT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False
+):
+    """Audit events by order, customer and time range, one keyset page at a time or as an NDJSON stream."""
+    if auditdb is None:
+        raise HTTPException(status_code=503, detail="Audit log is not configured")
+
+    filters = {"orderId": orderId, "customerId": customerId, "since": naiveUtc(since), "until": naiveUtc(until), "cursor": cursor}
+    if stream:
+        return StreamingResponse(streamEvents(auditEvents(**filters)), media_type="application/x-ndjson")
+
+    events = await auditEvents(limit + 1, **filters).to_list(length=limit + 1)
+    page = {
+        "items": events[:limit],
+        "nextCursor": encodeAuditCursor(events[limit - 1]) if len(events) > limit else None
+    }
+    # Encoded directly, BSON events hold Binary UUIDs and datetimes
+    return Response(dumps(page), media_type="application/json")
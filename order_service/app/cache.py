@@ -0,0 +1,75 @@
+from collections import OrderedDict
+import time
+import os
+
+from prometheus_client.core import CounterMetricFamily
+
+from .Metrics import Gauge, registry
+
+CUSTOMER_CACHE_SIZE = int(os.getenv('customer_cache_size', 10000))
+CUSTOMER_CACHE_TTL = float(os.getenv('customer_cache_ttl', 60))
+
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries also expire after `ttl` seconds."""
+    def __init__(self, maxSize, ttl):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.__entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.__entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self.__entries[key]
+            self.misses += 1
+            return None
+
+        self.__entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value):
+        if self.maxSize <= 0:
+            return
+        self.__entries[key] = (value, time.monotonic() + self.ttl)
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.maxSize:
+            self.__entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        return self.__entries.pop(key, None) is not None
+
+    def clear(self):
+        self.__entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self.__entries),
+            "maxSize": self.maxSize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+class CacheLookups:
+    """Exports a cache's hit and miss counts as a counter, read at scrape time."""
+    def __init__(self, cache):
+        self.cache = cache
+
+    def collect(self):
+        lookups = CounterMetricFamily("customer_address_cache_lookups", "Customer address cache lookups since start", labels=("result",))
+        lookups.add_metric(("hit",), self.cache.hits)
+        lookups.add_metric(("miss",), self.cache.misses)
+        yield lookups
+
+
+customerAddresses = TTLCache(CUSTOMER_CACHE_SIZE, CUSTOMER_CACHE_TTL)
+registry.register(CacheLookups(customerAddresses))
+Gauge("customer_address_cache_entries", "Customer addresses currently cached", registry=registry).set_function(lambda: customerAddresses.stats()["size"])
@@ -0,0 +1,193 @@
+from fastapi import APIRouter, HTTPException
+from typing import Literal, Optional
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from bson import Binary
+from uuid import UUID
+import asyncio
+import socket
+import uuid
+import os
+
+from app.MongoDB import mongodb
+from .models import CascadeJob
+from .Metrics import Counter, registry
+from .RabbitMQ import publishMessages, auditMessages
+from .outbox import OUTBOX_MODE, outboxRecord, relay
+
+# delete drops a deleted customer's orders; archive copies them to ordersArchive first
+CASCADE_MODE = os.getenv('order_cascade_mode', 'delete').lower()
+CASCADE_BATCH_SIZE = int(os.getenv('cascade_batch_size', 500))
+CASCADE_POLL_INTERVAL = float(os.getenv('cascade_poll_interval', 5))
+CASCADE_LEASE_TTL = float(os.getenv('cascade_lease_ttl', 60))
+# Pause between batches, so a large cascade leaves room for the request traffic on the same database
+CASCADE_BATCH_PAUSE = float(os.getenv('cascade_batch_pause', 0.05))
+DUPLICATE_KEY = 11000
+
+CASCADE_DELETED = Counter("cascade_deleted_orders_total", "Orders removed by customer cascade jobs", registry=registry)
+CASCADE_JOBS = Counter("cascade_jobs_total", "Customer cascade jobs by outcome", ("status",), registry=registry)
+
+router = APIRouter(prefix="/order/cascade", tags=["Cascade"])
+
+
+class CascadeWorker:
+    """Removes the orders of deleted customers in the background, one job per customer.
+
+    Jobs live in `jobs`, keyed by the customer's Binary id, so their progress
+    survives restarts and is visible from every instance. A worker claims a job
+    with a lease it renews after every batch; a job whose lease ran out is
+    picked up again. Every batch is idempotent: it only removes the orders it
+    just read, and archiving tolerates orders that were already copied.
+    """
+    def __init__(self, jobs, orders, archive, outbox, batchSize=CASCADE_BATCH_SIZE, interval=CASCADE_POLL_INTERVAL,
+                 leaseTtl=CASCADE_LEASE_TTL, pause=CASCADE_BATCH_PAUSE, mode=CASCADE_MODE):
+        self.jobs = jobs
+        self.orders = orders
+        self.archive = archive
+        self.outbox = outbox
+        self.batchSize = batchSize
+        self.interval = interval
+        self.leaseTtl = leaseTtl
+        self.pause = pause
+        self.mode = mode
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.__wake = asyncio.Event()
+        self.__task = None
+
+    def start(self):
+        if self.__task is None:
+            self.__task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+
+    def wake(self):
+        self.__wake.set()
+
+    async def enqueue(self, customerId, mode=None):
+        """Queue (or re-queue) the cascade for a customer; a job that is already running is left to finish."""
+        now = datetime.utcnow()
+        try:
+            await self.jobs.update_one(
+                {"_id": Binary.from_uuid(customerId), "status": {"$ne": "running"}},
+                {"$set": {"status": "queued", "mode": mode or self.mode, "queuedAt": now, "error": None},
+                 "$setOnInsert": {"total": 0, "deleted": 0, "batches": 0}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            pass # Running; it deletes whatever belongs to the customer when it gets there
+        self.wake()
+        return await self.jobs.find_one({"_id": Binary.from_uuid(customerId)})
+
+    async def claim(self):
+        now = datetime.utcnow()
+        return await self.jobs.find_one_and_update(
+            {"$or": [{"status": "queued"}, {"status": "running", "leaseExpiresAt": {"$lt": now}}]},
+            {"$set": {"status": "running", "owner": self.owner, "startedAt": now,
+                      "leaseExpiresAt": now + timedelta(seconds=self.leaseTtl)}},
+            sort=[("queuedAt", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def archiveOrders(self, orders, session=None):
+        try:
+            await self.archive.insert_many(orders, ordered=False, session=session)
+        except BulkWriteError as exc:
+            # Copied by an earlier attempt at this batch
+            if any(error["code"] != DUPLICATE_KEY for error in exc.details["writeErrors"]):
+                raise
+
+    async def runBatch(self, job):
+        """Remove the next batch of the customer's orders with one delete_many and audit them as one message."""
+        orders = await self.orders.find({"customerId": job["_id"]}, {"_id": 0}).limit(self.batchSize).to_list(length=self.batchSize)
+        if not orders:
+            return 0
+
+        now = datetime.utcnow()
+        events = [order | {"deletedAt": now} for order in orders]
+        async with mongodb.transaction() if OUTBOX_MODE else nullcontext() as session:
+            if (job.get("mode") or self.mode) == "archive":
+                await self.archiveOrders([order | {"archivedAt": now} for order in orders], session)
+            deleted = (await self.orders.delete_many({"id": {"$in": [order["id"] for order in orders]}}, session=session)).deleted_count
+            if OUTBOX_MODE:
+                await self.outbox.insert_one(outboxRecord(auditMessages(events)), session=session)
+        if OUTBOX_MODE:
+            relay.wake()
+        else:
+            publishMessages(events) # RabbitMQ, one message per batch
+
+        await self.jobs.update_one({"_id": job["_id"], "owner": self.owner}, {
+            "$inc": {"deleted": deleted, "batches": 1},
+            "$set": {"updatedAt": now, "leaseExpiresAt": now + timedelta(seconds=self.leaseTtl)}
+        })
+        CASCADE_DELETED.inc(deleted)
+        return len(orders)
+
+    async def runJob(self, job):
+        total = await self.orders.count_documents({"customerId": job["_id"]})
+        await self.jobs.update_one({"_id": job["_id"]}, {"$set": {"total": job.get("deleted", 0) + total}})
+        try:
+            while await self.runBatch(job):
+                await asyncio.sleep(self.pause)
+        except asyncio.CancelledError:
+            raise # Another instance takes over once the lease runs out
+        except Exception as exc:
+            await self.jobs.update_one({"_id": job["_id"]}, {"$set": {"status": "failed", "error": str(exc), "finishedAt": datetime.utcnow()}})
+            CASCADE_JOBS.labels("failed").inc()
+            return
+
+        await self.jobs.update_one({"_id": job["_id"], "owner": self.owner}, {"$set": {"status": "done", "finishedAt": datetime.utcnow()}})
+        CASCADE_JOBS.labels("done").inc()
+
+    async def run(self):
+        while True:
+            job = None
+            try:
+                job = await self.claim()
+                if job is not None:
+                    await self.runJob(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                print(f"Cascade worker error: {exc}")
+
+            if job is None:
+                try:
+                    await asyncio.wait_for(self.__wake.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.__wake.clear()
+
+
+cascade = CascadeWorker(mongodb.collections["cascadeJobs"], mongodb.collections["orders"],
+                        mongodb.collections["ordersArchive"], mongodb.collections["outbox"])
+
+
+def jobStatus(job):
+    return CascadeJob(**job | {
+        "customerId": UUID(bytes=job["_id"]),
+        "mode": job.get("mode") or cascade.mode, # Jobs queued by customer_service take the workers' default
+        "progress": min(1, job["deleted"] / job["total"]) if job.get("total") else float(job["status"] == "done")
+    })
+
+
+@router.post("/{customerId}", response_model=CascadeJob, status_code=202)
+async def queueCascade(customerId: UUID, mode: Optional[Literal["delete", "archive"]] = None):
+    """Queue the removal of a customer's orders; customer_service calls this when a customer is deleted."""
+    return jobStatus(await cascade.enqueue(customerId, mode))
+
+
+@router.get("/{customerId}", response_model=CascadeJob)
+async def getCascade(customerId: UUID):
+    job = await cascade.jobs.find_one({"_id": Binary.from_uuid(customerId)})
+    if job is None:
+        raise HTTPException(status_code=404, detail="No cascade for this customer")
+    return jobStatus(job)
@@ -0,0 +1,56 @@
+from bson import Binary, ObjectId
+from pydantic import BaseModel
+from datetime import datetime
+from typing import get_args
+from uuid import UUID
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Encode list responses straight from the Motor documents instead of validating them into models first
+FAST_RESPONSES = os.getenv('fast_responses', 'false').lower() in ('1', 'true', 'yes')
+
+
+def encodeSpecial(value):
+    """Called by the encoder only for the types JSON has no form for."""
+    if isinstance(value, Binary):
+        return str(UUID(bytes=value))
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, UUID):
+        return str(value)
+    if isinstance(value, ObjectId):
+        return str(value) # _id of audit events stored before messages carried an id
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    def dumps(value) -> bytes:
+        return orjson.dumps(value, default=encodeSpecial)
+else:
+    def dumps(value) -> bytes:
+        return json.dumps(value, default=encodeSpecial, separators=(",", ":")).encode()
+
+
+def nestedModel(annotation):
+    """The model a field holds, also inside Optional[...] or List[...]; None for plain values."""
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return annotation
+    return next((model for model in map(nestedModel, get_args(annotation)) if model is not None), None)
+
+
+def modelPaths(model, prefix=""):
+    paths = []
+    for name, field in model.model_fields.items():
+        nested = nestedModel(field.annotation)
+        paths += modelPaths(nested, f"{prefix}{name}.") if nested is not None else [f"{prefix}{name}"]
+    return paths
+
+
+def projection(model):
+    """Only the model's fields, down into sub-documents, so the output matches what response_model would have produced."""
+    return {"_id": 0} | {path: 1 for path in modelPaths(model)}
@@ -0,0 +1,65 @@
+from fastapi import HTTPException
+from pydantic import BaseModel
+from pymongo import ASCENDING, DESCENDING
+from typing import Literal
+from datetime import datetime
+
+from .models import Order
+from .indexes import keysetSort
+from .audit import naiveUtc
+
+# A leading - sorts descending
+OrderSort = Literal["createdAt", "-createdAt", "updatedAt", "-updatedAt", "price", "-price"]
+
+
+def modelFields(model, prefix=""):
+    """Every field path of the model, nested models included, as dotted Mongo paths."""
+    for name, field in model.model_fields.items():
+        yield prefix + name
+        if isinstance(field.annotation, type) and issubclass(field.annotation, BaseModel):
+            yield from modelFields(field.annotation, f"{prefix}{name}.")
+
+
+ORDER_FIELDS = set(modelFields(Order))
+
+
+def selectFields(fields):
+    """?fields=id,status,address.city as projection paths; None selects everything.
+
+    A path inside one that is already selected is dropped, Mongo rejects the pair.
+    """
+    if fields is None:
+        return None
+
+    paths = list(dict.fromkeys(path.strip() for path in fields.split(",") if path.strip()))
+    unknown = [path for path in paths if path not in ORDER_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return [path for path in paths if not any(path.startswith(f"{other}.") for other in paths)] or None
+
+
+def orderQuery(query, status=None, ranges={}, sort=None):
+    """Add the list filters to query and return it with the keyset sort to read it in.
+
+    Only one field can be ranged, and it is also the sort field. Every accepted
+    combination then reads a single index in order: customerId and/or status,
+    then the sort field, then id. Nothing is scanned or sorted in memory.
+    """
+    ranges = {field: bounds for field, bounds in ranges.items() if bounds != (None, None)}
+    if len(ranges) > 1:
+        raise HTTPException(status_code=400, detail="Only one of the createdAt, updatedAt and price ranges can be used at a time")
+
+    ranged = next(iter(ranges), None)
+    field = sort.lstrip("-") if sort else ranged
+    if ranged is not None and ranged != field:
+        raise HTTPException(status_code=400, detail=f"A {ranged} range can only be sorted by {ranged}")
+
+    if status is not None:
+        query = query | {"status": status}
+    if ranged is not None:
+        low, high = (naiveUtc(bound) if isinstance(bound, datetime) else bound for bound in ranges[ranged])
+        query = query | {ranged: {operator: bound for operator, bound in (("$gte", low), ("$lte", high)) if bound is not None}}
+
+    if field is None:
+        return query, None
+    return query, keysetSort(field, DESCENDING if sort and sort.startswith("-") else ASCENDING)
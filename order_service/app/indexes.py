@@ -0,0 +1,126 @@
+from pymongo import IndexModel, ASCENDING, DESCENDING
+from bson import Binary
+from uuid import uuid4
+from datetime import datetime
+
+# Indexes this service owns; customers are declared by customer_service
+INDEXES = {
+    "orders": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id"),
+        # Order lists: equality on customerId or status, then the sort field, which is also the only ranged one
+        IndexModel([("customerId", ASCENDING), ("createdAt", ASCENDING), ("id", ASCENDING)], name="customerId_createdAt_id"),
+        IndexModel([("customerId", ASCENDING), ("updatedAt", ASCENDING), ("id", ASCENDING)], name="customerId_updatedAt_id"),
+        IndexModel([("customerId", ASCENDING), ("price", ASCENDING), ("id", ASCENDING)], name="customerId_price_id"),
+        IndexModel([("status", ASCENDING), ("createdAt", ASCENDING), ("id", ASCENDING)], name="status_createdAt_id"),
+        IndexModel([("status", ASCENDING), ("updatedAt", ASCENDING), ("id", ASCENDING)], name="status_updatedAt_id"),
+        IndexModel([("status", ASCENDING), ("price", ASCENDING), ("id", ASCENDING)], name="status_price_id"),
+        IndexModel([("createdAt", ASCENDING), ("id", ASCENDING)], name="createdAt_id"),
+        IndexModel([("updatedAt", ASCENDING), ("id", ASCENDING)], name="updatedAt_id"),
+        IndexModel([("price", ASCENDING), ("id", ASCENDING)], name="price_id"),
+        IndexModel([("statusTransition.id", ASCENDING)], name="statusTransition.id", sparse=True)
+    ],
+    "cascadeJobs": [
+        IndexModel([("status", ASCENDING), ("queuedAt", ASCENDING)], name="status_queuedAt")
+    ],
+    "ordersArchive": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id"),
+        IndexModel([("customerId", ASCENDING), ("createdAt", ASCENDING)], name="customerId_createdAt")
+    ],
+    "outbox": [
+        IndexModel([("createdAt", ASCENDING)], name="createdAt")
+    ],
+    # Rollup buckets are keyed {customerId, status, day}; the consumer maintains them
+    "orderRollups": [
+        IndexModel([("_id.customerId", ASCENDING), ("_id.day", ASCENDING)], name="customerId_day"),
+        IndexModel([("_id.day", ASCENDING)], name="day")
+    ]
+}
+
+# The audit database is written by rabbitmq_consumer; these indexes back the audit read API
+AUDIT_INDEXES = {
+    "AuditLog": [
+        IndexModel([("id", ASCENDING), ("eventAt", ASCENDING), ("_id", ASCENDING)], name="id_eventAt__id"),
+        IndexModel([("customerId", ASCENDING), ("eventAt", ASCENDING), ("_id", ASCENDING)], name="customerId_eventAt__id"),
+        IndexModel([("eventAt", ASCENDING), ("_id", ASCENDING)], name="eventAt__id")
+    ],
+    "AuditLogHourly": [
+        IndexModel([("events.id", ASCENDING), ("hour", ASCENDING)], name="events.id_hour"),
+        IndexModel([("events.customerId", ASCENDING), ("hour", ASCENDING)], name="events.customerId_hour")
+    ]
+}
+
+# Fields order lists can be sorted and range-filtered on
+SORT_FIELDS = ("createdAt", "updatedAt", "price")
+
+
+def keysetSort(field="createdAt", direction=ASCENDING):
+    """Sort on field with id as the tie-breaker; descending walks the same index backwards."""
+    return [(field, direction), ("id", direction)]
+
+
+KEYSET_SORT = keysetSort()
+AUDIT_SORT = [("eventAt", ASCENDING), ("_id", ASCENDING)]
+
+# (route, collection, filter, sort) for every indexed query the routes issue.
+# Unpaged getAll without filters is a full scan by design and is not listed.
+QUERY_SHAPES = [
+    ("create/update customer lookup", "customers", {"id": Binary.from_uuid(uuid4())}, None),
+    ("update/delete/getByOrder/changeStatus", "orders", {"id": Binary.from_uuid(uuid4())}, None),
+    ("getByCustomer", "orders", {"customerId": Binary.from_uuid(uuid4())}, None),
+    ("getByCustomer paged", "orders", {"customerId": Binary.from_uuid(uuid4())}, KEYSET_SORT),
+    ("getAll paged", "orders", {}, KEYSET_SORT),
+    ("bulk status by ids", "orders", {"id": {"$in": [Binary.from_uuid(uuid4())]}, "status": "pending"}, None),
+    ("bulk status by customer", "orders", {"customerId": Binary.from_uuid(uuid4()), "status": "pending"}, None),
+    ("bulk status by status", "orders", {"status": "pending", "createdAt": {"$lt": datetime(2024, 1, 1)}}, None),
+    ("bulk status transitioned orders", "orders", {"statusTransition.id": str(uuid4())}, None),
+    ("outbox relay", "outbox", {}, [("createdAt", ASCENDING)]),
+    ("cascade claim", "cascadeJobs", {"status": "queued"}, [("queuedAt", ASCENDING)]),
+    ("stats by customer", "orderRollups", {"_id.customerId": Binary.from_uuid(uuid4())}, None),
+    ("stats by day", "orderRollups", {"_id.day": {"$gte": "2024-01-01"}}, None)
+] + [
+    # Every filter combination getAll and getByCustomer accept, in both sort directions
+    (f"{route} by {field}{' desc' if direction == DESCENDING else ''}", "orders", scope | {field: {"$gte": start}}, keysetSort(field, direction))
+    for route, scope in (
+        ("list", {}),
+        ("list by status", {"status": "pending"}),
+        ("getByCustomer", {"customerId": Binary.from_uuid(uuid4())}),
+        ("getByCustomer by status", {"customerId": Binary.from_uuid(uuid4()), "status": "pending"})
+    )
+    for field, start in (("createdAt", datetime(2024, 1, 1)), ("updatedAt", datetime(2024, 1, 1)), ("price", 10.0))
+    for direction in (ASCENDING, DESCENDING)
+]
+
+
+AUDIT_QUERY_SHAPES = [
+    ("audit by order", "AuditLog", {"id": str(uuid4())}, AUDIT_SORT),
+    ("audit by customer", "AuditLog", {"customerId": str(uuid4())}, AUDIT_SORT),
+    ("audit by time", "AuditLog", {"eventAt": {"$gte": "2024-01-01T00:00:00"}}, AUDIT_SORT),
+    ("audit buckets by order", "AuditLogHourly", {"events.id": str(uuid4())}, None),
+    ("audit buckets by customer", "AuditLogHourly", {"events.customerId": str(uuid4())}, None)
+]
+
+
+def planStages(plan):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from planStages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from planStages(value)
+
+
+async def findCollectionScans(mongodb, shapes=QUERY_SHAPES):
+    """Run explain() for every route query and return the routes whose winning plan
+    is a COLLSCAN, or that sort in memory instead of reading an index in order."""
+    scans = []
+    for route, collection, query, sort in shapes:
+        cursor = mongodb.collections[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        stages = set(planStages(explain["queryPlanner"]["winningPlan"]))
+        if "COLLSCAN" in stages or (sort and "SORT" in stages):
+            scans.append(route)
+    return scans
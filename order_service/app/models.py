@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, model_validator
+from typing import Optional, List
 from uuid import UUID
 from datetime import datetime
 
@@ -30,4 +30,61 @@ class UpdateOrder(BaseModel):
     quantity: int
     price: float
     status: str
-    product: Product
\ No newline at end of file
+    product: Product
+
+class OrderPage(BaseModel):
+    items: List[Order]
+    nextCursor: Optional[str] = None
+
+class BulkOrderResult(BaseModel):
+    index: int
+    id: Optional[UUID] = None
+    error: Optional[str] = None
+
+class OrderStats(BaseModel):
+    customerId: Optional[UUID] = None
+    status: Optional[str] = None
+    day: Optional[str] = None
+    count: int
+    quantity: int
+    revenue: float
+
+class AuditPage(BaseModel):
+    items: List[dict]
+    nextCursor: Optional[str] = None
+
+class StatusFilter(BaseModel):
+    customerId: Optional[UUID] = None
+    status: Optional[str] = None
+    createdBefore: Optional[datetime] = None
+
+class BulkStatusChange(BaseModel):
+    status: str
+    ids: Optional[List[UUID]] = None
+    filter: Optional[StatusFilter] = None
+
+    @model_validator(mode="after")
+    def idsOrFilter(self):
+        if (self.ids is None) == (self.filter is None):
+            raise ValueError("Pass either ids or filter")
+        if self.filter is not None and not self.filter.model_dump(exclude_none=True):
+            raise ValueError("The filter needs at least one of customerId, status or createdBefore")
+        return self
+
+class BulkStatusResult(BaseModel):
+    transitionId: str
+    updated: int
+    skipped: List[UUID] = []
+
+class CascadeJob(BaseModel):
+    customerId: UUID
+    status: str
+    mode: str
+    total: int
+    deleted: int
+    batches: int
+    progress: float
+    error: Optional[str] = None
+    queuedAt: datetime
+    startedAt: Optional[datetime] = None
+    finishedAt: Optional[datetime] = None
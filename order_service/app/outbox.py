@@ -0,0 +1,142 @@
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from datetime import datetime, timedelta
+import asyncio
+import socket
+import uuid
+import time
+import os
+
+from app.MongoDB import mongodb
+from .Metrics import Counter, Gauge, Histogram, DEFAULT_BUCKETS, registry
+from .RabbitMQ import publisher, auditProperties, AUDIT_ENCODING, CONTENT_TYPES
+
+# With the outbox, creates write the audit event into Mongo with the order and a relay publishes it
+OUTBOX_MODE = os.getenv('audit_mode', 'direct').lower() == 'outbox'
+RELAY_BATCH_SIZE = int(os.getenv('outbox_batch_size', 500))
+RELAY_INTERVAL = float(os.getenv('outbox_poll_interval', 1))
+LEASE_TTL = float(os.getenv('outbox_lease_ttl', 15))
+# How long a batch waits for broker confirms; kept under the lease TTL so the lease cannot lapse mid-batch
+PUBLISH_TIMEOUT = float(os.getenv('outbox_publish_timeout', LEASE_TTL / 2))
+
+RELAYED = Counter("outbox_relayed_total", "Outbox records published and confirmed by the broker", registry=registry)
+RELAY_FAILURES = Counter("outbox_relay_failures_total", "Outbox records the broker did not confirm; they are retried", registry=registry)
+RELAY_BATCH_DURATION = Histogram("outbox_relay_batch_duration_seconds", "Time to publish and clear one outbox batch", buckets=DEFAULT_BUCKETS, registry=registry)
+
+
+def outboxRecord(body, messageId=None, contentType=CONTENT_TYPES.get(AUDIT_ENCODING)):
+    # The record id doubles as the message_id, which the consumer dedupes on
+    return {"_id": messageId or str(uuid.uuid4()), "body": body, "contentType": contentType, "createdAt": datetime.utcnow()}
+
+
+class OutboxRelay:
+    """Drains the outbox collection to RabbitMQ in batches, oldest record first.
+
+    A record is deleted only after the broker confirmed it, so a crash between
+    the two publishes it again; the consumer stores it once because the
+    message_id is the record id. With several order_service instances, a lease
+    in `leases` lets one relay run at a time.
+    """
+    def __init__(self, outbox, leases, publisher=publisher, batchSize=RELAY_BATCH_SIZE,
+                 interval=RELAY_INTERVAL, leaseTtl=LEASE_TTL, publishTimeout=PUBLISH_TIMEOUT):
+        self.outbox = outbox
+        self.leases = leases
+        self.publisher = publisher
+        self.batchSize = batchSize
+        self.interval = interval
+        self.leaseTtl = leaseTtl
+        self.publishTimeout = min(publishTimeout, leaseTtl / 2)
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.relayed = 0
+        self.failed = 0
+        self.lag = 0
+        self.__wake = asyncio.Event()
+        self.__task = None
+
+    def start(self):
+        if self.__task is None:
+            self.__task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+
+    def wake(self):
+        """Called after a commit so the record goes out without waiting for the next poll."""
+        self.__wake.set()
+
+    async def acquireLease(self):
+        now = datetime.utcnow()
+        try:
+            lease = await self.leases.find_one_and_update(
+                {"_id": "outboxRelay", "$or": [{"owner": self.owner}, {"expiresAt": {"$lt": now}}]},
+                {"$set": {"owner": self.owner, "expiresAt": now + timedelta(seconds=self.leaseTtl)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            return False # Held by another instance
+        return lease is not None and lease["owner"] == self.owner
+
+    async def drainOnce(self):
+        """Publish one batch and delete what the broker confirmed; returns the number confirmed."""
+        records = await self.outbox.find({}).sort([("createdAt", ASCENDING)]).limit(self.batchSize).to_list(length=self.batchSize)
+        self.lag = (datetime.utcnow() - records[0]["createdAt"]).total_seconds() if records else 0
+        if not records:
+            return 0
+
+        started = time.perf_counter()
+        futures = [
+            asyncio.wrap_future(self.publisher.publish(record["body"], auditProperties(record["_id"], record.get("contentType"))))
+            for record in records
+        ]
+        done, pending = await asyncio.wait(futures, timeout=self.publishTimeout)
+        for future in pending:
+            # The broker is down or slow; messages still queued are withdrawn and go out with a later batch
+            future.cancel()
+
+        confirmed = [
+            record["_id"] for record, future in zip(records, futures)
+            if future in done and future.exception() is None and future.result() is True
+        ]
+        if confirmed:
+            await self.outbox.delete_many({"_id": {"$in": confirmed}})
+        RELAY_BATCH_DURATION.observe(time.perf_counter() - started)
+
+        failed = len(records) - len(confirmed)
+        self.relayed += len(confirmed)
+        self.failed += failed
+        RELAYED.inc(len(confirmed))
+        RELAY_FAILURES.inc(failed)
+        return len(confirmed)
+
+    async def run(self):
+        while True:
+            confirmed = 0
+            try:
+                if await self.acquireLease():
+                    confirmed = await self.drainOnce()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                print(f"Outbox relay error: {exc}")
+
+            if confirmed < self.batchSize:
+                # Caught up, or the broker is rejecting; wait for the next poll or a fresh commit
+                try:
+                    await asyncio.wait_for(self.__wake.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.__wake.clear()
+
+    def stats(self):
+        return {"relayed": self.relayed, "failed": self.failed, "lagSeconds": self.lag}
+
+
+relay = OutboxRelay(mongodb.collections["outbox"], mongodb.collections["outboxLease"])
+Gauge("outbox_lag_seconds", "Age of the oldest unpublished outbox record at the last relay poll", registry=registry).set_function(lambda: relay.lag)
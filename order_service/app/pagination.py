@@ -0,0 +1,109 @@
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse, Response
+from bson import Binary
+from pymongo import ASCENDING
+from uuid import UUID
+from datetime import datetime
+import base64
+import json
+import os
+
+from .indexes import KEYSET_SORT
+from .encoding import FAST_RESPONSES, dumps, projection
+
+MAX_PAGE_SIZE = int(os.getenv('max_page_size', 1000))
+STREAM_BATCH_SIZE = int(os.getenv('stream_batch_size', 500))
+
+
+def encodeCursor(document, sort=KEYSET_SORT):
+    (field, direction), id = sort[0], document["id"]
+    value = document[field]
+    position = {
+        field: value.isoformat() if isinstance(value, datetime) else value,
+        "id": str(id if isinstance(id, UUID) else UUID(bytes=id))
+    }
+    if sort != KEYSET_SORT:
+        position["sort"] = [field, direction]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decodeCursor(cursor, sort=KEYSET_SORT):
+    """The (value, id) the cursor stopped at; it must come from a page with the same sort."""
+    field, direction = sort[0]
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if position.get("sort", ["createdAt", ASCENDING]) != [field, direction]:
+            raise ValueError("cursor from a different sort")
+        value = position[field]
+        if not isinstance(value, (str, int, float)):
+            raise TypeError("cursor value")
+        return datetime.fromisoformat(value) if isinstance(value, str) else value, Binary.from_uuid(UUID(position["id"]))
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def afterCursor(query, cursor, sort=KEYSET_SORT):
+    """Keyset condition on (sort field, id): everything strictly after the cursor position."""
+    if cursor is None:
+        return query
+
+    field, direction = sort[0]
+    value, id = decodeCursor(cursor, sort)
+    beyond = "$gt" if direction == ASCENDING else "$lt"
+    after = {"$or": [
+        {field: {beyond: value}},
+        {field: value, "id": {beyond: id}}
+    ]}
+    return {"$and": [query, after]} if query else after
+
+
+async def streamDocuments(cursor, model, fast=False):
+    async for document in cursor:
+        yield dumps(document) + b"\n" if fast else model(**document).model_dump_json() + "\n"
+
+
+async def paginate(collection, query, model, limit=None, cursor=None, stream=False, fast=None, sort=None, fields=None):
+    """Serve a find() as a full list, a keyset page or an NDJSON stream.
+
+    In fast mode the documents are encoded to JSON as they come from Motor,
+    skipping the response_model validation; the projection keeps the output
+    identical. Selecting fields always takes the fast path, since the partial
+    documents would not validate as the model. Pages fetch the sort field and id
+    for the cursor even when they were not selected, and drop them afterwards.
+    """
+    fast = True if fields else FAST_RESPONSES if fast is None else fast
+    if fields:
+        projected = {"_id": 0} | {field: 1 for field in fields}
+    else:
+        projected = projection(model) if fast else {"_id": 0}
+
+    if stream:
+        documents = collection.find(afterCursor(query, cursor, sort or KEYSET_SORT), projected).batch_size(STREAM_BATCH_SIZE)
+        if cursor is not None or sort:
+            documents = documents.sort(sort or KEYSET_SORT)
+        return StreamingResponse(streamDocuments(documents, model, fast), media_type="application/x-ndjson")
+
+    if limit is None and cursor is None:
+        documents = collection.find(query, projected)
+        if sort:
+            documents = documents.sort(sort)
+        documents = await documents.to_list(length=None)
+        return Response(dumps(documents), media_type="application/json") if fast else documents
+
+    sort = sort or KEYSET_SORT
+    limit = limit or MAX_PAGE_SIZE
+    unselected = []
+    if fields:
+        selected = {field.split(".")[0] for field in fields}
+        unselected = [field for field, _ in sort if field not in selected]
+        projected |= {field: 1 for field in unselected}
+    documents = await collection.find(afterCursor(query, cursor, sort), projected).sort(sort).limit(limit + 1).to_list(length=limit + 1)
+
+    page = {
+        "items": documents[:limit],
+        "nextCursor": encodeCursor(documents[limit - 1], sort) if len(documents) > limit else None
+    }
+    for document in page["items"]:
+        for field in unselected:
+            document.pop(field, None)
+    return Response(dumps(page), media_type="application/json") if fast else page
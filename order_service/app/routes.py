@@ -1,27 +1,64 @@
-from fastapi import APIRouter, HTTPException
-from typing import List
+from fastapi import APIRouter, HTTPException, Query, Body
+from typing import Annotated, List, Literal, Optional, Union
+from pymongo import UpdateMany
+from pymongo.errors import BulkWriteError
+from contextlib import nullcontext
+import os
 from bson import Binary
 from uuid import UUID, uuid4
-from datetime import datetime
+from datetime import datetime, date
 
 from app.MongoDB import mongodb
-from .models import Order, UpdateOrder
-from .RabbitMQ import publishMessage
+from .models import Order, OrderPage, UpdateOrder, BulkOrderResult, OrderStats, BulkStatusChange, BulkStatusResult
+from .transitions import sourcesOf
+from .pagination import paginate, MAX_PAGE_SIZE
+from .filters import OrderSort, orderQuery, selectFields
+from .cache import customerAddresses
+from .RabbitMQ import publishMessage, publishMessages, auditMessage, auditMessages
+from .outbox import OUTBOX_MODE, outboxRecord, relay
+
+MAX_BULK_SIZE = int(os.getenv('max_bulk_size', 1000))
+# What an update event carries from before the write, so the rollups can move the order out of its old bucket
+ROLLUP_FIELDS = ("customerId", "status", "quantity", "price")
 
 router = APIRouter(prefix="/order", tags=["Order"])
 
 
-@router.post("/", response_model=UUID)
-async def create(order: UpdateOrder):
-    response = await mongodb.collections["customers"].find_one({"id": Binary.from_uuid(order.customerId)}, {"address": 1})
-    if response is None:
-        raise HTTPException(status_code=404, detail="Customer not found")
-    
+async def getCustomerAddress(customerId: UUID):
+    address = customerAddresses.get(customerId)
+    if address is None:
+        response = await mongodb.collections["customers"].find_one({"id": Binary.from_uuid(customerId)}, {"address": 1})
+        if response is None:
+            raise HTTPException(status_code=404, detail="Customer not found")
+        address = response["address"]
+        customerAddresses.set(customerId, address)
+    return address
+
+
+async def getCustomerAddresses(customerIds):
+    """Resolve many customers at once: cache first, then a single $in query for the misses."""
+    addresses = {}
+    for customerId in customerIds:
+        address = customerAddresses.get(customerId)
+        if address is not None:
+            addresses[customerId] = address
+
+    missing = [Binary.from_uuid(customerId) for customerId in customerIds if customerId not in addresses]
+    if missing:
+        customers = await mongodb.collections["customers"].find({"id": {"$in": missing}}, {"_id": 0, "id": 1, "address": 1}).to_list(length=None)
+        for customer in customers:
+            customerId = UUID(bytes=customer["id"])
+            addresses[customerId] = customer["address"]
+            customerAddresses.set(customerId, customer["address"])
+    return addresses
+
+
+def newOrder(order: UpdateOrder, address):
     order = order.dict()
     order = Order(**order |
             {
                 "id": uuid4(),
-                "address": response["address"],
+                "address": address,
                 "createdAt": datetime.utcnow(),
                 "updatedAt": datetime.utcnow()
             }
@@ -30,17 +67,201 @@ async def create(order: UpdateOrder):
     order.id = Binary.from_uuid(order.id) 
     order.customerId = Binary.from_uuid(order.customerId)
     order.product.id = Binary.from_uuid(order.product.id)
-    
-    await mongodb.collections["orders"].insert_one(order.dict()) #MongoDB
-    publishMessage(order.dict()) # RabbitMQ
+    return order
+
+
+async def auditedWrite(write):
+    """Run `write(session)`, which returns the audit event of what it changed or None, and publish the event.
+
+    In outbox mode the write and its outbox record commit in one transaction.
+    """
+    if OUTBOX_MODE:
+        async with mongodb.transaction() as session:
+            event = await write(session)
+            if event is not None:
+                await mongodb.collections["outbox"].insert_one(outboxRecord(auditMessage(event)), session=session)
+        if event is not None:
+            relay.wake()
+        return event
+
+    event = await write(None)
+    if event is not None:
+        publishMessage(event) # RabbitMQ
+    return event
+
+
+@router.post("/", response_model=UUID)
+async def create(order: UpdateOrder):
+    address = await getCustomerAddress(order.customerId)
+    order = newOrder(order, address)
+
+    async def write(session):
+        await mongodb.collections["orders"].insert_one(order.dict(), session=session) #MongoDB
+        return order.dict()
+
+    await auditedWrite(write)
     return order.id
 
 
+@router.post("/bulk", response_model=List[BulkOrderResult])
+async def createBulk(orders: Annotated[List[UpdateOrder], Body(max_length=MAX_BULK_SIZE)]):
+    addresses = await getCustomerAddresses({order.customerId for order in orders})
+
+    results, created = [], []
+    for index, order in enumerate(orders):
+        if order.customerId not in addresses:
+            results.append(BulkOrderResult(index=index, error="Customer not found"))
+            continue
+        order = newOrder(order, addresses[order.customerId])
+        results.append(BulkOrderResult(index=index, id=order.id))
+        created.append((index, order))
+
+    if created and OUTBOX_MODE:
+        try:
+            async with mongodb.transaction() as session:
+                await mongodb.collections["orders"].insert_many([order.dict() for _, order in created], session=session) #MongoDB
+                await mongodb.collections["outbox"].insert_one(outboxRecord(auditMessages([order.dict() for _, order in created])), session=session)
+        except BulkWriteError as exc:
+            # Nothing was committed; name the order that aborted the transaction
+            failed = {error["index"]: error["errmsg"] for error in exc.details["writeErrors"]}
+            for position, (index, order) in enumerate(created):
+                results[index] = BulkOrderResult(index=index, error=failed.get(position, "Not created, the batch was rolled back"))
+        relay.wake()
+
+    elif created:
+        failed = {}
+        try:
+            await mongodb.collections["orders"].insert_many([order.dict() for _, order in created], ordered=False) #MongoDB
+        except BulkWriteError as exc:
+            failed = {error["index"]: error["errmsg"] for error in exc.details["writeErrors"]}
+
+        for position, (index, order) in enumerate(created):
+            if position in failed:
+                results[index] = BulkOrderResult(index=index, error=failed[position])
+        published = [order.dict() for position, (_, order) in enumerate(created) if position not in failed]
+        if published:
+            publishMessages(published) # RabbitMQ
+
+    return results
+
+
+def transitionQuery(change: BulkStatusChange):
+    if change.ids is not None:
+        return {"id": {"$in": [Binary.from_uuid(id) for id in change.ids]}}
+
+    query = {}
+    if change.filter.customerId is not None:
+        query["customerId"] = Binary.from_uuid(change.filter.customerId)
+    if change.filter.createdBefore is not None:
+        query["createdAt"] = {"$lt": change.filter.createdBefore}
+    return query
+
+
+async def applyTransition(query, sources, target, transitionId, session=None):
+    """One UpdateMany per allowed source status, sent as a single bulk_write.
+
+    The source status is part of every filter, so an order that moved on in
+    the meantime is left alone, and each order records the status it came from.
+    """
+    now = datetime.utcnow()
+    await mongodb.collections["orders"].bulk_write([
+        UpdateMany(query | {"status": source}, {"$set": {
+            "status": target,
+            "updatedAt": now,
+            "statusTransition": {"id": transitionId, "from": source}
+        }})
+        for source in sources
+    ], ordered=False, session=session)
+    return await mongodb.collections["orders"].find(query | {"statusTransition.id": transitionId}, {"_id": 0}, session=session).to_list(length=None)
+
+
+async def transitionChunk(query, sources, target, transitionId):
+    """Move the orders matching `query`, at most MAX_BULK_SIZE, and publish them as one audit message."""
+    async with mongodb.transaction() if OUTBOX_MODE else nullcontext() as session:
+        changed = await applyTransition(query, sources, target, transitionId, session)
+        if changed and OUTBOX_MODE:
+            await mongodb.collections["outbox"].insert_one(outboxRecord(auditMessages(changed)), session=session)
+    if changed and OUTBOX_MODE:
+        relay.wake()
+    elif changed:
+        publishMessages(changed) # RabbitMQ, one message per chunk
+    return changed
+
+
+@router.put("/changeStatus", response_model=BulkStatusResult)
+async def changeStatusBulk(change: BulkStatusChange):
+    """Move the orders named by ids, or matched by a filter, to a new status.
+
+    A filter can match any number of orders, so they are read MAX_BULK_SIZE
+    ids at a time and every chunk is moved and published on its own; orders
+    this transition already moved are left out of the next read.
+    """
+    sources = sourcesOf(change.status)
+    if not sources:
+        raise HTTPException(status_code=422, detail=f"No status can move to {change.status}")
+    if change.ids is not None and len(change.ids) > MAX_BULK_SIZE:
+        raise HTTPException(status_code=422, detail=f"At most {MAX_BULK_SIZE} ids per request")
+    if change.filter is not None and change.filter.status is not None:
+        sources = [source for source in sources if source == change.filter.status]
+
+    transitionId = str(uuid4())
+    if change.ids is not None:
+        changed = await transitionChunk(transitionQuery(change), sources, change.status, transitionId)
+        updated = {UUID(bytes=order["id"]) for order in changed}
+        return BulkStatusResult(transitionId=transitionId, updated=len(changed), skipped=[id for id in change.ids if id not in updated])
+
+    updated = 0
+    query = transitionQuery(change) | {"status": {"$in": sources}, "statusTransition.id": {"$ne": transitionId}}
+    while sources:
+        chunk = await mongodb.collections["orders"].find(query, {"_id": 0, "id": 1}).limit(MAX_BULK_SIZE).to_list(length=MAX_BULK_SIZE)
+        if not chunk:
+            break
+        updated += len(await transitionChunk({"id": {"$in": [order["id"] for order in chunk]}}, sources, change.status, transitionId))
+
+    return BulkStatusResult(transitionId=transitionId, updated=updated)
+
+
+@router.get("/stats", response_model=List[OrderStats])
+async def getStats(
+    customerId: Optional[UUID] = None,
+    status: Optional[str] = None,
+    since: Optional[date] = Query(None, alias="from"),
+    until: Optional[date] = Query(None, alias="to"),
+    groupBy: List[Literal["customerId", "status", "day"]] = Query([])
+):
+    """Order count, quantity and revenue summed from the rollup buckets, never from the orders themselves.
+
+    Without groupBy the result is a single total.
+    """
+    query = {}
+    if customerId is not None:
+        query["_id.customerId"] = Binary.from_uuid(customerId)
+    if status is not None:
+        query["_id.status"] = status
+    if since is not None or until is not None:
+        query["_id.day"] = {}
+        if since is not None:
+            query["_id.day"]["$gte"] = since.isoformat()
+        if until is not None:
+            query["_id.day"]["$lte"] = until.isoformat()
+
+    pipeline = [
+        {"$match": query},
+        {"$group": {
+            "_id": {field: f"$_id.{field}" for field in groupBy} or None,
+            "count": {"$sum": "$count"},
+            "quantity": {"$sum": "$quantity"},
+            "revenue": {"$sum": "$revenue"}
+        }},
+        {"$sort": {"_id": 1}}
+    ]
+    buckets = await mongodb.collections["orderRollups"].aggregate(pipeline).to_list(length=None)
+    return [(bucket.pop("_id") or {}) | bucket for bucket in buckets]
+
+
 @router.put("/{orderId}", response_model=bool)
 async def update(orderId: UUID, order: UpdateOrder):
-    response = await mongodb.collections["customers"].find_one({"id": Binary.from_uuid(order.customerId)}, {"address": 1})
-    if response is None:
-        raise HTTPException(status_code=404, detail="Customer not found")
+    address = await getCustomerAddress(order.customerId)
     
 
     orderId = Binary.from_uuid(orderId) 
@@ -49,27 +270,72 @@ async def update(orderId: UUID, order: UpdateOrder):
 
     order = order.dict()
     order["updatedAt"] = datetime.utcnow()
-    order["address"] = response["address"]
+    order["address"] = address
+
+    async def write(session):
+        previous = await mongodb.collections["orders"].find_one_and_update({"id": orderId}, {"$set": order}, {"_id": 0}, session=session)
+        if previous is None:
+            return None
+        # A bulk status change's statusTransition stays on the order but says nothing about this write
+        previous.pop("statusTransition", None)
+        return previous | order | {"previous": {field: previous[field] for field in ROLLUP_FIELDS}}
 
-    return (await mongodb.collections["orders"].update_one({"id": orderId}, {"$set": order}, upsert=False)).matched_count > 0
+    return await auditedWrite(write) is not None
 
 
 @router.delete("/{orderId}", response_model=bool)
 async def delete(orderId: UUID): #OTHER RELATİON LOGİC
     orderId = Binary.from_uuid(orderId)
-    return (await mongodb.collections["orders"].delete_one({"id": orderId})).deleted_count > 0
 
+    async def write(session):
+        deleted = await mongodb.collections["orders"].find_one_and_delete({"id": orderId}, {"_id": 0}, session=session)
+        return deleted | {"deletedAt": datetime.utcnow()} if deleted is not None else None
+
+    return await auditedWrite(write) is not None
 
-@router.get("/", response_model=List[Order])
-async def getAll():
-    return await mongodb.collections["orders"].find({}, {"_id": 0}).to_list(length=None)
 
+@router.get("/", response_model=Union[List[Order], OrderPage])
+async def getAll(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    status: Optional[str] = None,
+    createdFrom: Optional[datetime] = None,
+    createdTo: Optional[datetime] = None,
+    updatedFrom: Optional[datetime] = None,
+    updatedTo: Optional[datetime] = None,
+    minPrice: Optional[float] = None,
+    maxPrice: Optional[float] = None,
+    sort: Optional[OrderSort] = None,
+    fields: Optional[str] = None
+):
+    ranges = {"createdAt": (createdFrom, createdTo), "updatedAt": (updatedFrom, updatedTo), "price": (minPrice, maxPrice)}
+    query, sortBy = orderQuery({}, status, ranges, sort)
 
-@router.get("/getByCustomer/{customerId}", response_model=List[Order])
-async def getByCustomer(customerId: UUID):
+    return await paginate(mongodb.collections["orders"], query, Order, limit, cursor, stream, sort=sortBy, fields=selectFields(fields))
+
+
+@router.get("/getByCustomer/{customerId}", response_model=Union[List[Order], OrderPage])
+async def getByCustomer(
+    customerId: UUID,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    status: Optional[str] = None,
+    createdFrom: Optional[datetime] = None,
+    createdTo: Optional[datetime] = None,
+    updatedFrom: Optional[datetime] = None,
+    updatedTo: Optional[datetime] = None,
+    minPrice: Optional[float] = None,
+    maxPrice: Optional[float] = None,
+    sort: Optional[OrderSort] = None,
+    fields: Optional[str] = None
+):
     customerId = Binary.from_uuid(customerId)
+    ranges = {"createdAt": (createdFrom, createdTo), "updatedAt": (updatedFrom, updatedTo), "price": (minPrice, maxPrice)}
+    query, sortBy = orderQuery({"customerId": customerId}, status, ranges, sort)
 
-    return await mongodb.collections["orders"].find({"customerId": customerId}, {"_id": 0}).to_list(length=None)
+    return await paginate(mongodb.collections["orders"], query, Order, limit, cursor, stream, sort=sortBy, fields=selectFields(fields))
 
 
 @router.get("/getByOrder/{orderId}", response_model=Order)
@@ -86,4 +352,21 @@ async def getByOrder(orderId: UUID):
 async def changeStatus(orderId: UUID, status: str):
     orderId = Binary.from_uuid(orderId)
 
-    return (await mongodb.collections["orders"].update_one({"id": orderId}, {"$set": {"status": status}}, upsert=False)).matched_count > 0
\ No newline at end of file
+    async def write(session):
+        now = datetime.utcnow()
+        previous = await mongodb.collections["orders"].find_one_and_update({"id": orderId}, {"$set": {"status": status, "updatedAt": now}}, {"_id": 0}, session=session)
+        if previous is None:
+            return None
+        return previous | {"status": status, "updatedAt": now, "statusTransition": {"id": str(uuid4()), "from": previous["status"]}}
+
+    return await auditedWrite(write) is not None
+
+
+@router.get("/customerCache/stats", response_model=dict)
+async def customerCacheStats():
+    return customerAddresses.stats()
+
+
+@router.delete("/customerCache/{customerId}", response_model=bool)
+async def invalidateCustomer(customerId: UUID):
+    return customerAddresses.invalidate(customerId)
\ No newline at end of file
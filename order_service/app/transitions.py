@@ -0,0 +1,18 @@
+import json
+import os
+
+# status -> the statuses an order may move to from it; override with a JSON object in order_status_transitions
+DEFAULT_TRANSITIONS = {
+    "pending": ["processing", "shipped", "cancelled"],
+    "processing": ["shipped", "cancelled"],
+    "shipped": ["delivered", "returned"],
+    "delivered": ["returned"],
+    "cancelled": [],
+    "returned": []
+}
+ALLOWED_TRANSITIONS = json.loads(os.getenv('order_status_transitions', 'null')) or DEFAULT_TRANSITIONS
+
+
+def sourcesOf(target, transitions=ALLOWED_TRANSITIONS):
+    """The statuses an order may be in to move to `target`, in a stable order."""
+    return sorted(status for status, targets in transitions.items() if target in targets)
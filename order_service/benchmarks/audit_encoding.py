@@ -0,0 +1,50 @@
+"""Encode/decode cost and size of audit messages, JSON against BSON.
+
+Run from the order_service directory:
+    python -m benchmarks.audit_encoding --messages 20000 --batch 100
+
+JSON encoding includes encodeSpecialFields, the way publishMessage sends it;
+decoding is what the consumer does with each body before inserting it.
+"""
+import argparse
+import json
+import time
+import bson
+
+from app.RabbitMQ import auditMessage, auditMessages
+from .publisher import sampleOrder
+
+
+CODECS = {
+    "json": (lambda order: auditMessage(order, "json"), lambda orders: auditMessages(orders, "json"), json.loads),
+    "bson": (lambda order: auditMessage(order, "bson"), lambda orders: auditMessages(orders, "bson"), bson.decode)
+}
+
+
+def timed(function, items):
+    started = time.perf_counter()
+    results = [function(item) for item in items]
+    return time.perf_counter() - started, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--batch", type=int, default=100, help="events per bulk message")
+    args = parser.parse_args()
+
+    orders = [sampleOrder() for _ in range(args.messages)]
+    batches = [orders[offset:offset + args.batch] for offset in range(0, len(orders), args.batch)]
+
+    print(f"{args.messages} orders; single messages and bulk messages of {args.batch}")
+    print(f"{'format':<8}{'shape':<8}{'encode us/event':>17}{'decode us/event':>17}{'bytes/event':>13}")
+    for name, (encodeOne, encodeMany, decode) in CODECS.items():
+        for shape, encode, items in (("single", encodeOne, orders), ("bulk", encodeMany, batches)):
+            encodeTime, bodies = timed(encode, items)
+            decodeTime, _ = timed(decode, bodies)
+            size = sum(len(body if isinstance(body, bytes) else body.encode()) for body in bodies)
+            print(f"{name:<8}{shape:<8}{encodeTime / len(orders) * 1e6:>17.2f}{decodeTime / len(orders) * 1e6:>17.2f}{size / len(orders):>13.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import threading
+import time
+import pika
+
+
+class FakeChannel:
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_closed = False
+
+    def queue_declare(self, queue, durable=False):
+        time.sleep(self.broker.roundTrip)
+
+    def confirm_delivery(self):
+        time.sleep(self.broker.roundTrip)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        # confirm-mode publishes wait one broker round trip for the ack
+        time.sleep(self.broker.roundTrip)
+        with self.broker.lock:
+            self.broker.messages.append(body)
+
+
+class FakeBlockingConnection:
+    """Drop-in for pika.BlockingConnection that only simulates network latency."""
+    def __init__(self, broker, parameters=None):
+        self.broker = broker
+        self.is_open = True
+        # TCP + AMQP handshake (protocol header, start/tune/open) is several round trips
+        time.sleep(self.broker.handshake)
+        with self.broker.lock:
+            self.broker.connections += 1
+
+    def channel(self):
+        time.sleep(self.broker.roundTrip)
+        return FakeChannel(self.broker)
+
+    def close(self):
+        self.is_open = False
+
+
+class FakeBroker:
+    """Local RabbitMQ stand-in; patch pika.BlockingConnection with `broker.connect`."""
+    def __init__(self, handshake=0.005, roundTrip=0.0005):
+        self.handshake = handshake
+        self.roundTrip = roundTrip
+        self.lock = threading.Lock()
+        self.messages = []
+        self.connections = 0
+
+    def connect(self, parameters=None):
+        return FakeBlockingConnection(self, parameters)
+
+    def reset(self):
+        self.messages = []
+        self.connections = 0
+
+    def patch(self):
+        return _Patch(self)
+
+
+class _Patch:
+    def __init__(self, broker):
+        self.broker = broker
+
+    def __enter__(self):
+        self.original = pika.BlockingConnection
+        pika.BlockingConnection = self.broker.connect
+        return self.broker
+
+    def __exit__(self, *exc):
+        pika.BlockingConnection = self.original
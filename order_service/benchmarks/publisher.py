@@ -0,0 +1,99 @@
+"""Orders/sec of the audit publish path, before and after the persistent publisher.
+
+Run from the order_service directory:
+    python -m benchmarks.publisher --orders 2000 --concurrency 100
+"""
+import argparse
+import asyncio
+import json
+import time
+import pika
+from bson import Binary
+from datetime import datetime
+from uuid import uuid4
+
+from app.RabbitMQ import RabbitMQPublisher, encodeSpecialFields, QUEUE_NAME
+from .broker import FakeBroker
+
+
+def sampleOrder():
+    return {
+        "id": Binary.from_uuid(uuid4()),
+        "customerId": Binary.from_uuid(uuid4()),
+        "quantity": 1,
+        "price": 100.0,
+        "status": "pending",
+        "address": {"addressLine": "123 Main St", "city": "Metropolis", "country": "Wonderland", "cityCode": 12345},
+        "product": {"id": Binary.from_uuid(uuid4()), "name": "Product1", "imageUrl": "http://example.com/product1.png"},
+        "createdAt": datetime.utcnow(),
+        "updatedAt": datetime.utcnow()
+    }
+
+
+def legacyPublishMessage(orderData: dict):
+    # The previous implementation: one connection per order, on the event loop
+    orderData = encodeSpecialFields(orderData)
+    connection = pika.BlockingConnection(pika.ConnectionParameters())
+    channel = connection.channel()
+    channel.queue_declare(queue=QUEUE_NAME, durable=True)
+    channel.basic_publish(exchange='', routing_key=QUEUE_NAME, body=json.dumps(orderData),
+                          properties=pika.BasicProperties(delivery_mode=2))
+    connection.close()
+
+
+async def drive(orders, concurrency, publish):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def order():
+        async with semaphore:
+            publish(sampleOrder())
+
+    await asyncio.gather(*(order() for _ in range(orders)))
+
+
+async def benchLegacy(broker, orders, concurrency):
+    start = time.perf_counter()
+    await drive(orders, concurrency, legacyPublishMessage)
+    return time.perf_counter() - start, time.perf_counter() - start
+
+
+async def benchPublisher(broker, orders, concurrency, poolSize):
+    publisher = RabbitMQPublisher(pika.ConnectionParameters, poolSize=poolSize)
+    publisher.start()
+    futures = []
+
+    start = time.perf_counter()
+    await drive(orders, concurrency, lambda order: futures.append(publisher.publish(json.dumps(encodeSpecialFields(order)))))
+    accepted = time.perf_counter() - start
+    await asyncio.gather(*(asyncio.wrap_future(future) for future in futures))
+    confirmed = time.perf_counter() - start
+
+    publisher.stop()
+    return accepted, confirmed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--pool-size", type=int, default=4)
+    parser.add_argument("--handshake-ms", type=float, default=5)
+    parser.add_argument("--rtt-ms", type=float, default=0.5)
+    args = parser.parse_args()
+
+    broker = FakeBroker(handshake=args.handshake_ms / 1000, roundTrip=args.rtt_ms / 1000)
+    with broker.patch():
+        results = {}
+        broker.reset()
+        results["per-order connection"] = asyncio.run(benchLegacy(broker, args.orders, args.concurrency)) + (broker.connections,)
+        broker.reset()
+        results["persistent publisher"] = asyncio.run(benchPublisher(broker, args.orders, args.concurrency, args.pool_size)) + (broker.connections,)
+
+    print(f"{args.orders} orders, concurrency {args.concurrency}, handshake {args.handshake_ms}ms, rtt {args.rtt_ms}ms")
+    print(f"{'mode':<24}{'accepted/s':>12}{'confirmed/s':>13}{'connections':>13}")
+    for name, (accepted, confirmed, connections) in results.items():
+        print(f"{name:<24}{args.orders / accepted:>12.0f}{args.orders / confirmed:>13.0f}{connections:>13}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Latency and peak memory of GET /order/ for large result sets, per encoding mode.
+
+Run from the order_service directory:
+    python -m benchmarks.serialization --orders 10000 100000
+
+The collection is a stand-in that hands back prebuilt documents, so the numbers
+cover what happens between Motor and the socket: response_model validation and
+jsonable_encoder in the default mode, one encoder pass in the fast mode.
+"""
+import argparse
+import time
+import tracemalloc
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from fastapi.testclient import TestClient
+
+from app import encoding
+from main import app
+from .publisher import sampleOrder
+
+
+def bench(client, documents, fast, repeat):
+    collections = MagicMock()
+    collections["orders"].find.return_value.to_list = AsyncMock(side_effect=lambda length: [dict(document) for document in documents])
+
+    with patch("app.routes.mongodb.collections", collections), patch("app.pagination.FAST_RESPONSES", fast):
+        client.get("/order/") # warm up
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            response = client.get("/order/")
+            timings.append(time.perf_counter() - started)
+
+        tracemalloc.start()
+        client.get("/order/")
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return min(timings), peak, len(response.content)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    client = TestClient(app)
+    print(f"encoder: {'orjson' if encoding.orjson is not None else 'json'}")
+    print(f"{'orders':>8}  {'mode':<10}{'latency ms':>12}{'orders/s':>12}{'peak MiB':>10}{'body MiB':>10}")
+    for count in args.orders:
+        documents = [sampleOrder() for _ in range(count)]
+        for name, fast in (("default", False), ("fast", True)):
+            latency, peak, size = bench(client, documents, fast, args.repeat)
+            print(f"{count:>8}  {name:<10}{latency * 1000:>12.0f}{count / latency:>12.0f}{peak / 2**20:>10.1f}{size / 2**20:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
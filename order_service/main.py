@@ -1,10 +1,38 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from app.routes import router
+from app.audit import router as auditRouter
+from app.cascade import router as cascadeRouter, cascade
+from app.MongoDB import mongodb, auditdb
+from app.RabbitMQ import publisher
+from app.outbox import OUTBOX_MODE, relay
+from app.Metrics import MetricsMiddleware, metrics
 import uvicorn
+import asyncio
 
-app = FastAPI()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await mongodb.ensureIndexes()
+    if auditdb is not None:
+        await auditdb.ensureIndexes()
+    publisher.start()
+    if OUTBOX_MODE:
+        relay.start()
+    cascade.start()
+    yield
+    await cascade.stop()
+    await relay.stop()
+    # Joins the publisher threads while they flush, so it runs off the event loop
+    await asyncio.to_thread(publisher.stop)
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(MetricsMiddleware)
+app.add_route("/metrics", metrics, include_in_schema=False)
+app.include_router(auditRouter)
+app.include_router(cascadeRouter)
 app.include_router(router)
 
 if __name__ == "__main__": 
-    uvicorn.run(app, host="0.0.0.0", port=8002)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8002)
@@ -1,12 +1,28 @@
 import pytest
 from fastapi.testclient import TestClient
 from datetime import datetime
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, ANY
 from unittest.mock import patch, AsyncMock
-from bson import Binary
+from bson import Binary, ObjectId
+from pymongo.errors import BulkWriteError
 from uuid import uuid4, UUID
+import asyncio
+import os
+import json
+import time
 
 from main import app
+from app.MongoDB import MongoDB
+from app.indexes import INDEXES, findCollectionScans
+from app.cache import customerAddresses, TTLCache
+from app.routes import MAX_BULK_SIZE
+from app.outbox import OutboxRelay
+from app.cascade import CascadeWorker
+from app.indexes import AUDIT_INDEXES, AUDIT_QUERY_SHAPES
+from app.RabbitMQ import auditMessage, auditMessages, auditProperties, encodeSpecialFields
+import bson
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
 
 #Test client
 client = TestClient(app)
@@ -16,6 +32,7 @@ client = TestClient(app)
 def mock_mongodb():
     with patch("app.routes.mongodb.collections") as mock_db:
         mock_db["orders"].insert_one = AsyncMock()
+        customerAddresses.clear()
         yield mock_db
 
 
@@ -65,8 +82,9 @@ def test_create_order(mock_publish, mock_mongodb):
 ##########################################
 
 ##################UPDATE##################
-# Test the order update route for a successful case
-def test_update_order_success(mock_mongodb):
+# Test the order update route for a successful case; the event carries the values it replaced
+@patch("app.routes.publishMessage")
+def test_update_order_success(mock_publish, mock_mongodb):
     order_id = uuid4()
     customer_id = uuid4()
     product_id = uuid4()
@@ -80,7 +98,8 @@ def test_update_order_success(mock_mongodb):
         }
     })
 
-    mock_mongodb["orders"].update_one = AsyncMock(return_value=AsyncMock(matched_count=1))
+    previous = make_order(customer_id) | {"id": Binary.from_uuid(order_id), "quantity": 1, "price": 100.0, "status": "pending"}
+    mock_mongodb["orders"].find_one_and_update = AsyncMock(return_value=previous)
 
     update_data = {
         "customerId": str(customer_id),
@@ -101,14 +120,54 @@ def test_update_order_success(mock_mongodb):
 
     mock_mongodb["customers"].find_one.assert_called_once_with({"id": Binary.from_uuid(customer_id)}, {"address": 1})
 
-    mock_mongodb["orders"].update_one.assert_called_once()
-    updated_order = mock_mongodb["orders"].update_one.call_args[0][1]["$set"]
+    mock_mongodb["orders"].find_one_and_update.assert_called_once()
+    assert mock_mongodb["orders"].find_one_and_update.call_args[0][0] == {"id": Binary.from_uuid(order_id)}
+    updated_order = mock_mongodb["orders"].find_one_and_update.call_args[0][1]["$set"]
     assert updated_order["quantity"] == 2
     assert updated_order["price"] == 150.0
     assert updated_order["status"] == "processing"
     assert updated_order["address"]["city"] == "Metropolis"
     assert updated_order["product"]["id"] == Binary.from_uuid(product_id)
 
+    event = mock_publish.call_args[0][0]
+    assert (event["id"], event["status"], event["quantity"], event["createdAt"]) == (previous["id"], "processing", 2, previous["createdAt"])
+    assert event["previous"] == {"customerId": Binary.from_uuid(customer_id), "status": "pending", "quantity": 1, "price": 100.0}
+
+# Test an update of an order a bulk status change moved does not carry that transition into its event
+@patch("app.routes.publishMessage")
+def test_update_order_after_bulk_transition(mock_publish, mock_mongodb):
+    customer_id, order_id = uuid4(), uuid4()
+    mock_mongodb["customers"].find_one = AsyncMock(return_value={"address": make_order(customer_id)["address"]})
+    previous = make_order(customer_id) | {"quantity": 1, "status": "processing", "statusTransition": {"id": "bulk", "from": "pending"}}
+    mock_mongodb["orders"].find_one_and_update = AsyncMock(return_value=previous)
+
+    update_data = {
+        "customerId": str(customer_id),
+        "quantity": 5,
+        "price": 100.0,
+        "status": "shipped",
+        "product": {"id": str(uuid4()), "name": "Product", "imageUrl": "http://example.com/product.png"}
+    }
+    assert client.put(f"/order/{order_id}", json=update_data).json() is True
+
+    event = mock_publish.call_args[0][0]
+    assert "statusTransition" not in event
+    assert (event["status"], event["previous"]["status"], event["previous"]["quantity"]) == ("shipped", "processing", 1)
+
+# Test updating a missing order returns False and publishes nothing
+@patch("app.routes.publishMessage")
+def test_update_order_not_found(mock_publish, mock_mongodb):
+    mock_mongodb["customers"].find_one = AsyncMock(return_value={"address": {
+        "addressLine": "123 Main St", "city": "Metropolis", "country": "Wonderland", "cityCode": 12345
+    }})
+    mock_mongodb["orders"].find_one_and_update = AsyncMock(return_value=None)
+
+    response = client.put(f"/order/{uuid4()}", json=make_update_order(uuid4()))
+
+    assert response.status_code == 200
+    assert response.json() is False
+    assert not mock_publish.called
+
 # Test the order update route for a case where the customer is not found
 def test_update_order_customer_not_found(mock_mongodb):
     order_id = uuid4()
@@ -136,22 +195,36 @@ def test_update_order_customer_not_found(mock_mongodb):
 
     mock_mongodb["customers"].find_one.assert_called_once_with({"id": Binary.from_uuid(customer_id)}, {"address": 1})
 
-    mock_mongodb["orders"].update_one.assert_not_called()
+    mock_mongodb["orders"].find_one_and_update.assert_not_called()
 ##########################################
 
 ##################DELETE##################
-# Test the order delete route
-def test_delete_order(mock_mongodb):
+# Test the order delete route publishes the removed order with deletedAt, so the rollups subtract it
+@patch("app.routes.publishMessage")
+def test_delete_order(mock_publish, mock_mongodb):
     order_id = uuid4()
+    deleted = make_order() | {"id": Binary.from_uuid(order_id)}
 
-    mock_mongodb["orders"].delete_one = AsyncMock(return_value=AsyncMock(deleted_count=1))
+    mock_mongodb["orders"].find_one_and_delete = AsyncMock(return_value=deleted)
 
     response = client.delete(f"/order/{order_id}")
 
     assert response.status_code == 200
     assert response.json() is True
 
-    mock_mongodb["orders"].delete_one.assert_called_once_with({"id": Binary.from_uuid(order_id)})
+    mock_mongodb["orders"].find_one_and_delete.assert_called_once_with({"id": Binary.from_uuid(order_id)}, {"_id": 0}, session=None)
+    event = mock_publish.call_args[0][0]
+    assert event["id"] == deleted["id"] and isinstance(event["deletedAt"], datetime)
+
+# Test deleting a missing order returns False and publishes nothing
+@patch("app.routes.publishMessage")
+def test_delete_order_not_found(mock_publish, mock_mongodb):
+    mock_mongodb["orders"].find_one_and_delete = AsyncMock(return_value=None)
+
+    response = client.delete(f"/order/{uuid4()}")
+
+    assert response.json() is False
+    assert not mock_publish.called
 ##########################################
 
 
@@ -399,35 +472,1016 @@ def test_get_orders_by_customer_not_found(mock_mongodb):
 ##########################################
 
 #################CHANGESTATUS##################
-# Test the order status change route for a successful case
-def test_change_order_status_success(mock_mongodb):
+# Test the order status change route for a successful case; the event records the status it came from
+@patch("app.routes.publishMessage")
+def test_change_order_status_success(mock_publish, mock_mongodb):
     order_id = uuid4()
     new_status = "shipped"
 
-    mock_mongodb["orders"].update_one = AsyncMock(return_value=AsyncMock(matched_count=1))
+    mock_mongodb["orders"].find_one_and_update = AsyncMock(return_value=make_order() | {"status": "processing"})
 
     response = client.put(f"/order/changeStatus/{order_id}?status={new_status}")
 
     assert response.status_code == 200
     assert response.json() is True
 
-    mock_mongodb["orders"].update_one.assert_called_once_with(
-        {"id": Binary.from_uuid(order_id)}, {"$set": {"status": new_status}}, upsert=False
+    mock_mongodb["orders"].find_one_and_update.assert_called_once_with(
+        {"id": Binary.from_uuid(order_id)}, {"$set": {"status": new_status, "updatedAt": ANY}}, {"_id": 0}, session=None
     )
+    event = mock_publish.call_args[0][0]
+    assert event["status"] == new_status
+    assert event["statusTransition"]["from"] == "processing"
+    assert event["updatedAt"] == mock_mongodb["orders"].find_one_and_update.call_args[0][1]["$set"]["updatedAt"]
 
 # Test the order status change route for a case where the order is not found
-def test_change_order_status_not_found(mock_mongodb):
+@patch("app.routes.publishMessage")
+def test_change_order_status_not_found(mock_publish, mock_mongodb):
     order_id = uuid4()
     new_status = "shipped"
 
-    mock_mongodb["orders"].update_one = AsyncMock(return_value=AsyncMock(matched_count=0))
+    mock_mongodb["orders"].find_one_and_update = AsyncMock(return_value=None)
 
     response = client.put(f"/order/changeStatus/{order_id}?status={new_status}")
 
     assert response.status_code == 200
     assert response.json() is False
 
-    mock_mongodb["orders"].update_one.assert_called_once_with(
-        {"id": Binary.from_uuid(order_id)}, {"$set": {"status": new_status}}, upsert=False
+    mock_mongodb["orders"].find_one_and_update.assert_called_once_with(
+        {"id": Binary.from_uuid(order_id)}, {"$set": {"status": new_status, "updatedAt": ANY}}, {"_id": 0}, session=None
     )
-##########################################
\ No newline at end of file
+    assert not mock_publish.called
+##########################################
+
+################PAGINATION################
+def project(document, projected):
+    """What MongoDB returns for an inclusion projection of dotted paths."""
+    if set(projected) == {"_id"}:
+        return dict(document)
+    result = {}
+    for path, included in projected.items():
+        if path == "_id" or not included:
+            continue
+        *parents, name = path.split(".")
+        source, target = document, result
+        for parent in parents:
+            source, target = source.get(parent, {}), target.setdefault(parent, {})
+        if name in source:
+            target[name] = source[name]
+    return result
+
+def make_order(customer_id=None, created_at=None):
+    return {
+        "id": Binary.from_uuid(uuid4()),
+        "customerId": Binary.from_uuid(customer_id or uuid4()),
+        "quantity": 1,
+        "price": 100.0,
+        "status": "pending",
+        "address": {
+            "addressLine": "123 Main St",
+            "city": "Metropolis",
+            "country": "Wonderland",
+            "cityCode": 12345
+        },
+        "product": {
+            "id": Binary.from_uuid(uuid4()),
+            "name": "Product1",
+            "imageUrl": "http://example.com/product1.png"
+        },
+        "createdAt": created_at or datetime.utcnow(),
+        "updatedAt": datetime.utcnow()
+    }
+
+# Test keyset pagination returns a page and a cursor pointing after its last item
+def test_get_all_orders_paged(mock_mongodb):
+    orders = [make_order() for _ in range(3)]
+
+    mock_find = MagicMock()
+    mock_find.sort.return_value.limit.return_value.to_list = AsyncMock(return_value=orders)
+    mock_mongodb["orders"].find.return_value = mock_find
+
+    response = client.get("/order/?limit=2")
+
+    assert response.status_code == 200
+
+    response_data = response.json()
+    assert len(response_data["items"]) == 2
+    assert response_data["items"][1]["id"] == str(UUID(bytes=orders[1]["id"]))
+    assert response_data["nextCursor"]
+
+    mock_mongodb["orders"].find.assert_called_once_with({}, {"_id": 0})
+    mock_find.sort.assert_called_once_with([("createdAt", 1), ("id", 1)])
+    mock_find.sort.return_value.limit.assert_called_once_with(3)
+
+    # The cursor resumes strictly after the last returned (createdAt, id)
+    mock_mongodb["orders"].find.reset_mock()
+    mock_find.sort.return_value.limit.return_value.to_list = AsyncMock(return_value=orders[2:])
+
+    response = client.get(f"/order/getByCustomer/{uuid4()}?limit=2&cursor={response_data['nextCursor']}")
+
+    assert response.status_code == 200
+    assert response.json()["nextCursor"] is None
+
+    query = mock_mongodb["orders"].find.call_args[0][0]
+    after = query["$and"][1]["$or"]
+    assert after[0] == {"createdAt": {"$gt": orders[1]["createdAt"]}}
+    assert after[1] == {"createdAt": orders[1]["createdAt"], "id": {"$gt": orders[1]["id"]}}
+
+# Test a malformed cursor is rejected
+def test_get_all_orders_invalid_cursor(mock_mongodb):
+    response = client.get("/order/?cursor=not-a-cursor")
+
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Invalid cursor"}
+
+# Test the streaming mode sends one JSON document per line
+def test_get_orders_by_customer_stream(mock_mongodb):
+    customer_id = uuid4()
+    orders = [make_order(customer_id) for _ in range(2)]
+
+    mock_find = MagicMock()
+    mock_find.batch_size.return_value.__aiter__.return_value = orders
+    mock_mongodb["orders"].find.return_value = mock_find
+
+    response = client.get(f"/order/getByCustomer/{customer_id}?stream=true")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+
+    lines = response.text.splitlines()
+    assert len(lines) == 2
+    for line, order in zip(lines, orders):
+        assert json.loads(line)["id"] == str(UUID(bytes=order["id"]))
+        assert json.loads(line)["customerId"] == str(customer_id)
+
+    mock_mongodb["orders"].find.assert_called_once_with({"customerId": Binary.from_uuid(customer_id)}, {"_id": 0})
+##########################################
+
+
+##############FASTRESPONSES###############
+# Test the fast encoder produces the same list as the response_model path
+def test_get_all_orders_fast_matches_default(mock_mongodb):
+    orders = [make_order() for _ in range(3)]
+    mock_mongodb["orders"].find.return_value.to_list = AsyncMock(side_effect=lambda length: [dict(order) for order in orders])
+
+    expected = client.get("/order/").json()
+    with patch("app.pagination.FAST_RESPONSES", True):
+        response = client.get("/order/")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    assert response.json() == expected
+
+    # Only the model's fields are fetched, sub-documents included
+    projection = mock_mongodb["orders"].find.call_args[0][1]
+    assert projection["_id"] == 0
+    assert {path.split(".")[0] for path in projection} - {"_id"} == set(expected[0])
+    assert "address.city" in projection and "address" not in projection
+
+# Test keys stored beside the model's fields, top-level or nested, are left out in fast mode as they are by response_model
+def test_get_all_orders_fast_drops_extra_nested_keys(mock_mongodb):
+    orders = [make_order() for _ in range(2)]
+    for order in orders:
+        order["legacy"] = True
+        order["address"]["extra"] = "not in the model"
+        order["product"]["sku"] = "P-1"
+
+    def find(query, projected):
+        cursor = MagicMock()
+        cursor.to_list = AsyncMock(return_value=[project(order, projected) for order in orders])
+        return cursor
+    mock_mongodb["orders"].find.side_effect = find
+
+    expected = client.get("/order/").json()
+    with patch("app.pagination.FAST_RESPONSES", True):
+        fast = client.get("/order/").json()
+
+    assert fast == expected
+    assert "extra" not in fast[0]["address"] and "sku" not in fast[0]["product"] and "legacy" not in fast[0]
+
+# Test fast pages and streams keep their shape
+def test_get_orders_fast_page_and_stream(mock_mongodb):
+    customer_id = uuid4()
+    orders = [make_order(customer_id) for _ in range(3)]
+
+    mock_find = MagicMock()
+    mock_find.sort.return_value.limit.return_value.to_list = AsyncMock(return_value=orders)
+    mock_find.batch_size.return_value.__aiter__.return_value = orders
+    mock_mongodb["orders"].find.return_value = mock_find
+
+    with patch("app.pagination.FAST_RESPONSES", True):
+        page = client.get(f"/order/getByCustomer/{customer_id}?limit=2")
+        stream = client.get(f"/order/getByCustomer/{customer_id}?stream=true")
+
+    assert page.status_code == 200
+    assert [item["id"] for item in page.json()["items"]] == [str(UUID(bytes=order["id"])) for order in orders[:2]]
+    assert page.json()["nextCursor"]
+
+    lines = [json.loads(line) for line in stream.text.splitlines()]
+    assert len(lines) == 3
+    assert lines[0]["customerId"] == str(customer_id)
+    assert lines[0]["createdAt"] == orders[0]["createdAt"].isoformat()
+##########################################
+
+
+##################INDEXES#################
+# Test the explain check flags queries whose winning plan is a collection scan
+def test_find_collection_scans_flags_collscan():
+    mock_db = MagicMock()
+    ixscan = {"queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}}}
+    collscan = {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}}
+    mock_db.collections = MagicMock()
+    mock_db.collections.__getitem__.return_value.find.return_value.explain = AsyncMock(side_effect=[ixscan, collscan])
+
+    shapes = [("indexed", "c", {"id": 1}, None), ("scanned", "c", {"other": 1}, None)]
+
+    assert asyncio.run(findCollectionScans(mock_db, shapes)) == ["scanned"]
+
+# Test every route query is index-backed against a real database
+@pytest.mark.skipif(not os.getenv("conn_str"), reason="needs a MongoDB connection string in conn_str")
+def test_route_queries_use_indexes():
+    async def check():
+        db = MongoDB(os.getenv("conn_str"), [["Tesodev", "customers"], ["Tesodev", "orders"], ["Tesodev", "outbox"], ["Tesodev", "orderRollups"], ["Tesodev", "cascadeJobs"], ["Tesodev", "ordersArchive"]], INDEXES)
+        await db.ensureIndexes()
+        return await findCollectionScans(db)
+
+    assert asyncio.run(check()) == []
+##########################################
+
+
+
+###############CUSTOMERCACHE##############
+# Test repeated writes for the same customer hit the address cache instead of MongoDB
+def test_customer_address_cached(mock_mongodb):
+    customer_id = uuid4()
+
+    mock_mongodb["customers"].find_one = AsyncMock(return_value={
+        "address": {
+            "addressLine": "123 Main St",
+            "city": "Metropolis",
+            "country": "Wonderland",
+            "cityCode": 12345
+        }
+    })
+    mock_mongodb["orders"].find_one_and_update = AsyncMock(return_value=None)
+
+    update_data = {
+        "customerId": str(customer_id),
+        "quantity": 2,
+        "price": 150.0,
+        "status": "processing",
+        "product": {
+            "id": str(uuid4()),
+            "name": "Product2",
+            "imageUrl": "http://example.com/product2.png"
+        }
+    }
+
+    before = client.get("/order/customerCache/stats").json()
+    for _ in range(3):
+        response = client.put(f"/order/{uuid4()}", json=update_data)
+        assert response.status_code == 200
+
+    mock_mongodb["customers"].find_one.assert_called_once_with({"id": Binary.from_uuid(customer_id)}, {"address": 1})
+    assert mock_mongodb["orders"].find_one_and_update.call_args[0][1]["$set"]["address"]["city"] == "Metropolis"
+
+    stats = client.get("/order/customerCache/stats").json()
+    assert stats["hits"] - before["hits"] == 2
+    assert stats["misses"] - before["misses"] == 1
+
+    # Invalidating the customer forces the next write back to MongoDB
+    response = client.delete(f"/order/customerCache/{customer_id}")
+    assert response.json() is True
+
+    client.put(f"/order/{uuid4()}", json=update_data)
+    assert mock_mongodb["customers"].find_one.call_count == 2
+
+# Test the cache evicts the least recently used entry and expires stale ones
+def test_ttl_cache_eviction_and_expiry():
+    cache = TTLCache(maxSize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.stats()["evictions"] == 1
+
+    expired = TTLCache(maxSize=2, ttl=-1)
+    expired.set("a", 1)
+    assert expired.get("a") is None
+##########################################
+
+
+###################BULK###################
+def make_update_order(customer_id):
+    return {
+        "customerId": str(customer_id),
+        "quantity": 1,
+        "price": 100.0,
+        "status": "pending",
+        "product": {
+            "id": str(uuid4()),
+            "name": "Product1",
+            "imageUrl": "http://example.com/product1.png"
+        }
+    }
+
+# Test bulk creation resolves customers once, inserts unordered and publishes one batch
+@patch("app.routes.publishMessages")
+def test_create_orders_bulk(mock_publish, mock_mongodb):
+    known, unknown = uuid4(), uuid4()
+    address = {
+        "addressLine": "123 Main St",
+        "city": "Metropolis",
+        "country": "Wonderland",
+        "cityCode": 12345
+    }
+
+    mock_mongodb["customers"].find.return_value.to_list = AsyncMock(return_value=[
+        {"id": Binary.from_uuid(known), "address": address}
+    ])
+    mock_mongodb["orders"].insert_many = AsyncMock(side_effect=BulkWriteError({
+        "writeErrors": [{"index": 1, "code": 11000, "errmsg": "duplicate key"}]
+    }))
+
+    response = client.post("/order/bulk", json=[
+        make_update_order(known),
+        make_update_order(unknown),
+        make_update_order(known),
+        make_update_order(known)
+    ])
+
+    assert response.status_code == 200
+
+    results = response.json()
+    assert [result["index"] for result in results] == [0, 1, 2, 3]
+    assert results[0]["id"] and results[0]["error"] is None
+    assert results[1] == {"index": 1, "id": None, "error": "Customer not found"}
+    assert results[2]["id"] is None and results[2]["error"] == "duplicate key"
+    assert results[3]["id"] and results[3]["error"] is None
+
+    mock_mongodb["customers"].find.assert_called_once()
+    query = mock_mongodb["customers"].find.call_args[0][0]
+    assert set(query["id"]["$in"]) == {Binary.from_uuid(known), Binary.from_uuid(unknown)}
+
+    documents = mock_mongodb["orders"].insert_many.call_args[0][0]
+    assert len(documents) == 3
+    assert all(document["address"]["city"] == "Metropolis" for document in documents)
+    assert mock_mongodb["orders"].insert_many.call_args[1] == {"ordered": False}
+
+    mock_publish.assert_called_once()
+    assert len(mock_publish.call_args[0][0]) == 2
+
+# Test bulk requests over the size limit are rejected
+def test_create_orders_bulk_too_large(mock_mongodb):
+    response = client.post("/order/bulk", json=[make_update_order(uuid4())] * (MAX_BULK_SIZE + 1))
+
+    assert response.status_code == 422
+##########################################
+
+##################METRICS#################
+# Test /metrics exposes per-route latency in the Prometheus text format, labelled by route template
+def test_metrics_endpoint(mock_mongodb):
+    mock_mongodb["orders"].find_one = AsyncMock(return_value=None)
+    client.get(f"/order/getByOrder/{uuid4()}")
+
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'http_requests_total{method="GET",route="/order/getByOrder/{orderId}",status="404"}' in response.text
+    assert 'http_request_duration_seconds_bucket{le="+Inf",method="GET",route="/order/getByOrder/{orderId}"}' in response.text
+    assert "http_requests_in_flight" in response.text
+
+# Test the customer address cache lookups are exported as a counter
+def test_metrics_cache_lookups_counter(mock_mongodb):
+    response = client.get("/metrics")
+
+    assert "# TYPE customer_address_cache_lookups_total counter" in response.text
+    assert 'customer_address_cache_lookups_total{result="hit"}' in response.text
+##########################################
+
+
+##################OUTBOX##################
+# Test outbox mode writes the order and its audit record in one transaction instead of publishing
+@patch("app.routes.relay")
+@patch("app.routes.publishMessage")
+def test_create_order_outbox(mock_publish, mock_relay, mock_mongodb):
+    session = object()
+
+    @asynccontextmanager
+    async def transaction():
+        yield session
+
+    mock_mongodb["customers"].find_one = AsyncMock(return_value={"address": {
+        "addressLine": "123 Main St", "city": "Sample City", "country": "Sample Country", "cityCode": 12345
+    }})
+    mock_mongodb["outbox"].insert_one = AsyncMock()
+
+    with patch("app.routes.OUTBOX_MODE", True), patch("app.routes.mongodb.transaction", transaction):
+        response = client.post("/order/", json=make_update_order(uuid4()))
+
+    assert response.status_code == 200
+    assert not mock_publish.called
+    assert mock_mongodb["orders"].insert_one.call_args.kwargs["session"] is session
+
+    record = mock_mongodb["outbox"].insert_one.call_args.args[0]
+    assert mock_mongodb["outbox"].insert_one.call_args.kwargs["session"] is session
+    assert json.loads(record["body"])["id"] == response.json()
+    assert mock_relay.wake.called
+
+# Test outbox mode commits a delete and its audit record in one transaction
+@patch("app.routes.relay")
+@patch("app.routes.publishMessage")
+def test_delete_order_outbox(mock_publish, mock_relay, mock_mongodb):
+    session = object()
+
+    @asynccontextmanager
+    async def transaction():
+        yield session
+
+    deleted = make_order()
+    mock_mongodb["orders"].find_one_and_delete = AsyncMock(return_value=deleted)
+    mock_mongodb["outbox"].insert_one = AsyncMock()
+
+    with patch("app.routes.OUTBOX_MODE", True), patch("app.routes.mongodb.transaction", transaction):
+        response = client.delete(f"/order/{UUID(bytes=deleted['id'])}")
+
+    assert response.json() is True
+    assert not mock_publish.called
+    assert mock_mongodb["orders"].find_one_and_delete.call_args.kwargs["session"] is session
+    record = mock_mongodb["outbox"].insert_one.call_args.args[0]
+    assert mock_mongodb["outbox"].insert_one.call_args.kwargs["session"] is session
+    assert "deletedAt" in json.loads(record["body"])
+    assert mock_relay.wake.called
+
+# Test the relay deletes only the records the broker confirmed
+def test_outbox_relay_drain():
+    records = [{"_id": str(uuid4()), "body": "{}", "createdAt": datetime.utcnow()} for _ in range(3)]
+    outbox = MagicMock()
+    outbox.find.return_value.sort.return_value.limit.return_value.to_list = AsyncMock(return_value=records)
+    outbox.delete_many = AsyncMock()
+
+    futures = []
+    def publish(body, properties):
+        future = Future()
+        if len(futures) == 1:
+            future.set_exception(RuntimeError("nacked"))
+        else:
+            future.set_result(True)
+        futures.append(properties.message_id)
+        return future
+
+    relay = OutboxRelay(outbox, MagicMock(), publisher=MagicMock(publish=publish), batchSize=10)
+    confirmed = asyncio.run(relay.drainOnce())
+
+    assert confirmed == 2
+    assert futures == [record["_id"] for record in records]
+    outbox.delete_many.assert_called_once_with({"_id": {"$in": [records[0]["_id"], records[2]["_id"]]}})
+    assert relay.stats()["relayed"] == 2 and relay.stats()["failed"] == 1
+
+# Test a batch the broker never confirms gives up before the lease lapses and withdraws the queued messages
+def test_outbox_relay_drain_times_out():
+    records = [{"_id": str(uuid4()), "body": "{}", "createdAt": datetime.utcnow()} for _ in range(2)]
+    outbox = MagicMock()
+    outbox.find.return_value.sort.return_value.limit.return_value.to_list = AsyncMock(return_value=records)
+    outbox.delete_many = AsyncMock()
+
+    futures = [Future(), Future()]
+    futures[0].set_result(True)
+    publish = MagicMock(side_effect=futures)
+
+    relay = OutboxRelay(outbox, MagicMock(), publisher=MagicMock(publish=publish), batchSize=10, leaseTtl=0.2, publishTimeout=5)
+    assert relay.publishTimeout == 0.1
+
+    started = time.perf_counter()
+    confirmed = asyncio.run(relay.drainOnce())
+
+    assert time.perf_counter() - started < 1
+    assert confirmed == 1
+    assert futures[1].cancelled()
+    outbox.delete_many.assert_called_once_with({"_id": {"$in": [records[0]["_id"]]}})
+    assert relay.stats()["failed"] == 1
+##########################################
+
+
+##################STATS###################
+# Test stats are summed from the rollup buckets with the requested filters and grouping
+def test_get_order_stats(mock_mongodb):
+    customer_id = uuid4()
+    mock_mongodb["orderRollups"].aggregate.return_value.to_list = AsyncMock(return_value=[
+        {"_id": {"status": "pending", "day": "2024-05-01"}, "count": 3, "quantity": 4, "revenue": 250.0},
+        {"_id": {"status": "shipped", "day": "2024-05-01"}, "count": 1, "quantity": 1, "revenue": 10.0}
+    ])
+
+    response = client.get(f"/order/stats?customerId={customer_id}&from=2024-05-01&to=2024-05-31&groupBy=status&groupBy=day")
+
+    assert response.status_code == 200
+    assert response.json()[0] == {"customerId": None, "status": "pending", "day": "2024-05-01", "count": 3, "quantity": 4, "revenue": 250.0}
+
+    pipeline = mock_mongodb["orderRollups"].aggregate.call_args[0][0]
+    assert pipeline[0] == {"$match": {
+        "_id.customerId": Binary.from_uuid(customer_id),
+        "_id.day": {"$gte": "2024-05-01", "$lte": "2024-05-31"}
+    }}
+    assert pipeline[1]["$group"]["_id"] == {"status": "$_id.status", "day": "$_id.day"}
+
+# Test an empty groupBy returns one total
+def test_get_order_stats_total(mock_mongodb):
+    mock_mongodb["orderRollups"].aggregate.return_value.to_list = AsyncMock(return_value=[
+        {"_id": None, "count": 5, "quantity": 6, "revenue": 300.0}
+    ])
+
+    response = client.get("/order/stats")
+
+    assert response.status_code == 200
+    assert mock_mongodb["orderRollups"].aggregate.call_args[0][0][1]["$group"]["_id"] is None
+    assert response.json() == [{"customerId": None, "status": None, "day": None, "count": 5, "quantity": 6, "revenue": 300.0}]
+##########################################
+
+
+##################AUDIT###################
+def make_audit_event(order_id, minute):
+    return {"_id": str(uuid4()), "id": str(order_id), "customerId": str(uuid4()), "status": "pending",
+            "createdAt": datetime(2024, 4, 1).isoformat(), "eventAt": datetime(2024, 5, 1, 10, minute).isoformat()}
+
+# Test audit events are paged by (eventAt, _id) and the cursor resumes after the last one
+@patch("app.audit.auditdb")
+def test_get_audit_by_order_paged(mock_auditdb):
+    order_id = uuid4()
+    events = [make_audit_event(order_id, minute) for minute in range(3)]
+    mock_find = mock_auditdb.collections["AuditLog"].find
+    mock_find.return_value.sort.return_value.batch_size.return_value.limit.return_value.to_list = AsyncMock(return_value=events)
+
+    response = client.get(f"/order/audit/?orderId={order_id}&from=2024-05-01T10:00:00Z&limit=2")
+
+    assert response.status_code == 200
+    assert [event["_id"] for event in response.json()["items"]] == [events[0]["_id"], events[1]["_id"]]
+    assert mock_find.call_args[0][0] == {"$and": [
+        {"id": {"$in": [str(order_id), Binary.from_uuid(order_id)]}},
+        {"$or": [{"eventAt": {"$gte": "2024-05-01T10:00:00"}}, {"eventAt": {"$gte": datetime(2024, 5, 1, 10)}}]}
+    ]}
+    mock_find.return_value.sort.assert_called_once_with([("eventAt", 1), ("_id", 1)])
+
+    mock_find.reset_mock()
+    client.get(f"/order/audit/?orderId={order_id}&cursor={response.json()['nextCursor']}")
+    after = mock_find.call_args[0][0]["$and"][1]["$or"]
+    assert after[1] == {"eventAt": events[1]["eventAt"], "_id": {"$gt": events[1]["_id"]}}
+    # BSON events, stored with native dates, sort after every JSON event
+    assert after[2] == {"eventAt": {"$type": "date"}}
+
+# Test the hourly bucket layout narrows buckets first, then filters and sorts the events
+@patch("app.audit.AUDIT_STORAGE", "buckets")
+@patch("app.audit.auditdb")
+def test_get_audit_stream_from_buckets(mock_auditdb):
+    customer_id = uuid4()
+    events = [make_audit_event(uuid4(), minute) for minute in range(2)]
+    mock_auditdb.collections["AuditLogHourly"].aggregate.return_value.__aiter__.return_value = events
+
+    response = client.get(f"/order/audit/?customerId={customer_id}&from=2024-05-01T10:30:00&stream=true")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line)["_id"] for line in response.text.splitlines()] == [event["_id"] for event in events]
+
+    pipeline = mock_auditdb.collections["AuditLogHourly"].aggregate.call_args[0][0]
+    customer_ids = {"$in": [str(customer_id), Binary.from_uuid(customer_id)]}
+    assert pipeline[0] == {"$match": {"events.customerId": customer_ids, "hour": {"$gte": datetime(2024, 5, 1, 10)}}}
+    assert pipeline[3] == {"$match": {"$and": [
+        {"customerId": customer_ids},
+        {"$or": [{"eventAt": {"$gte": "2024-05-01T10:30:00"}}, {"eventAt": {"$gte": datetime(2024, 5, 1, 10, 30)}}]}
+    ]}}
+    assert pipeline[4] == {"$sort": {"eventAt": 1, "_id": 1}}
+
+# Test BSON events keep native types in storage and are returned as JSON strings
+@patch("app.audit.auditdb")
+def test_get_audit_native_events(mock_auditdb):
+    order_id = uuid4()
+    event = {"_id": str(uuid4()), "id": Binary.from_uuid(order_id), "eventAt": datetime(2024, 5, 1, 10, 0, 0, 500000)}
+    mock_find = mock_auditdb.collections["AuditLog"].find
+    mock_find.return_value.sort.return_value.batch_size.return_value.limit.return_value.to_list = AsyncMock(return_value=[event, event])
+
+    response = client.get(f"/order/audit/?orderId={order_id}&limit=1")
+
+    assert response.status_code == 200
+    assert response.json()["items"] == [{"_id": event["_id"], "id": str(order_id), "eventAt": "2024-05-01T10:00:00.500000"}]
+
+    mock_find.reset_mock()
+    client.get(f"/order/audit/?cursor={response.json()['nextCursor']}")
+    after = mock_find.call_args[0][0]["$or"]
+    assert after == [
+        {"eventAt": {"$gt": event["eventAt"]}},
+        {"eventAt": event["eventAt"], "_id": {"$gt": event["_id"]}},
+        {"eventAt": event["eventAt"], "_id": {"$type": "objectId"}}
+    ]
+
+# Test legacy events with an ObjectId _id are encoded as strings and the cursor compares them as ObjectIds
+@patch("app.audit.auditdb")
+def test_get_audit_legacy_object_id(mock_auditdb):
+    order_id = uuid4()
+    legacy = make_audit_event(order_id, 0) | {"_id": ObjectId()}
+    mock_find = mock_auditdb.collections["AuditLog"].find
+    mock_find.return_value.sort.return_value.batch_size.return_value.limit.return_value.to_list = AsyncMock(return_value=[legacy, legacy])
+
+    response = client.get(f"/order/audit/?orderId={order_id}&limit=1")
+
+    assert response.status_code == 200
+    assert response.json()["items"][0]["_id"] == str(legacy["_id"])
+
+    mock_find.reset_mock()
+    client.get(f"/order/audit/?orderId={order_id}&cursor={response.json()['nextCursor']}")
+    after = mock_find.call_args[0][0]["$and"][1]["$or"]
+    assert after == [
+        {"eventAt": {"$gt": legacy["eventAt"]}},
+        {"eventAt": legacy["eventAt"], "_id": {"$gt": legacy["_id"]}},
+        {"eventAt": {"$type": "date"}}
+    ]
+
+# Test a malformed audit cursor is rejected
+@patch("app.audit.auditdb")
+def test_get_audit_invalid_cursor(mock_auditdb):
+    response = client.get("/order/audit/?cursor=bm90LWpzb24")
+
+    assert response.status_code == 400
+
+# Test every audit query is index-backed against a real audit database
+@pytest.mark.skipif(not os.getenv("conn_str_audit"), reason="needs a MongoDB connection string in conn_str_audit")
+def test_audit_queries_use_indexes():
+    async def check():
+        db = MongoDB(os.getenv("conn_str_audit"), [["Tesodev", "AuditLog"], ["Tesodev", "AuditLogHourly"]], AUDIT_INDEXES)
+        await db.ensureIndexes()
+        return await findCollectionScans(db, AUDIT_QUERY_SHAPES)
+
+    assert asyncio.run(check()) == []
+##########################################
+
+
+###############AUDITENCODING##############
+# Test the BSON encoding keeps UUIDs and datetimes native and the JSON one leaves the order untouched
+def test_audit_message_encodings():
+    order = make_order()
+    order["createdAt"] = datetime(2024, 5, 1, 10, 0, 0, 123000)
+
+    decoded = bson.decode(auditMessage(order, "bson"))
+    assert decoded["id"] == order["id"] and decoded["id"].subtype == 4
+    assert decoded["createdAt"] == order["createdAt"]
+    assert decoded["product"]["id"] == order["product"]["id"]
+
+    assert [event["id"] for event in bson.decode(auditMessages([order, order], "bson"))["events"]] == [order["id"]] * 2
+
+    assert json.loads(auditMessage(order, "json"))["createdAt"] == "2024-05-01T10:00:00.123000"
+    assert isinstance(order["id"], Binary), "encoding for JSON must not mutate the order"
+    assert encodeSpecialFields({"ids": [order["id"]]}) == {"ids": [str(UUID(bytes=order["id"]))]}
+
+# Test every audit event is stamped with eventAt, the time of the write it records, not the order's createdAt
+def test_audit_message_event_time():
+    order = make_order() | {"createdAt": datetime(2024, 5, 1), "updatedAt": datetime(2024, 5, 2)}
+
+    assert bson.decode(auditMessage(order, "bson"))["eventAt"] == datetime(2024, 5, 2)
+    assert json.loads(auditMessage(order | {"deletedAt": datetime(2024, 5, 3)}, "json"))["eventAt"] == "2024-05-03T00:00:00"
+    assert [event["eventAt"] for event in json.loads(auditMessages([order, order | {"updatedAt": datetime(2024, 5, 4)}], "json"))] == [
+        "2024-05-02T00:00:00", "2024-05-04T00:00:00"
+    ]
+    assert "eventAt" not in order
+
+# Test the message properties announce the encoding and schema version
+def test_audit_properties():
+    properties = auditProperties("message", "application/bson")
+
+    assert properties.message_id == "message"
+    assert properties.content_type == "application/bson"
+    assert properties.headers == {"schema_version": 1}
+    assert properties.delivery_mode == 2
+##########################################
+
+
+###############BULKSTATUS#################
+# Test a bulk transition by ids is one bulk_write whose filters only match allowed source statuses
+@patch("app.routes.publishMessages")
+def test_change_status_bulk_by_ids(mock_publish, mock_mongodb):
+    ids = [uuid4() for _ in range(3)]
+    changed = [make_order() | {"id": Binary.from_uuid(id), "status": "shipped"} for id in ids[:2]]
+    mock_mongodb["orders"].bulk_write = AsyncMock()
+    mock_mongodb["orders"].find.return_value.to_list = AsyncMock(return_value=changed)
+
+    response = client.put("/order/changeStatus", json={"status": "shipped", "ids": [str(id) for id in ids]})
+
+    assert response.status_code == 200
+    assert response.json()["updated"] == 2
+    assert response.json()["skipped"] == [str(ids[2])]
+
+    operations = mock_mongodb["orders"].bulk_write.call_args[0][0]
+    assert [operation._filter["status"] for operation in operations] == ["pending", "processing"]
+    assert operations[0]._filter["id"] == {"$in": [Binary.from_uuid(id) for id in ids]}
+    assert operations[1]._doc["$set"]["statusTransition"] == {"id": response.json()["transitionId"], "from": "processing"}
+
+    mock_mongodb["orders"].find.assert_called_once_with(
+        {"id": {"$in": [Binary.from_uuid(id) for id in ids]}, "statusTransition.id": response.json()["transitionId"]}, {"_id": 0}, session=None
+    )
+    mock_publish.assert_called_once_with(changed)
+
+# Test a filter is worked through in chunks of max_bulk_size ids, each moved and published on its own
+@patch("app.routes.MAX_BULK_SIZE", 2)
+@patch("app.routes.publishMessages")
+def test_change_status_bulk_by_filter(mock_publish, mock_mongodb):
+    customer_id = uuid4()
+    orders = [make_order(customer_id) | {"status": "cancelled"} for _ in range(3)]
+    chunks = [[{"id": order["id"]} for order in orders[:2]], [{"id": orders[2]["id"]}], []]
+    mock_find = mock_mongodb["orders"].find
+    mock_find.return_value.limit.return_value.to_list = AsyncMock(side_effect=chunks)
+    mock_find.return_value.to_list = AsyncMock(side_effect=[orders[:2], orders[2:]])
+    mock_mongodb["orders"].bulk_write = AsyncMock()
+
+    response = client.put("/order/changeStatus", json={"status": "cancelled", "filter": {"customerId": str(customer_id), "status": "pending"}})
+
+    assert response.status_code == 200
+    assert response.json()["updated"] == 3
+    transitionId = response.json()["transitionId"]
+
+    reads = [call for call in mock_find.call_args_list if call.args[1] == {"_id": 0, "id": 1}]
+    assert len(reads) == 3
+    assert reads[0].args[0] == {"customerId": Binary.from_uuid(customer_id), "status": {"$in": ["pending"]}, "statusTransition.id": {"$ne": transitionId}}
+    mock_find.return_value.limit.assert_called_with(2)
+
+    writes = [call.args[0] for call in mock_mongodb["orders"].bulk_write.call_args_list]
+    assert [[operation._filter for operation in operations] for operations in writes] == [
+        [{"id": {"$in": [order["id"] for order in orders[:2]]}, "status": "pending"}],
+        [{"id": {"$in": [orders[2]["id"]]}, "status": "pending"}]
+    ]
+    assert [call.args[0] for call in mock_publish.call_args_list] == [orders[:2], orders[2:]]
+
+# Test a filter status that cannot move to the target is a no-op
+def test_change_status_bulk_disallowed_filter(mock_mongodb):
+    mock_mongodb["orders"].bulk_write = AsyncMock()
+
+    response = client.put("/order/changeStatus", json={"status": "delivered", "filter": {"status": "pending"}})
+
+    assert response.json()["updated"] == 0
+    assert not mock_mongodb["orders"].bulk_write.called
+    assert not mock_mongodb["orders"].find.called
+
+# Test the request must name ids or a filter with criteria, and a reachable status
+def test_change_status_bulk_invalid(mock_mongodb):
+    assert client.put("/order/changeStatus", json={"status": "shipped"}).status_code == 422
+    assert client.put("/order/changeStatus", json={"status": "shipped", "filter": {}}).status_code == 422
+    assert client.put("/order/changeStatus", json={"status": "pending", "ids": [str(uuid4())]}).status_code == 422
+##########################################
+
+
+################FILTERS###################
+# Test filters, sort and field selection become one index-aligned query and projection
+def test_get_orders_filtered_sorted_projected(mock_mongodb):
+    customer_id = uuid4()
+    orders = [make_order(customer_id) | {"price": price} for price in (300.0, 200.0, 100.0)]
+    # Motor returns only the projected fields, plus the sort key and id the cursor needs
+    projected = [{"id": order["id"], "price": order["price"], "status": order["status"], "address": {"city": "Metropolis"}} for order in orders]
+
+    mock_find = MagicMock()
+    mock_find.sort.return_value.limit.return_value.to_list = AsyncMock(side_effect=lambda length: [dict(document) for document in projected])
+    mock_mongodb["orders"].find.return_value = mock_find
+
+    response = client.get(f"/order/getByCustomer/{customer_id}?status=pending&maxPrice=500&sort=-price&fields=status,address.city,address&limit=2")
+
+    assert response.status_code == 200
+    page = response.json()
+    assert page["items"] == [{"status": "pending", "address": {"city": "Metropolis"}}] * 2
+    assert page["nextCursor"]
+
+    query, projection = mock_mongodb["orders"].find.call_args[0]
+    assert query == {"customerId": Binary.from_uuid(customer_id), "status": "pending", "price": {"$lte": 500.0}}
+    assert projection == {"_id": 0, "status": 1, "address": 1, "price": 1, "id": 1}
+    mock_find.sort.assert_called_once_with([("price", -1), ("id", -1)])
+
+    # The next page continues below the last price
+    mock_mongodb["orders"].find.reset_mock()
+    response = client.get(f"/order/getByCustomer/{customer_id}?status=pending&maxPrice=500&sort=-price&fields=status&limit=2&cursor={page['nextCursor']}")
+
+    assert response.status_code == 200
+    after = mock_mongodb["orders"].find.call_args[0][0]["$and"][1]["$or"]
+    assert after == [{"price": {"$lt": 200.0}}, {"price": 200.0, "id": {"$lt": orders[1]["id"]}}]
+
+    # A cursor only resumes the sort it was made for
+    response = client.get(f"/order/getByCustomer/{customer_id}?limit=2&cursor={page['nextCursor']}")
+    assert response.status_code == 400
+
+# Test a range without a sort is read in the ranged field's order
+def test_get_orders_range_sorts_by_ranged_field(mock_mongodb):
+    mock_find = MagicMock()
+    mock_find.sort.return_value.to_list = AsyncMock(return_value=[])
+    mock_mongodb["orders"].find.return_value = mock_find
+
+    response = client.get("/order/?updatedFrom=2024-01-01T03:00:00%2B03:00")
+
+    assert response.status_code == 200
+    assert mock_mongodb["orders"].find.call_args[0][0] == {"updatedAt": {"$gte": datetime(2024, 1, 1)}}
+    mock_find.sort.assert_called_once_with([("updatedAt", 1), ("id", 1)])
+
+# Test combinations no index can serve, and unknown fields, are rejected
+def test_get_orders_invalid_filters(mock_mongodb):
+    assert client.get("/order/?minPrice=10&createdFrom=2024-01-01T00:00:00").status_code == 400
+    assert client.get("/order/?minPrice=10&sort=createdAt").status_code == 400
+    assert client.get("/order/?sort=quantity").status_code == 422
+
+    response = client.get("/order/?fields=id,secret")
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Unknown fields: secret"}
+
+# Test the explain check also flags plans that sort in memory
+def test_find_collection_scans_flags_blocking_sort():
+    mock_db = MagicMock()
+    sortedScan = {"queryPlanner": {"winningPlan": {"stage": "SORT", "inputStage": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}}}}
+    mock_db.collections.__getitem__.return_value.find.return_value.sort.return_value.explain = AsyncMock(return_value=sortedScan)
+    mock_db.collections.__getitem__.return_value.find.return_value.explain = AsyncMock(return_value=sortedScan)
+
+    shapes = [("sorted in memory", "c", {"price": {"$gte": 1}}, [("price", 1), ("id", 1)]), ("unsorted", "c", {"id": 1}, None)]
+
+    assert asyncio.run(findCollectionScans(mock_db, shapes)) == ["sorted in memory"]
+##########################################
+
+
+################CASCADE###################
+def make_cascade_worker(orders, mode="delete"):
+    jobs, collection, archive = MagicMock(), MagicMock(), MagicMock()
+    batches = [orders[offset:offset + 2] for offset in range(0, len(orders), 2)] + [[]]
+    collection.find.return_value.limit.return_value.to_list = AsyncMock(side_effect=batches)
+    collection.count_documents = AsyncMock(return_value=len(orders))
+    collection.delete_many = AsyncMock(side_effect=lambda query, session: MagicMock(deleted_count=len(query["id"]["$in"])))
+    jobs.update_one = AsyncMock()
+    archive.insert_many = AsyncMock()
+    return CascadeWorker(jobs, collection, archive, MagicMock(), batchSize=2, pause=0, mode=mode)
+
+# Test a cascade removes the orders batch by batch, audits each batch as one message and records progress
+@patch("app.cascade.publishMessages")
+def test_cascade_job_deletes_in_batches(mock_publish):
+    customer_id = uuid4()
+    orders = [make_order(customer_id) for _ in range(3)]
+    worker = make_cascade_worker(orders, mode="archive")
+    job = {"_id": Binary.from_uuid(customer_id), "mode": "archive", "deleted": 0}
+
+    asyncio.run(worker.runJob(job))
+
+    assert worker.orders.delete_many.call_count == 2
+    assert worker.orders.delete_many.call_args_list[0].args[0] == {"id": {"$in": [order["id"] for order in orders[:2]]}}
+    worker.orders.find.assert_called_with({"customerId": job["_id"]}, {"_id": 0})
+
+    # Archived before deletion, audited once per batch with deletedAt
+    assert [len(call.args[0]) for call in worker.archive.insert_many.call_args_list] == [2, 1]
+    assert [len(call.args[0]) for call in mock_publish.call_args_list] == [2, 1]
+    assert all("deletedAt" in event for event in mock_publish.call_args_list[0].args[0])
+
+    updates = [call.args[1] for call in worker.jobs.update_one.call_args_list]
+    assert updates[0] == {"$set": {"total": 3}}
+    assert [update["$inc"]["deleted"] for update in updates if "$inc" in update] == [2, 1]
+    assert updates[-1]["$set"]["status"] == "done"
+
+# Test a failing batch marks the job failed with the error
+@patch("app.cascade.publishMessages")
+def test_cascade_job_failure(mock_publish):
+    customer_id = uuid4()
+    worker = make_cascade_worker([make_order(customer_id)])
+    worker.orders.delete_many = AsyncMock(side_effect=RuntimeError("not primary"))
+
+    asyncio.run(worker.runJob({"_id": Binary.from_uuid(customer_id), "deleted": 0}))
+
+    assert not mock_publish.called
+    update = worker.jobs.update_one.call_args.args[1]["$set"]
+    assert update["status"] == "failed" and update["error"] == "not primary"
+
+# Test the cascade routes queue a job and report its progress
+def test_cascade_routes():
+    customer_id = uuid4()
+    job = {"_id": Binary.from_uuid(customer_id), "status": "running", "mode": "delete", "total": 4, "deleted": 1,
+           "batches": 1, "queuedAt": datetime.utcnow(), "owner": "worker"}
+
+    with patch("app.cascade.cascade.jobs") as mock_jobs, patch("app.cascade.cascade.wake") as mock_wake:
+        mock_jobs.update_one = AsyncMock()
+        mock_jobs.find_one = AsyncMock(return_value=job)
+
+        response = client.post(f"/order/cascade/{customer_id}?mode=archive")
+        assert response.status_code == 202
+        assert mock_jobs.update_one.call_args.args[1]["$set"]["mode"] == "archive"
+        assert mock_wake.called
+
+        response = client.get(f"/order/cascade/{customer_id}")
+        assert response.status_code == 200
+        assert response.json()["customerId"] == str(customer_id)
+        assert response.json()["progress"] == 0.25
+
+        # A job customer_service queued carries no mode and reports the workers' default
+        mock_jobs.find_one = AsyncMock(return_value={key: value for key, value in job.items() if key != "mode"})
+        assert client.get(f"/order/cascade/{customer_id}").json()["mode"] == "delete"
+
+        mock_jobs.find_one = AsyncMock(return_value=None)
+        assert client.get(f"/order/cascade/{customer_id}").status_code == 404
+##########################################
+
+
+################PUBLISHER##################
+from app.RabbitMQ import RabbitMQPublisher, PublishQueueFull
+from benchmarks.broker import FakeBroker, FakeChannel
+import pika
+
+# Test the publisher reconnects after a refused connection and a dropped channel, and retries the same message
+def test_publisher_reconnects_and_retries(monkeypatch):
+    monkeypatch.setattr("app.RabbitMQ.RECONNECT_DELAY", 0)
+    broker = FakeBroker(handshake=0, roundTrip=0)
+    refusals = [pika.exceptions.AMQPConnectionError("refused")]
+    drops = [pika.exceptions.StreamLostError("connection reset")]
+    publish = FakeChannel.basic_publish
+
+    def connect(parameters=None):
+        if refusals:
+            raise refusals.pop()
+        return broker.connect(parameters)
+
+    def basic_publish(self, *args, **kwargs):
+        if drops:
+            raise drops.pop()
+        return publish(self, *args, **kwargs)
+
+    monkeypatch.setattr(pika, "BlockingConnection", connect)
+    monkeypatch.setattr(FakeChannel, "basic_publish", basic_publish)
+
+    publisher = RabbitMQPublisher(lambda: None, poolSize=1)
+    publisher.start()
+    try:
+        assert publisher.publish(b"order").result(timeout=5) is True
+    finally:
+        publisher.stop(timeout=5)
+
+    assert broker.messages == [b"order"]
+    assert broker.connections == 2
+    assert publisher.reconnects == 1
+    assert publisher.published == 1 and publisher.failed == 0
+
+# Test stop() publishes every message still queued before closing the pool
+def test_publisher_flushes_on_stop(monkeypatch):
+    broker = FakeBroker(handshake=0, roundTrip=0.002)
+    monkeypatch.setattr(pika, "BlockingConnection", broker.connect)
+
+    publisher = RabbitMQPublisher(lambda: None, poolSize=2)
+    publisher.start()
+    futures = [publisher.publish(f"order-{i}".encode()) for i in range(20)]
+    publisher.stop(timeout=5)
+
+    assert all(future.done() and future.result() is True for future in futures)
+    assert sorted(broker.messages) == sorted(f"order-{i}".encode() for i in range(20))
+    assert not publisher.running
+
+# Test stop() during a broker outage fails the pending messages instead of hanging
+def test_publisher_stop_while_broker_down(monkeypatch):
+    monkeypatch.setattr("app.RabbitMQ.RECONNECT_DELAY", 0.01)
+
+    def refuse(parameters=None):
+        raise pika.exceptions.AMQPConnectionError("refused")
+
+    monkeypatch.setattr(pika, "BlockingConnection", refuse)
+    publisher = RabbitMQPublisher(lambda: None, poolSize=1)
+    publisher.start()
+    future = publisher.publish(b"order")
+    publisher.stop(timeout=5)
+
+    with pytest.raises(pika.exceptions.AMQPConnectionError):
+        future.result(timeout=0)
+    assert publisher.failed == 1
+
+# Test publish() fails at once when the queue is full instead of letting it grow
+def test_publisher_queue_full():
+    publisher = RabbitMQPublisher(lambda: None, poolSize=1, maxPending=2)
+    queued = [publisher.publish(b"order") for _ in range(2)]
+    rejected = publisher.publish(b"order")
+
+    with pytest.raises(PublishQueueFull):
+        rejected.result(timeout=0)
+    assert not any(future.done() for future in queued)
+    assert publisher.backlog == 2 and publisher.failed == 1
+
+# Test an unexpected error fails only its message; the worker keeps publishing the ones behind it
+def test_publisher_survives_unexpected_error(monkeypatch):
+    broker = FakeBroker(handshake=0, roundTrip=0)
+    errors = [RuntimeError("encoder bug")]
+    publish = FakeChannel.basic_publish
+
+    def basic_publish(self, *args, **kwargs):
+        if errors:
+            raise errors.pop()
+        return publish(self, *args, **kwargs)
+
+    monkeypatch.setattr(pika, "BlockingConnection", broker.connect)
+    monkeypatch.setattr(FakeChannel, "basic_publish", basic_publish)
+
+    publisher = RabbitMQPublisher(lambda: None, poolSize=1)
+    publisher.start()
+    try:
+        failing, following = publisher.publish(b"first"), publisher.publish(b"second")
+        with pytest.raises(RuntimeError):
+            failing.result(timeout=5)
+        assert following.result(timeout=5) is True
+        assert publisher.running
+    finally:
+        publisher.stop(timeout=5)
+
+    assert broker.messages == [b"second"]
+    assert publisher.failed == 1 and publisher.published == 1
+##########################################
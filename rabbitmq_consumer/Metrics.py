@@ -0,0 +1,12 @@
+from prometheus_client import start_http_server, disable_created_metrics
+
+# Seconds; covers a single insert up to a slow batch write
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+disable_created_metrics()
+
+
+def serve(port):
+    """Expose /metrics from a daemon thread, the consumer itself has no HTTP server."""
+    server, _ = start_http_server(port)
+    return server
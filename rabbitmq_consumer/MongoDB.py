@@ -1,19 +1,56 @@
 import motor.motor_asyncio
+from pymongo import monitoring
 import os
 
+from prometheus_client import Histogram, Counter
+
+from Metrics import DEFAULT_BUCKETS
+
+
+MONGO_DURATION = Histogram("mongodb_command_duration_seconds", "MongoDB command latency", ("collection", "command"), buckets=DEFAULT_BUCKETS)
+MONGO_FAILURES = Counter("mongodb_command_failures_total", "MongoDB commands that failed", ("collection", "command"))
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Times every command pymongo sends, by collection and command name."""
+    def __init__(self):
+        self.collections = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = event.command.get("collection", "") # getMore carries the cursor id instead
+        self.collections[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event):
+        collection = self.collections.pop((event.connection_id, event.request_id), "")
+        MONGO_DURATION.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        collection = self.collections.pop((event.connection_id, event.request_id), "")
+        MONGO_DURATION.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+        MONGO_FAILURES.labels(collection, event.command_name).inc()
+
 
 conn_str = os.getenv('conn_str_audit')
+# The order database, where the rollups live next to the orders they summarize; unset disables them
+conn_str_orders = os.getenv('conn_str')
 
 class MongoDB:
     def __init__(self, conn_str, list):
         self.__client = motor.motor_asyncio.AsyncIOMotorClient(
-            conn_str, serverSelectionTimeoutMS=5000
+            conn_str, serverSelectionTimeoutMS=5000, event_listeners=[CommandMetrics()]
         )
         self.collections = {}
         self.addCollection(list)
 
+    @property
+    def client(self):
+        return self.__client
+
     def addCollection(self, list):
         for collection in list:
             self.collections[collection[1]] = self.__client[collection[0]][collection[1]]
 
-mongodb = MongoDB(conn_str, [["Tesodev", "AuditLog"]])
+mongodb = MongoDB(conn_str, [["Tesodev", "AuditLog"], ["Tesodev", "AuditLogHourly"]])
+orders_mongodb = MongoDB(conn_str_orders, [["Tesodev", "orders"], ["Tesodev", "orderRollups"]]) if conn_str_orders else None
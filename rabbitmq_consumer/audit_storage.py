@@ -0,0 +1,293 @@
+"""Hour-bucketed audit storage with TTL retention.
+
+With audit_storage=buckets the consumer appends every event to a bucket
+document in AuditLogHourly instead of inserting it into AuditLog on its own:
+
+    {"_id": "2024050110:3", "hour": ISODate("2024-05-01T10:00:00Z"), "count": 2, "events": [...]}
+
+An event is stored in the buckets of the hour of its eventAt (when the write
+it records happened) and a shard picked by a hash of its _id. The upsert only
+matches a bucket that does not already hold the event and has room, so a
+redelivery is turned down, as it is in AuditLog. A bucket holds at most
+audit_bucket_max_events events; after that its hour and shard continue in
+overflow buckets ("2024050110:3:1", ...). A TTL index on `hour` drops whole
+buckets once they are audit_retention_days old.
+
+    python audit_storage.py migrate [--restart] copy AuditLog into buckets, resuming after the last run
+    python audit_storage.py compare --events N write N events in both layouts and compare
+    python audit_storage.py backfill           stamp eventAt on events stored before it existed
+"""
+from pymongo import IndexModel, UpdateOne, ASCENDING
+from pymongo.errors import BulkWriteError, OperationFailure
+from datetime import datetime
+import argparse
+import asyncio
+import hashlib
+import time
+import uuid
+import sys
+import os
+
+AUDIT_STORAGE = os.getenv('audit_storage', 'documents').lower()
+BUCKETS_COLLECTION = 'AuditLogHourly'
+# Buckets per hour; raise it when busy hours keep overflowing their buckets
+BUCKET_SHARDS = int(os.getenv('audit_bucket_shards', 16))
+# Events per bucket document, well below the 16 MB document limit; a full bucket continues in an overflow bucket
+BUCKET_MAX_EVENTS = int(os.getenv('audit_bucket_max_events', 5000))
+RETENTION_DAYS = float(os.getenv('audit_retention_days', 90))
+MIGRATION_BATCH_SIZE = int(os.getenv('audit_migration_batch_size', 1000))
+# Progress of `migrate`, one document per source collection, next to the buckets
+MIGRATION_STATE = 'AuditMigration'
+# _id types AuditLog holds: ObjectIds from before message ids, strings since
+MIGRATION_ID_TYPES = ('objectId', 'string')
+DUPLICATE_KEY = 11000
+WRITE_CONFLICT = 112
+INDEX_OPTIONS_CONFLICT = 85
+# Write errors the same document hits on every retry: bad value, type mismatch, $-prefixed field,
+# validation, document or index key too large
+PERMANENT_WRITE_ERRORS = {2, 14, 52, 121, 10334, 17280, 17419}
+
+BUCKET_INDEXES = [
+    IndexModel([("hour", ASCENDING)], name="hour_ttl", expireAfterSeconds=int(RETENTION_DAYS * 86400))
+]
+
+
+def event_time(document):
+    """When the write an event records happened; events from producers without eventAt fall back to the order's timestamps."""
+    return document.get("eventAt") or document.get("deletedAt") or document.get("updatedAt") or document.get("createdAt")
+
+
+def event_hour(document):
+    event_at = event_time(document)
+    try:
+        moment = datetime.fromisoformat(event_at) if isinstance(event_at, str) else event_at
+    except ValueError:
+        moment = None
+    moment = moment or datetime.utcnow()
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def bucket_key(document, shards=BUCKET_SHARDS):
+    hour = event_hour(document)
+    shard = int(hashlib.sha1(str(document["_id"]).encode()).hexdigest(), 16) % shards
+    return f"{hour:%Y%m%d%H}:{shard}"
+
+
+def bucket_sequence(bucket_id):
+    # "2024050110:3" is the first bucket of its hour and shard, "2024050110:3:1" the first overflow
+    parts = bucket_id.split(":")
+    return int(parts[2]) if len(parts) > 2 else 0
+
+
+def bucket_update(document, shards=BUCKET_SHARDS, sequence=0):
+    key = bucket_key(document, shards)
+    return UpdateOne(
+        {"_id": f"{key}:{sequence}" if sequence else key, "count": {"$lt": BUCKET_MAX_EVENTS}, "events._id": {"$ne": document["_id"]}},
+        {"$setOnInsert": {"hour": event_hour(document)}, "$push": {"events": document}, "$inc": {"count": 1}},
+        upsert=True
+    )
+
+
+async def write_buckets(collection, documents):
+    """Returns the error code of each index that failed, and the indexes that hit a duplicate key."""
+    try:
+        await collection.bulk_write([bucket_update(document) for document in documents], ordered=False)
+    except BulkWriteError as exc:
+        errors = exc.details["writeErrors"]
+        return ({error["index"]: error["code"] for error in errors if error["code"] != DUPLICATE_KEY},
+                {error["index"] for error in errors if error["code"] == DUPLICATE_KEY})
+    return {}, set()
+
+
+async def store_overflowing(collection, document, attempts=3):
+    """Store an event its first bucket turned down; returns None, DUPLICATE_KEY when it is stored already, or the error code.
+
+    The first bucket holds the event already, is full, or was just created by
+    another worker. Every bucket of the event's hour and shard is read, with
+    the event if it holds it, and the event goes into the first one with room
+    or a new overflow bucket. Losing a race for that bucket reads them again.
+    """
+    key = bucket_key(document)
+    for _ in range(attempts):
+        buckets = await collection.find(
+            {"_id": {"$regex": f"^{key}(:[0-9]+)?$"}},
+            {"count": 1, "events": {"$elemMatch": {"_id": document["_id"]}}}
+        ).to_list(length=None)
+        if any(bucket.get("events") for bucket in buckets):
+            return DUPLICATE_KEY
+
+        counts = {bucket_sequence(bucket["_id"]): bucket["count"] for bucket in buckets}
+        sequence = min((sequence for sequence, count in counts.items() if count < BUCKET_MAX_EVENTS), default=max(counts, default=-1) + 1)
+        try:
+            await collection.bulk_write([bucket_update(document, sequence=sequence)])
+            return None
+        except BulkWriteError as exc:
+            code = exc.details["writeErrors"][0]["code"]
+            if code != DUPLICATE_KEY:
+                return code
+    return WRITE_CONFLICT # Still contended; requeued and tried again later
+
+
+async def save_buckets(collection, documents):
+    """Append events to their buckets; returns the error code of each index that failed, and the indexes already stored.
+
+    One bulk write tries every event's first bucket. The few it turns down,
+    redeliveries and events of a full or just created bucket, are sorted out
+    one by one.
+    """
+    failed, turned_down = await write_buckets(collection, documents)
+    duplicates = set()
+    for index in sorted(turned_down):
+        code = await store_overflowing(collection, documents[index])
+        if code == DUPLICATE_KEY:
+            duplicates.add(index)
+        elif code is not None:
+            failed[index] = code
+    return failed, duplicates
+
+
+async def ensure_bucket_indexes(collection):
+    try:
+        await collection.create_indexes(BUCKET_INDEXES)
+    except OperationFailure as exc:
+        if exc.code != INDEX_OPTIONS_CONFLICT:
+            raise
+        # The retention changed; collMod updates the TTL in place
+        await collection.database.command({
+            "collMod": collection.name,
+            "index": {"name": "hour_ttl", "expireAfterSeconds": int(RETENTION_DAYS * 86400)}
+        })
+
+
+async def migrate(source, target, batch_size=MIGRATION_BATCH_SIZE, state=None, restart=False):
+    """Copy AuditLog into buckets in _id order, one pass per _id type.
+
+    Legacy events have ObjectId _ids and newer ones string _ids derived from
+    the message; $gt only matches values of its own type, so each type is
+    copied in its own pass with its own checkpoint. The last copied _id of each
+    is saved in `state` after every batch and a later run resumes after it,
+    unless `restart` is set. Events already in a bucket are skipped either way,
+    so a batch copied twice after a crash is harmless.
+    """
+    await ensure_bucket_indexes(target)
+    state = state if state is not None else target.database[MIGRATION_STATE]
+    if restart:
+        await state.delete_one({"_id": source.name})
+    checkpoint = await state.find_one({"_id": source.name})
+    lasts = checkpoint["last"] if checkpoint else {}
+    if not isinstance(lasts, dict):
+        # A checkpoint from before the per-type passes; its type restarts, which only repeats skipped events
+        lasts = {}
+        await state.update_one({"_id": source.name}, {"$set": {"last": lasts}})
+
+    copied, started = 0, time.monotonic()
+    for id_type in MIGRATION_ID_TYPES:
+        last = lasts.get(id_type)
+        if last is not None:
+            print(f' [migrate] resuming {id_type} _ids after {last}')
+        while True:
+            query = {"$type": id_type} | ({} if last is None else {"$gt": last})
+            documents = await source.find({"_id": query}).sort("_id", ASCENDING).limit(batch_size).to_list(length=batch_size)
+            if not documents:
+                break
+            failed, duplicates = await save_buckets(target, documents)
+            if failed:
+                raise RuntimeError(f"{len(failed)} events could not be written after {id_type} _id {last}")
+            copied += len(documents) - len(duplicates)
+            last = documents[-1]["_id"]
+            await state.update_one({"_id": source.name}, {
+                "$set": {f"last.{id_type}": last, "updatedAt": datetime.utcnow()},
+                "$inc": {"copied": len(documents) - len(duplicates)}
+            }, upsert=True)
+            print(f' [migrate] {copied} events copied, last {id_type} _id {last}, {copied / (time.monotonic() - started):.0f}/s')
+    return copied
+
+
+async def backfill(documents, buckets):
+    """Stamp eventAt on events stored before the producers sent it; returns the documents changed.
+
+    AuditLog events get the same fallback the consumer uses. Events in buckets
+    get their createdAt, the time their bucket was picked by, so they stay in
+    the hour the audit API looks for them in.
+    """
+    fallback = {"$ifNull": ["$eventAt", "$deletedAt", "$updatedAt", "$createdAt"]}
+    changed = (await documents.update_many({"eventAt": {"$exists": False}}, [{"$set": {"eventAt": fallback}}])).modified_count
+    changed += (await buckets.update_many({"events": {"$elemMatch": {"eventAt": {"$exists": False}}}}, [{"$set": {"events": {"$map": {
+        "input": "$events",
+        "as": "event",
+        "in": {"$mergeObjects": ["$$event", {"eventAt": {"$ifNull": ["$$event.eventAt", "$$event.createdAt"]}}]}
+    }}}}])).modified_count
+    return changed
+
+
+def sample_event(index):
+    return {
+        "_id": str(uuid.uuid4()),
+        "id": str(uuid.uuid4()),
+        "customerId": str(uuid.uuid4()),
+        "quantity": 1,
+        "price": 100.0,
+        "status": "pending",
+        "address": {"addressLine": "123 Main St", "city": "Metropolis", "country": "Wonderland", "cityCode": 12345},
+        "product": {"id": str(uuid.uuid4()), "name": f"Product{index % 100}", "imageUrl": "http://example.com/product.png"},
+        "createdAt": datetime(2024, 5, 1, index // 3600 % 24, index // 60 % 60).isoformat(),
+        "updatedAt": datetime(2024, 5, 1).isoformat(),
+        "eventAt": datetime(2024, 5, 1, index // 3600 % 24, index // 60 % 60).isoformat()
+    }
+
+
+async def storage_stats(collection):
+    stats = await collection.database.command("collStats", collection.name)
+    return {"documents": stats["count"], "storageSize": stats["storageSize"], "totalIndexSize": stats["totalIndexSize"]}
+
+
+async def compare(client, events, batch_size):
+    """Write the same events into both layouts of a scratch database and report size and rate."""
+    database = client["TesodevAuditBenchmark"]
+    await client.drop_database(database.name)
+    documents = database["AuditLog"]
+    buckets = database[BUCKETS_COLLECTION]
+    await ensure_bucket_indexes(buckets)
+
+    results = {}
+    for name, write in (
+        ("documents", lambda batch: documents.insert_many(batch, ordered=False)),
+        ("buckets", lambda batch: save_buckets(buckets, batch))
+    ):
+        started = time.monotonic()
+        for offset in range(0, events, batch_size):
+            await write([sample_event(index) for index in range(offset, min(events, offset + batch_size))])
+        elapsed = time.monotonic() - started
+        results[name] = {"eventsPerSecond": round(events / elapsed)} | await storage_stats(documents if name == "documents" else buckets)
+
+    await client.drop_database(database.name)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["migrate", "compare", "backfill"])
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=MIGRATION_BATCH_SIZE)
+    parser.add_argument("--restart", action="store_true", help="migrate: ignore the saved progress and start from the first event")
+    args = parser.parse_args()
+
+    from MongoDB import mongodb
+    loop = asyncio.get_event_loop()
+    if args.command == "migrate":
+        copied = loop.run_until_complete(migrate(mongodb.collections['AuditLog'], mongodb.collections[BUCKETS_COLLECTION], args.batch_size, restart=args.restart))
+        print(f'Copied {copied} events into {BUCKETS_COLLECTION}; AuditLog was left in place')
+    elif args.command == "backfill":
+        changed = loop.run_until_complete(backfill(mongodb.collections['AuditLog'], mongodb.collections[BUCKETS_COLLECTION]))
+        print(f'Stamped eventAt on {changed} documents')
+    else:
+        results = loop.run_until_complete(compare(mongodb.client, args.events, args.batch_size))
+        print(f"{args.events} events, batches of {args.batch_size}")
+        print(f"{'layout':<12}{'events/s':>10}{'documents':>11}{'storage MiB':>13}{'index MiB':>11}")
+        for name, result in results.items():
+            print(f"{name:<12}{result['eventsPerSecond']:>10}{result['documents']:>11}"
+                  f"{result['storageSize'] / 2**20:>13.1f}{result['totalIndexSize'] / 2**20:>11.1f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,41 +1,332 @@
 import pika
 import json
+import bson
 import asyncio
+import hashlib
+import threading
+import signal
+import time
 import os
+from pymongo.errors import BulkWriteError, DuplicateKeyError, WriteError
+from prometheus_client import Counter, Gauge, Histogram
 
-from MongoDB import mongodb
+from MongoDB import mongodb, orders_mongodb
+from rollups import save_rollups
+from audit_storage import AUDIT_STORAGE, BUCKETS_COLLECTION, PERMANENT_WRITE_ERRORS, save_buckets, ensure_bucket_indexes, event_time
+import Metrics
 
 username = os.getenv('rabbit_username')
 password = os.getenv('rabbit_password')
 ip = os.getenv('ip')
 
+QUEUE_NAME = 'order_audit_log'
+# Rejected messages end up here once the dead-letter policy in the README is set on QUEUE_NAME
+DEAD_LETTER_EXCHANGE = os.getenv('consumer_dead_letter_exchange', 'order_audit_log.dlx')
+DEAD_LETTER_QUEUE = os.getenv('consumer_dead_letter_queue', 'order_audit_log.dead')
+# A batch size above 1 switches to the batched insert_many mode
+BATCH_SIZE = int(os.getenv('consumer_batch_size', 1))
+BATCH_TIMEOUT = float(os.getenv('consumer_batch_timeout', 0.5))
+REPORT_INTERVAL = float(os.getenv('consumer_report_interval', 10))
+BACKLOG_INTERVAL = float(os.getenv('consumer_backlog_interval', 5))
+METRICS_PORT = int(os.getenv('metrics_port', 9100))
+DUPLICATE_KEY = 11000
+# Message schema versions this consumer can decode, by content type
+SUPPORTED_SCHEMAS = {'application/json': {1}, 'application/bson': {1}}
+
+CONSUMED = Counter("audit_messages_stored_total", "Audit documents written to MongoDB")
+REJECTED = Counter("audit_messages_rejected_total", "Audit messages nacked", ("requeue",))
+WRITE_DURATION = Histogram("audit_write_duration_seconds", "Time to write one message or batch to MongoDB", buckets=Metrics.DEFAULT_BUCKETS)
+BATCH_SIZE_OBSERVED = Histogram("audit_batch_size", "Documents per insert_many batch", buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500))
+QUEUE_BACKLOG = Gauge("audit_queue_backlog", "Ready messages in the audit queue at the last check")
+
+
+class Throughput:
+    """Counts stored messages and prints the rate every REPORT_INTERVAL seconds."""
+    def __init__(self, name, interval=REPORT_INTERVAL):
+        self.name = name
+        self.interval = interval
+        self.count = 0
+        self.total = 0
+        self.since = time.monotonic()
+
+    def add(self, count):
+        self.count += count
+        self.total += count
+        CONSUMED.inc(count)
+        now = time.monotonic()
+        if now - self.since >= self.interval:
+            print(f' [{self.name}] {self.count / (now - self.since):.1f} msg/s, {self.total} total')
+            self.count = 0
+            self.since = now
+
+class BacklogWatcher:
+    """Sets QUEUE_BACKLOG every `interval` seconds from its own thread and connection.
+
+    pika connections are not thread safe, and the consumer's only serves
+    timers while it waits for messages, so a consumer that is idle or stuck
+    on a write would leave the gauge at its last value.
+    """
+    def __init__(self, connection_parameters, interval=BACKLOG_INTERVAL):
+        self.connection_parameters = connection_parameters
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='backlog-watcher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(self.interval)
+            self.thread = None
+
+    def run(self):
+        connection, channel = None, None
+        while True:
+            try:
+                if channel is None or channel.is_closed:
+                    close(connection)
+                    connection = pika.BlockingConnection(self.connection_parameters())
+                    channel = connection.channel()
+                # A passive declare only reads the queue state
+                QUEUE_BACKLOG.set(channel.queue_declare(queue=QUEUE_NAME, durable=True, passive=True).method.message_count)
+            except pika.exceptions.AMQPError as exc:
+                print(f' [backlog] could not read the queue depth: {exc!r}')
+                close(connection)
+                connection, channel = None, None
+            if self.stopped.wait(self.interval):
+                break
+        close(connection)
+
+def close(connection):
+    try:
+        if connection is not None and connection.is_open:
+            connection.close()
+    except pika.exceptions.AMQPError:
+        pass
+
+def connection_parameters():
+    return pika.ConnectionParameters(
+        host=ip,
+        port=5672,
+        virtual_host='/',
+        credentials=pika.PlainCredentials(username, password)
+    )
+
+throughput = Throughput('consumer')
+stopping = False
+
+
+def decode(properties, body):
+    """Decode a message body by its content_type and schema_version headers.
+
+    Messages without them come from producers that predate the headers and
+    are JSON version 1. BSON keeps UUIDs and datetimes native, so they are
+    stored as such. Anything unknown raises ValueError and is rejected without
+    requeue, which dead-letters it when the queue has the dead-letter policy.
+    """
+    content_type = (properties and properties.content_type) or 'application/json'
+    version = ((properties and properties.headers) or {}).get('schema_version', 1)
+    if version not in SUPPORTED_SCHEMAS.get(content_type, ()):
+        raise ValueError(f'Unsupported audit message {content_type} version {version}')
+
+    if content_type == 'application/bson':
+        try:
+            data = bson.decode(body)
+        except bson.errors.InvalidBSON as exc:
+            raise ValueError(str(exc))
+        return data['events'] if list(data) == ['events'] else data
+    return json.loads(body)
+
+def to_documents(properties, body):
+    """Decode a message into its audit documents.
+
+    A message holds one event, or a JSON array of events from a bulk write.
+    Every document gets an _id derived from the message, so redeliveries are
+    not stored twice, and an eventAt when its producer predates the field.
+    """
+    data = decode(properties, body)
+    if not all(isinstance(document, dict) for document in (data if isinstance(data, list) else [data])):
+        raise ValueError('Audit events must be objects')
+    message_id = (properties and properties.message_id) or hashlib.sha1(body).hexdigest()
+    documents = data if isinstance(data, list) else [data]
+    for index, document in enumerate(documents):
+        document["_id"] = f"{message_id}:{index}" if isinstance(data, list) else message_id
+        document["eventAt"] = event_time(document)
+    return documents
+
 async def save_to_mongodb(order_data):
-    await mongodb.collections['AuditLog'].insert_one(order_data)
+    """Insert one document; returns False for a redelivery of a message that was already stored."""
+    if AUDIT_STORAGE == 'buckets':
+        failed, duplicates = await save_buckets(mongodb.collections[BUCKETS_COLLECTION], [order_data])
+        if failed:
+            raise WriteError("Audit event could not be written to its bucket", failed[0])
+        return not duplicates
+    try:
+        await mongodb.collections['AuditLog'].insert_one(order_data)
+    except DuplicateKeyError:
+        return False
+    return True
+
+async def save_batch_to_mongodb(documents):
+    """Insert a batch unordered; returns the error code of each index that failed, and the indexes already stored."""
+    if AUDIT_STORAGE == 'buckets':
+        return await save_buckets(mongodb.collections[BUCKETS_COLLECTION], documents)
+    try:
+        await mongodb.collections['AuditLog'].insert_many(documents, ordered=False)
+    except BulkWriteError as exc:
+        errors = exc.details["writeErrors"]
+        return ({error["index"]: error["code"] for error in errors if error["code"] != DUPLICATE_KEY},
+                {error["index"] for error in errors if error["code"] == DUPLICATE_KEY})
+    return {}, set()
+
+async def update_rollups(documents):
+    # Redeliveries included: the audit write may have landed before a crash that kept the rollups from it
+    if orders_mongodb is not None and documents:
+        await save_rollups(orders_mongodb.collections['orderRollups'], documents)
+
+def reject(channel, delivery_tag, requeue):
+    channel.basic_nack(delivery_tag=delivery_tag, requeue=requeue)
+    REJECTED.labels(str(requeue).lower()).inc()
 
 def callback(ch, method, properties, body):
-    order_data = json.loads(body)
+    try:
+        documents = to_documents(properties, body)
+    except ValueError:
+        # Redelivering it would fail the same way
+        reject(ch, method.delivery_tag, requeue=False)
+        return
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(save_to_mongodb(order_data))
+    with WRITE_DURATION.time():
+        if len(documents) == 1:
+            try:
+                loop.run_until_complete(save_to_mongodb(documents[0]))
+            except WriteError as exc:
+                if exc.code not in PERMANENT_WRITE_ERRORS:
+                    raise
+                reject(ch, method.delivery_tag, requeue=False)
+                return
+        else:
+            failed, _ = loop.run_until_complete(save_batch_to_mongodb(documents))
+            if failed:
+                reject(ch, method.delivery_tag, requeue=not PERMANENT_WRITE_ERRORS & set(failed.values()))
+                return
+        loop.run_until_complete(update_rollups(documents))
     ch.basic_ack(delivery_tag=method.delivery_tag)
+    throughput.add(len(documents))
 
-def consume():
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(
-            host=ip,
-            port=5672,
-            virtual_host='/',
-            credentials=pika.PlainCredentials(username, password)
-        )
-    )
+def flush(channel, batch):
+    """Write a batch with one insert_many and settle it with one multiple ack.
+
+    Undecodable messages and writes that can never succeed are rejected
+    without requeue, other writes that failed are requeued on their own and
+    the rest is acked together. If the whole insert fails, the batch is
+    requeued; the message derived _id keeps the retry from duplicating
+    documents that did make it in.
+    """
+    documents, owners, tags = [], [], []
+    for delivery_tag, properties, body in batch:
+        try:
+            decoded = to_documents(properties, body)
+        except ValueError:
+            reject(channel, delivery_tag, requeue=False)
+            continue
+        documents.extend(decoded)
+        owners.extend([delivery_tag] * len(decoded))
+        tags.append(delivery_tag)
+
+    if documents:
+        loop = asyncio.get_event_loop()
+        BATCH_SIZE_OBSERVED.observe(len(documents))
+        try:
+            with WRITE_DURATION.time():
+                failed, _ = loop.run_until_complete(save_batch_to_mongodb(documents))
+                loop.run_until_complete(update_rollups([
+                    document for index, document in enumerate(documents) if index not in failed
+                ]))
+        except Exception:
+            channel.basic_nack(delivery_tag=tags[-1], multiple=True, requeue=True)
+            raise
+
+        # A message is requeued whole if any of its documents failed, and dead-lettered if one can never be written
+        failed_tags = {owners[index] for index in failed}
+        rejected_tags = {owners[index] for index, code in failed.items() if code in PERMANENT_WRITE_ERRORS}
+        for tag in sorted(failed_tags):
+            reject(channel, tag, requeue=tag not in rejected_tags)
+
+        stored = [tag for tag in tags if tag not in failed_tags]
+        if stored:
+            # Settles every outstanding tag up to the last stored one
+            channel.basic_ack(delivery_tag=stored[-1], multiple=True)
+        throughput.add(len(documents) - len(failed))
+
+    batch.clear()
+
+def consume_batches(channel):
+    batch = []
+    started = time.monotonic()
+    for method, properties, body in channel.consume(QUEUE_NAME, inactivity_timeout=BATCH_TIMEOUT):
+        if method is not None:
+            if not batch:
+                started = time.monotonic()
+            batch.append((method.delivery_tag, properties, body))
+
+        if batch and (stopping or len(batch) >= BATCH_SIZE or time.monotonic() - started >= BATCH_TIMEOUT):
+            flush(channel, batch)
+
+        if stopping:
+            # Hands prefetched messages that never made it into a batch back to the queue
+            channel.cancel()
+            break
+
+def consume(metrics_port=METRICS_PORT):
+    if metrics_port:
+        Metrics.serve(metrics_port)
+
+    if AUDIT_STORAGE == 'buckets':
+        asyncio.get_event_loop().run_until_complete(ensure_bucket_indexes(mongodb.collections[BUCKETS_COLLECTION]))
+
+    connection = pika.BlockingConnection(connection_parameters())
     channel = connection.channel()
-    
-    channel.queue_declare(queue='order_audit_log', durable=True)
-    
-    channel.basic_qos(prefetch_count=1)
-    channel.basic_consume(queue='order_audit_log', on_message_callback=callback)
-    
-    print(' [*] Waiting for messages. To exit press CTRL+C') 
-    channel.start_consuming()
+
+    channel.queue_declare(queue=QUEUE_NAME, durable=True)
+    # The queue predates dead-lettering and its arguments cannot change, so a policy routes rejects here
+    channel.exchange_declare(exchange=DEAD_LETTER_EXCHANGE, exchange_type='fanout', durable=True)
+    channel.queue_declare(queue=DEAD_LETTER_QUEUE, durable=True)
+    channel.queue_bind(queue=DEAD_LETTER_QUEUE, exchange=DEAD_LETTER_EXCHANGE)
+
+    def drain(signum, frame):
+        # Finish the message or batch in hand, then stop consuming
+        global stopping
+        stopping = True
+        if BATCH_SIZE <= 1:
+            connection.add_callback_threadsafe(channel.stop_consuming)
+    signal.signal(signal.SIGTERM, drain)
+
+    backlog = BacklogWatcher(connection_parameters)
+    backlog.start()
+
+    print(' [*] Waiting for messages. To exit press CTRL+C')
+    if BATCH_SIZE > 1:
+        channel.basic_qos(prefetch_count=BATCH_SIZE * 2)
+        consume_batches(channel)
+    else:
+        channel.basic_qos(prefetch_count=1)
+        channel.basic_consume(queue=QUEUE_NAME, on_message_callback=callback)
+        channel.start_consuming()
+
+    backlog.stop()
+    connection.close()
+
+def run_worker(index):
+    """Entry point of a supervisor worker process; its connections and Mongo client are its own."""
+    global throughput
+    throughput = Throughput(f'worker-{index}')
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # The supervisor turns CTRL+C into a SIGTERM drain
+    consume(METRICS_PORT + index if METRICS_PORT else 0)
 
 if __name__ == "__main__":
-    consume()
\ No newline at end of file
+    consume()
@@ -0,0 +1,148 @@
+"""Order rollups: order count, quantity and revenue per customer, status and day.
+
+The consumer folds every audit event into its buckets with $inc upserts sent
+as one bulk_write; status changes and updates move orders between buckets,
+and deletes take them out. Each bucket keeps the ids of the last events it
+applied, and an update only matches a bucket that does not hold its event, so
+a redelivered message is not counted twice. The rollups can always be
+recomputed from the orders collection:
+
+    python rollups.py rebuild
+"""
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from bson import Binary
+from datetime import datetime
+from uuid import UUID
+import asyncio
+import sys
+import os
+
+from prometheus_client import Counter
+
+# Event ids remembered per bucket; a redelivery arriving after this many newer events in the same bucket counts again
+APPLIED_WINDOW = int(os.getenv('rollup_applied_window', 1000))
+DUPLICATE_KEY = 11000
+
+ROLLUP_UPDATES = Counter("order_rollup_updates_total", "Rollup buckets incremented")
+
+# Groups orders into the same buckets the consumer increments
+REBUILD_PIPELINE = [
+    {"$group": {
+        "_id": {
+            "customerId": "$customerId",
+            "status": "$status",
+            "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$createdAt"}}
+        },
+        "count": {"$sum": 1},
+        "quantity": {"$sum": "$quantity"},
+        "revenue": {"$sum": {"$multiply": ["$price", "$quantity"]}}
+    }},
+    {"$out": "orderRollups"}
+]
+
+
+def bucket(order):
+    """The rollup _id of an audit event; JSON messages carry ids and dates as strings, BSON ones natively."""
+    customer_id, created_at = order["customerId"], order["createdAt"]
+    return {
+        "customerId": customer_id if isinstance(customer_id, Binary) else Binary.from_uuid(UUID(customer_id)),
+        "status": order["status"],
+        "day": (created_at if isinstance(created_at, datetime) else datetime.fromisoformat(created_at)).strftime("%Y-%m-%d")
+    }
+
+
+def moves(order):
+    """The buckets an event changes, as (bucket, sign, quantity, price).
+
+    A new order adds to its bucket and a deleted one (deletedAt) is subtracted.
+    An event from an update carries the previous customerId, status, quantity
+    and price under `previous`; one from a status change carries
+    statusTransition and moves the order from its previous status's bucket.
+    `previous` wins, because bulk status changes leave statusTransition on the
+    order and an older producer may copy it into a later update's event.
+    """
+    if order.get("deletedAt"):
+        return [(bucket(order), -1, order["quantity"], order["price"])]
+
+    current = (bucket(order), 1, order["quantity"], order["price"])
+    transition, previous = order.get("statusTransition"), order.get("previous")
+    if previous:
+        old = order | previous
+        return [current, (bucket(old), -1, old["quantity"], old["price"])]
+    if transition:
+        return [current, (bucket(order | {"status": transition["from"]}), -1, order["quantity"], order["price"])]
+    return [current]
+
+
+def rollup_updates(orders):
+    """One guarded $inc upsert per event and bucket it changes.
+
+    The filter skips a bucket that already lists the event's _id, so on a
+    redelivery the upsert fails with a duplicate key instead of counting again.
+    """
+    updates = []
+    for order in orders:
+        deltas = {}
+        for key, sign, quantity, price in moves(order):
+            delta = deltas.setdefault(tuple(key.values()), {"_id": key, "count": 0, "quantity": 0, "revenue": 0})
+            delta["count"] += sign
+            delta["quantity"] += sign * quantity
+            delta["revenue"] += sign * price * quantity
+
+        for delta in deltas.values():
+            updates.append(UpdateOne(
+                {"_id": delta.pop("_id"), "applied": {"$ne": order["_id"]}},
+                {"$inc": delta, "$push": {"applied": {"$each": [order["_id"]], "$slice": -APPLIED_WINDOW}}},
+                upsert=True
+            ))
+    return updates
+
+
+async def write_rollups(collection, updates):
+    """Returns the updates that failed with a duplicate key."""
+    try:
+        await collection.bulk_write(updates, ordered=False)
+    except BulkWriteError as exc:
+        errors = exc.details["writeErrors"]
+        if any(error["code"] != DUPLICATE_KEY for error in errors):
+            raise
+        ROLLUP_UPDATES.inc(len(updates) - len(errors))
+        return [updates[error["index"]] for error in errors]
+    ROLLUP_UPDATES.inc(len(updates))
+    return []
+
+
+async def save_rollups(collection, orders):
+    """Apply events to their buckets, each at most once.
+
+    Two consumers creating the same bucket at once both upsert and one of them
+    gets a duplicate key for an event it has not applied, so duplicates are
+    tried once more; by then the bucket exists and only applied events fail again.
+    """
+    updates = rollup_updates(orders)
+    if updates:
+        duplicates = await write_rollups(collection, updates)
+        if duplicates:
+            await write_rollups(collection, duplicates)
+
+
+async def rebuild(mongodb):
+    """Replace the rollups with a fresh aggregation over orders.
+
+    $out swaps the collection in at the end and keeps its indexes. Increments
+    the consumer makes while the aggregation runs are lost, so run it with the
+    consumers stopped or follow it by a quiet period.
+    """
+    await mongodb.collections["orders"].aggregate(REBUILD_PIPELINE).to_list(length=None)
+    return await mongodb.collections["orderRollups"].estimated_document_count()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("usage: python rollups.py rebuild")
+
+    from MongoDB import orders_mongodb
+    if orders_mongodb is None:
+        sys.exit("conn_str is not set")
+    print(f"Rebuilt {asyncio.run(rebuild(orders_mongodb))} rollup buckets")
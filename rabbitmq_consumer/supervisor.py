@@ -0,0 +1,69 @@
+import multiprocessing
+import signal
+import time
+import os
+
+WORKERS = int(os.getenv('consumer_workers', 0)) or os.cpu_count()
+DRAIN_TIMEOUT = float(os.getenv('consumer_drain_timeout', 30))
+RESTART_DELAY = float(os.getenv('consumer_restart_delay', 5))
+
+
+def run_worker(index):
+    # Imported in the child so every worker builds its own Mongo client and connection
+    import consumer
+    consumer.run_worker(index)
+
+
+class Supervisor:
+    """Runs `workers` consumer processes, restarts the ones that die and drains them all on SIGTERM."""
+    def __init__(self, workers=WORKERS, target=run_worker):
+        self.workers = workers
+        self.target = target
+        self.context = multiprocessing.get_context('spawn')
+        self.processes = {}
+        self.restartAt = {}
+        self.stopping = False
+
+    def start_worker(self, index):
+        process = self.context.Process(target=self.target, args=(index,), name=f'consumer-worker-{index}')
+        process.start()
+        self.processes[index] = process
+        self.restartAt[index] = time.monotonic() + RESTART_DELAY
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def drain(self):
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate() # SIGTERM, the worker finishes its batch and exits
+
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        for index, process in self.processes.items():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                print(f' [supervisor] worker-{index} did not drain in {DRAIN_TIMEOUT}s, killing it')
+                process.kill()
+                process.join()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for index in range(self.workers):
+            self.start_worker(index)
+        print(f' [supervisor] started {self.workers} workers')
+
+        while not self.stopping:
+            time.sleep(0.5)
+            for index, process in self.processes.items():
+                # Waits RESTART_DELAY after the last start so a worker that crashes on boot does not spin
+                if not process.is_alive() and not self.stopping and time.monotonic() >= self.restartAt[index]:
+                    print(f' [supervisor] worker-{index} exited with code {process.exitcode}, restarting')
+                    self.start_worker(index)
+
+        print(' [supervisor] draining workers')
+        self.drain()
+
+if __name__ == "__main__":
+    Supervisor().run()
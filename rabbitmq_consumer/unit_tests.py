@@ -0,0 +1,448 @@
+import pytest
+from types import SimpleNamespace
+from unittest.mock import MagicMock, AsyncMock, patch, ANY
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, WriteError
+from functools import partial
+from pathlib import Path
+import threading
+import asyncio
+import signal
+import json
+import time
+import sys
+import pika
+
+import consumer
+import supervisor
+import rollups
+import audit_storage
+
+#Mock AuditLog collection
+@pytest.fixture
+def mock_auditlog():
+    with patch.dict(consumer.mongodb.collections, {"AuditLog": MagicMock()}) as collections:
+        yield collections["AuditLog"]
+
+@pytest.fixture(autouse=True)
+def thread_loop():
+    # The consumer drives its Motor calls with run_until_complete on the thread's loop
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    yield
+    asyncio.get_event_loop().close()
+
+def message(event, message_id=None):
+    return json.dumps(event).encode(), pika.BasicProperties(content_type="application/json", message_id=message_id)
+
+def event(status="pending"):
+    return {"id": "c9f8b9c4-6f5e-4ec4-9a3e-3c1d8f6d7e51", "customerId": "d1b0c1a4-6f5e-4ec4-9a3e-3c1d8f6d7e51",
+            "quantity": 2, "price": 10.0, "status": status, "createdAt": "2024-05-01T10:00:00"}
+
+def write_error(index, code):
+    return {"index": index, "code": code, "errmsg": "duplicate key" if code == 11000 else "write failed"}
+
+
+##################BATCHES##################
+# Test a mixed batch: undecodable messages are rejected, failed writes requeued on their own, duplicates and the rest acked together
+def test_flush_mixed_batch(mock_auditlog):
+    channel = MagicMock()
+    batch = []
+    for tag, message_id in enumerate(["first", None, "failing", "duplicate", "last"], start=1):
+        body, properties = message(event(), message_id)
+        if tag == 2:
+            body = b"{not json"
+        batch.append((tag, properties, body))
+
+    # Documents are numbered in batch order without the undecodable message: first, failing, duplicate, last
+    mock_auditlog.insert_many = AsyncMock(side_effect=BulkWriteError({"writeErrors": [write_error(1, 1), write_error(2, 11000)]}))
+
+    consumer.flush(channel, batch)
+
+    documents = mock_auditlog.insert_many.call_args.args[0]
+    assert [document["_id"] for document in documents] == ["first", "failing", "duplicate", "last"]
+    assert mock_auditlog.insert_many.call_args.kwargs == {"ordered": False}
+    channel.basic_nack.assert_any_call(delivery_tag=2, requeue=False)
+    channel.basic_nack.assert_any_call(delivery_tag=3, requeue=True)
+    assert channel.basic_nack.call_count == 2
+    # One multiple ack settles the stored and duplicate messages up to the last stored one
+    channel.basic_ack.assert_called_once_with(delivery_tag=5, multiple=True)
+    assert batch == []
+
+# Test a message holding several events is requeued whole when one of its documents fails
+def test_flush_requeues_whole_bulk_message(mock_auditlog):
+    channel = MagicMock()
+    bulk = json.dumps([event(), event("shipped")]).encode()
+    single, properties = message(event(), "single")
+    batch = [(1, pika.BasicProperties(message_id="bulk"), bulk), (2, properties, single)]
+    mock_auditlog.insert_many = AsyncMock(side_effect=BulkWriteError({"writeErrors": [write_error(1, 1)]}))
+
+    consumer.flush(channel, batch)
+
+    assert [document["_id"] for document in mock_auditlog.insert_many.call_args.args[0]] == ["bulk:0", "bulk:1", "single"]
+    channel.basic_nack.assert_called_once_with(delivery_tag=1, requeue=True)
+    channel.basic_ack.assert_called_once_with(delivery_tag=2, multiple=True)
+
+# Test a failed insert_many requeues the whole batch and nothing is acked
+def test_flush_requeues_batch_when_insert_fails(mock_auditlog):
+    channel = MagicMock()
+    batch = []
+    for tag in (1, 2, 3):
+        body, properties = message(event(), f"m{tag}")
+        batch.append((tag, properties, body))
+    mock_auditlog.insert_many = AsyncMock(side_effect=ConnectionError("mongo down"))
+
+    with pytest.raises(ConnectionError):
+        consumer.flush(channel, batch)
+
+    channel.basic_nack.assert_called_once_with(delivery_tag=3, multiple=True, requeue=True)
+    channel.basic_ack.assert_not_called()
+
+# Test a redelivered batch produces the same _ids, so documents that were already stored are skipped as duplicates
+def test_flush_redelivery_is_not_stored_twice(mock_auditlog):
+    channel = MagicMock()
+    body, properties = message(event())
+    mock_auditlog.insert_many = AsyncMock()
+    consumer.flush(channel, [(1, properties, body)])
+    first = mock_auditlog.insert_many.call_args.args[0][0]["_id"]
+
+    mock_auditlog.insert_many = AsyncMock(side_effect=BulkWriteError({"writeErrors": [write_error(0, 11000)]}))
+    consumer.flush(channel, [(7, properties, body)])
+
+    assert mock_auditlog.insert_many.call_args.args[0][0]["_id"] == first
+    channel.basic_ack.assert_called_with(delivery_tag=7, multiple=True)
+    channel.basic_nack.assert_not_called()
+##########################################
+
+
+#################CALLBACK##################
+# Test single-message mode stores and acks a message, and rejects one it cannot decode without requeueing it
+def test_callback_rejects_undecodable_message(mock_auditlog):
+    channel = MagicMock()
+    mock_auditlog.insert_one = AsyncMock()
+    body, properties = message(event(), "good")
+
+    consumer.callback(channel, SimpleNamespace(delivery_tag=1), properties, body)
+
+    assert mock_auditlog.insert_one.call_args.args[0]["_id"] == "good"
+    channel.basic_ack.assert_called_once_with(delivery_tag=1)
+
+    for tag, (body, properties) in enumerate([
+        (b"{not json", pika.BasicProperties(content_type="application/json")),
+        (b"[1, 2]", pika.BasicProperties(content_type="application/json")),
+        (b"{}", pika.BasicProperties(content_type="application/json", headers={"schema_version": 9}))
+    ], start=2):
+        consumer.callback(channel, SimpleNamespace(delivery_tag=tag), properties, body)
+        channel.basic_nack.assert_called_with(delivery_tag=tag, requeue=False)
+
+    assert mock_auditlog.insert_one.call_count == 1
+    assert channel.basic_ack.call_count == 1
+
+# Test the consumer declares the dead-letter exchange and queue the README policy routes rejects to
+def test_consume_declares_dead_letter_queue(monkeypatch):
+    channel = MagicMock()
+    monkeypatch.setattr(pika, "BlockingConnection", MagicMock(return_value=MagicMock(channel=MagicMock(return_value=channel))))
+    monkeypatch.setattr(pika, "ConnectionParameters", MagicMock())
+    monkeypatch.setattr(consumer, "BATCH_SIZE", 1)
+    monkeypatch.setattr(consumer.signal, "signal", MagicMock())
+
+    consumer.consume(metrics_port=0)
+
+    channel.exchange_declare.assert_called_once_with(exchange=consumer.DEAD_LETTER_EXCHANGE, exchange_type="fanout", durable=True)
+    channel.queue_declare.assert_any_call(queue=consumer.DEAD_LETTER_QUEUE, durable=True)
+    channel.queue_bind.assert_called_once_with(queue=consumer.DEAD_LETTER_QUEUE, exchange=consumer.DEAD_LETTER_EXCHANGE)
+    channel.start_consuming.assert_called_once()
+
+# Test the backlog gauge follows the queue depth with no messages consumed, and survives a refused connection
+def test_backlog_watcher_polls_while_idle(monkeypatch):
+    depth = [7]
+    channel = MagicMock(is_closed=False)
+    channel.queue_declare.side_effect = lambda **kwargs: SimpleNamespace(method=SimpleNamespace(message_count=depth[0]))
+    refusals = [pika.exceptions.AMQPConnectionError("refused")]
+
+    def connect(parameters):
+        if refusals:
+            raise refusals.pop()
+        return MagicMock(channel=MagicMock(return_value=channel))
+    monkeypatch.setattr(pika, "BlockingConnection", connect)
+
+    watcher = consumer.BacklogWatcher(lambda: None, interval=0.01)
+    watcher.start()
+    try:
+        deadline = time.monotonic() + 5
+        while consumer.QUEUE_BACKLOG._value.get() != 7 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert consumer.QUEUE_BACKLOG._value.get() == 7
+
+        depth[0] = 3
+        while consumer.QUEUE_BACKLOG._value.get() != 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert consumer.QUEUE_BACKLOG._value.get() == 3
+    finally:
+        watcher.stop()
+
+    assert channel.queue_declare.call_args.kwargs == {"queue": consumer.QUEUE_NAME, "durable": True, "passive": True}
+    assert watcher.thread is None
+##########################################
+
+
+#################SUPERVISOR#################
+# Stub worker targets; the supervisor spawns them, so they live at module level
+def crashing_worker(index):
+    sys.exit(3)
+
+def draining_worker(directory, index):
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    Path(directory, f"ready-{index}").touch()
+    while not stopping:
+        time.sleep(0.01)
+    Path(directory, f"drained-{index}").touch()
+
+def stuck_worker(directory, index):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    Path(directory, f"ready-{index}").touch()
+    while True:
+        time.sleep(1)
+
+@pytest.fixture
+def signal_handlers():
+    # Supervisor.run installs its own SIGTERM and SIGINT handlers
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+    yield
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+def stop_when(instance, condition, timeout=30):
+    def wait():
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        instance.stop()
+    thread = threading.Thread(target=wait, daemon=True)
+    thread.start()
+    return thread
+
+# Test a worker that dies is started again, after the restart delay
+def test_supervisor_restarts_crashed_workers(monkeypatch, signal_handlers):
+    monkeypatch.setattr(supervisor, "RESTART_DELAY", 0)
+    instance = supervisor.Supervisor(workers=1, target=crashing_worker)
+    starts = []
+    start_worker = instance.start_worker
+    monkeypatch.setattr(instance, "start_worker", lambda index: (starts.append(index), start_worker(index)))
+
+    stop_when(instance, lambda: len(starts) >= 3)
+    instance.run()
+
+    assert starts[:3] == [0, 0, 0]
+
+# Test SIGTERM lets every worker finish and exit on its own
+def test_supervisor_drains_workers(tmp_path, signal_handlers):
+    instance = supervisor.Supervisor(workers=2, target=partial(draining_worker, str(tmp_path)))
+
+    stop_when(instance, lambda: all(Path(tmp_path, f"ready-{index}").exists() for index in range(2)))
+    instance.run()
+
+    assert [process.exitcode for process in instance.processes.values()] == [0, 0]
+    assert all(Path(tmp_path, f"drained-{index}").exists() for index in range(2))
+
+# Test a worker that does not drain within the timeout is killed
+def test_supervisor_kills_stuck_workers(tmp_path, monkeypatch, signal_handlers):
+    monkeypatch.setattr(supervisor, "DRAIN_TIMEOUT", 0.5)
+    instance = supervisor.Supervisor(workers=1, target=partial(stuck_worker, str(tmp_path)))
+
+    stop_when(instance, lambda: Path(tmp_path, "ready-0").exists())
+    instance.run()
+
+    assert instance.processes[0].exitcode == -signal.SIGKILL
+##########################################
+
+
+##################ROLLUPS##################
+def applied_updates(updates):
+    return [(update._filter["_id"]["status"], update._doc["$inc"]["count"], update._doc["$inc"]["revenue"]) for update in updates]
+
+# Test every kind of event turns into guarded $inc upserts on the buckets it moves the order between
+def test_rollup_updates_moves():
+    created = event() | {"_id": "created"}
+    transition = event("shipped") | {"_id": "transition", "statusTransition": {"id": "t", "from": "pending"}}
+    updated = event("pending") | {"_id": "updated", "quantity": 3, "previous": {"customerId": event()["customerId"], "status": "pending", "quantity": 2, "price": 10.0}}
+    deleted = event() | {"_id": "deleted", "deletedAt": "2024-05-02T10:00:00"}
+
+    updates = rollups.rollup_updates([created, transition, updated, deleted])
+
+    assert applied_updates(updates) == [
+        ("pending", 1, 20.0),
+        ("shipped", 1, 20.0), ("pending", -1, -20.0),
+        # An update that stays in its bucket is one net change
+        ("pending", 0, 10.0),
+        ("pending", -1, -20.0)
+    ]
+    assert [update._filter["applied"] for update in updates[:2]] == [{"$ne": "created"}, {"$ne": "transition"}]
+    assert updates[0]._doc["$push"]["applied"]["$each"] == ["created"]
+
+# Test an update after a bulk status change moves the order out of the bucket it was in, not the one the transition left
+def test_rollup_updates_update_after_transition():
+    previous = {"customerId": event()["customerId"], "status": "processing", "quantity": 1, "price": 10.0}
+    updated = event("shipped") | {"_id": "updated", "quantity": 5, "statusTransition": {"id": "t", "from": "pending"}, "previous": previous}
+
+    assert applied_updates(rollups.rollup_updates([updated])) == [("shipped", 1, 50.0), ("processing", -1, -10.0)]
+
+# Test a redelivered event fails on its guard and is retried once, and other write errors are raised
+def test_save_rollups_applies_each_event_once():
+    collection = MagicMock()
+    redelivered = event() | {"_id": "redelivered"}
+    collection.bulk_write = AsyncMock(side_effect=BulkWriteError({"writeErrors": [write_error(0, 11000)]}))
+
+    asyncio.get_event_loop().run_until_complete(rollups.save_rollups(collection, [redelivered]))
+
+    assert collection.bulk_write.call_count == 2
+    assert collection.bulk_write.call_args.args[0][0]._filter["applied"] == {"$ne": "redelivered"}
+
+    collection.bulk_write = AsyncMock(side_effect=BulkWriteError({"writeErrors": [write_error(0, 1)]}))
+    with pytest.raises(BulkWriteError):
+        asyncio.get_event_loop().run_until_complete(rollups.save_rollups(collection, [redelivered]))
+
+# Test documents the audit log already held still reach the rollups, whose own guard skips what they applied
+def test_flush_rolls_up_duplicates(mock_auditlog):
+    channel = MagicMock()
+    batch = []
+    for tag, message_id in enumerate(["stored", "duplicate", "failing"], start=1):
+        body, properties = message(event(), message_id)
+        batch.append((tag, properties, body))
+    mock_auditlog.insert_many = AsyncMock(side_effect=BulkWriteError({"writeErrors": [write_error(1, 11000), write_error(2, 1)]}))
+
+    with patch("consumer.orders_mongodb", MagicMock()), patch("consumer.save_rollups", AsyncMock()) as save_rollups:
+        consumer.flush(channel, batch)
+
+    assert [document["_id"] for document in save_rollups.call_args.args[1]] == ["stored", "duplicate"]
+##########################################
+
+
+###############AUDITSTORAGE################
+# Test events are bucketed by the time of their own write, with a fallback for producers that predate eventAt
+def test_event_time_and_hour():
+    transition = event("shipped") | {"updatedAt": "2024-05-03T08:15:00", "eventAt": "2024-05-03T08:15:00"}
+    assert audit_storage.event_hour(transition) == audit_storage.datetime(2024, 5, 3, 8)
+
+    body, properties = message(event() | {"updatedAt": "2024-05-02T09:30:00", "deletedAt": "2024-05-04T11:00:00"}, "legacy")
+    document = consumer.to_documents(properties, body)[0]
+    assert document["eventAt"] == "2024-05-04T11:00:00"
+    assert audit_storage.event_hour(document) == audit_storage.datetime(2024, 5, 4, 11)
+
+    bulk = consumer.to_documents(pika.BasicProperties(message_id="bulk"), json.dumps([event(), transition]).encode())
+    assert [(document["_id"], document["eventAt"]) for document in bulk] == [("bulk:0", "2024-05-01T10:00:00"), ("bulk:1", "2024-05-03T08:15:00")]
+
+# Test an event whose bucket is full goes to an overflow bucket, and one already stored in any of them is a duplicate
+def test_save_buckets_overflows_full_bucket():
+    full, stored = event() | {"_id": "full"}, event() | {"_id": "stored"}
+    full_key, stored_key = audit_storage.bucket_key(full), audit_storage.bucket_key(stored)
+    assert audit_storage.bucket_update(full)._filter == {"_id": full_key, "count": {"$lt": audit_storage.BUCKET_MAX_EVENTS}, "events._id": {"$ne": "full"}}
+
+    buckets = {
+        full_key: [{"_id": full_key, "count": audit_storage.BUCKET_MAX_EVENTS}],
+        stored_key: [{"_id": stored_key, "count": audit_storage.BUCKET_MAX_EVENTS}, {"_id": f"{stored_key}:1", "count": 3, "events": [{"_id": "stored"}]}]
+    }
+    def find(query, projection):
+        cursor = MagicMock()
+        key = query["_id"]["$regex"][1:].split("(")[0]
+        cursor.to_list = AsyncMock(return_value=buckets[key])
+        return cursor
+
+    collection = MagicMock()
+    collection.find.side_effect = find
+    collection.bulk_write = AsyncMock(side_effect=[BulkWriteError({"writeErrors": [write_error(0, 11000), write_error(1, 11000)]}), None])
+
+    failed, duplicates = asyncio.get_event_loop().run_until_complete(audit_storage.save_buckets(collection, [full, stored]))
+
+    assert (failed, duplicates) == ({}, {1})
+    overflow = collection.bulk_write.call_args.args[0][0]
+    assert overflow._filter["_id"] == f"{full_key}:1" and overflow._doc["$push"]["events"]["_id"] == "full"
+
+# Test writes that fail the same way on every retry are dead-lettered, in batches and in single-message mode
+def test_permanent_write_errors_are_not_requeued(mock_auditlog):
+    channel = MagicMock()
+    batch = []
+    for tag, message_id in enumerate(["too-large", "transient", "ok"], start=1):
+        body, properties = message(event(), message_id)
+        batch.append((tag, properties, body))
+    mock_auditlog.insert_many = AsyncMock(side_effect=BulkWriteError({"writeErrors": [write_error(0, 10334), write_error(1, 1)]}))
+
+    consumer.flush(channel, batch)
+
+    channel.basic_nack.assert_any_call(delivery_tag=1, requeue=False)
+    channel.basic_nack.assert_any_call(delivery_tag=2, requeue=True)
+    channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+
+    channel = MagicMock()
+    mock_auditlog.insert_one = AsyncMock(side_effect=WriteError("document too large", 10334))
+    body, properties = message(event(), "single")
+    consumer.callback(channel, SimpleNamespace(delivery_tag=4), properties, body)
+    channel.basic_nack.assert_called_once_with(delivery_tag=4, requeue=False)
+    channel.basic_ack.assert_not_called()
+
+    mock_auditlog.insert_one = AsyncMock(side_effect=WriteError("write conflict", 112))
+    with pytest.raises(WriteError):
+        consumer.callback(channel, SimpleNamespace(delivery_tag=5), properties, body)
+
+# Test migrate resumes after the saved _id of each type, records its progress per batch, and --restart starts over
+def test_migrate_resumes_from_checkpoint():
+    source, target, state = MagicMock(), MagicMock(), MagicMock()
+    source.name = "AuditLog"
+    batches = [[], [event() | {"_id": "c"}, event() | {"_id": "d"}], []]
+    source.find.return_value.sort.return_value.limit.return_value.to_list = AsyncMock(side_effect=batches)
+    target.create_indexes = AsyncMock()
+    target.bulk_write = AsyncMock()
+    state.find_one = AsyncMock(return_value={"_id": "AuditLog", "last": {"string": "b"}, "copied": 2})
+    state.update_one = AsyncMock()
+    state.delete_one = AsyncMock()
+
+    copied = asyncio.get_event_loop().run_until_complete(audit_storage.migrate(source, target, batch_size=2, state=state))
+
+    assert copied == 2
+    assert [call.args[0] for call in source.find.call_args_list] == [
+        {"_id": {"$type": "objectId"}},
+        {"_id": {"$type": "string", "$gt": "b"}},
+        {"_id": {"$type": "string", "$gt": "d"}}
+    ]
+    update = state.update_one.call_args
+    assert update.args[0] == {"_id": "AuditLog"}
+    assert update.args[1]["$set"]["last.string"] == "d" and update.args[1]["$inc"] == {"copied": 2}
+    assert not state.delete_one.called
+
+    state.find_one = AsyncMock(return_value=None)
+    source.find.reset_mock()
+    source.find.return_value.sort.return_value.limit.return_value.to_list = AsyncMock(return_value=[])
+    asyncio.get_event_loop().run_until_complete(audit_storage.migrate(source, target, state=state, restart=True))
+
+    state.delete_one.assert_called_once_with({"_id": "AuditLog"})
+    assert source.find.call_args_list[0].args[0] == {"_id": {"$type": "objectId"}}
+
+# Test legacy ObjectId events are copied even when string _ids, which sort first, were copied already
+def test_migrate_mixed_id_types():
+    legacy = [ObjectId() for _ in range(3)]
+    stored = [event() | {"_id": _id} for _id in legacy] + [event() | {"_id": "msg-a"}, event() | {"_id": "msg-b"}]
+
+    def find(query):
+        condition = query["_id"]
+        kind = ObjectId if condition["$type"] == "objectId" else str
+        matches = [document for document in stored if isinstance(document["_id"], kind) and ("$gt" not in condition or document["_id"] > condition["$gt"])]
+        cursor = MagicMock()
+        cursor.sort.return_value.limit.return_value.to_list = AsyncMock(return_value=sorted(matches, key=lambda document: document["_id"])[:2])
+        return cursor
+
+    source, target, state = MagicMock(), MagicMock(), MagicMock()
+    source.name = "AuditLog"
+    source.find.side_effect = find
+    target.create_indexes = AsyncMock()
+    target.bulk_write = AsyncMock()
+    # An interrupted run had finished the string _ids only
+    state.find_one = AsyncMock(return_value={"_id": "AuditLog", "last": {"string": "msg-b"}, "copied": 2})
+    state.update_one = AsyncMock()
+
+    copied = asyncio.get_event_loop().run_until_complete(audit_storage.migrate(source, target, batch_size=2, state=state))
+
+    assert copied == 3
+    written = [update._doc["$push"]["events"]["_id"] for call in target.bulk_write.call_args_list for update in call.args[0]]
+    assert written == legacy
+    assert state.update_one.call_args.args[1]["$set"] == {"last.objectId": legacy[-1], "updatedAt": ANY}
+##########################################